@@ -4,11 +4,12 @@ warnings.filterwarnings("ignore", category=UserWarning, module="urllib3")
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from .config import DevelopmentConfig, AcceptanceConfig, ProductionConfig
+from .replicas import RoutingSession
 
 from swagger import init_swagger
 
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 def create_app(config_name=None):
     app = Flask(__name__)
@@ -24,10 +25,40 @@ def create_app(config_name=None):
 
     # Initialize extensions
     db.init_app(app)
+    with app.app_context():
+        from .pool import init_pool
+        init_pool(app, db.engines.values())
+        from .metrics import init_metrics
+        init_metrics(app, db.engines.values())
+    from .replicas import init_replicas
+    init_replicas(app)
     swagger = init_swagger(app)
 
+    from .auth import init_auth
+    init_auth(app)
+    from .cache import init_cache
+    init_cache(app)
+    from .compression import init_compression
+    init_compression(app)
+    from .json_provider import init_json_provider
+    init_json_provider(app)
+    from .exports import init_exports
+    init_exports(app)
+    from .changes import init_changes
+    init_changes(app)
+
     # Register blueprints
     from .routes import api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
+    from .instrumentation import instrumentation_bp
+    app.register_blueprint(instrumentation_bp, url_prefix='/api/instrumentation')
+    from .exports import exports_bp
+    app.register_blueprint(exports_bp, url_prefix='/api/exports')
+
+    # CLI commands
+    from .importer import books_cli
+    from .stats import refresh_stats_command
+    books_cli.add_command(refresh_stats_command)
+    app.cli.add_command(books_cli)
 
     return app
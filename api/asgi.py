@@ -0,0 +1,332 @@
+"""ASGI deployment with async read endpoints.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 80 --workers 4
+
+GET /api/books, GET /api/books/<id> and GET /api/books/search run on
+SQLAlchemy's asyncio engine (asyncpg / aiosqlite), so a single process can
+hold thousands of slow clients or slow queries without tying up a thread
+each. They reuse the blueprint's query builders, serializers, auth check
+and JSON provider, so responses are the same as the Flask routes, and they
+are recorded under the same endpoint names in /metrics. With
+REPLICA_DATABASE_URIS set they read from the replicas, as the Flask routes
+do. Every other request
+(writes, docs, instrumentation) is handed to the Flask app through
+a2wsgi's WSGI adapter (uvicorn's own is deprecated).
+"""
+import asyncio
+import io
+import re
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qs, urlencode
+
+from a2wsgi import WSGIMiddleware
+from a2wsgi.wsgi import build_environ
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from werkzeug.wrappers import Request
+
+from . import db
+from .auth import authenticate, check_rate_limit
+from .compression import cached_response, finish_response
+from .filters import book_filters, book_sort, books_select, decode_position, seek, encode_position
+from .models import Book
+from .pagination import encode_cursor, parse_limit
+from .metrics import instrument_engine, start_request, finish_request
+from .pool import init_pool
+from .replicas import UNAVAILABLE_ERRORS, ReplicaSet
+from .routes import NDJSON_MIMETYPE, wants_ndjson
+from .search import MAX_SEARCH_OFFSET, search_terms, search_statement, decode_offset
+from .serializers import BOOK_COLUMNS, serialize_row
+from .versioning import book_etag, catalog_state, catalog_state_select, collection_etag
+
+_BOOK_PATH = re.compile(r'^/api/books/(\d+)$')
+
+_ASYNC_DRIVERS = {
+    'postgres': 'postgresql+asyncpg',
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+}
+
+
+def create_async_engine_for(app, url=None):
+    """Async engine for the app's database (or `url`), with the same pool settings as the sync one."""
+    if url is None:
+        with app.app_context():
+            url = db.engine.url  # Flask-SQLAlchemy has already resolved relative SQLite paths
+    url = url.set(drivername=_ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+    options = {key: value for key, value in app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}).items()
+               if key in ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle', 'pool_pre_ping')}
+    if options:
+        options['poolclass'] = AsyncAdaptedQueuePool  # aiosqlite would otherwise get NullPool
+    if url.drivername == 'postgresql+asyncpg':
+        options['connect_args'] = {
+            "server_settings": {"statement_timeout": str(app.config['DB_STATEMENT_TIMEOUT_MS'])}}
+    engine = create_async_engine(url, **options)
+    init_pool(app, [engine.sync_engine])
+    instrument_engine(engine.sync_engine)
+    return engine
+
+
+def create_async_replica_set(app):
+    """ReplicaSet of async engines for the app's read replicas, or None when it has none."""
+    replicas = app.extensions.get('replicas')
+    if replicas is None:
+        return None
+    return ReplicaSet([create_async_engine_for(app, engine.url) for engine in replicas.engines],
+                      replicas.retry_after)
+
+
+class AsyncReadApp:
+    """ASGI app serving the book read endpoints natively and everything else through Flask."""
+
+    def __init__(self, flask_app, engine=None):
+        self.flask_app = flask_app
+        self.config = flask_app.config
+        self.engine = engine or create_async_engine_for(flask_app)
+        self.replicas = create_async_replica_set(flask_app)
+        self.wsgi = WSGIMiddleware(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            handler, endpoint, args = self.match(scope['path'], scope['query_string'])
+            if handler is not None:
+                return await self.dispatch(scope, send, handler, endpoint, args)
+        return await self.wsgi(scope, receive, send)
+
+    async def dispatch(self, scope, send, handler, endpoint, args):
+        """Run a native handler, recording the same metrics as the Flask hooks."""
+        started = time.perf_counter()
+        start_request()
+        sent = {"status": None, "size": 0}
+        extra_headers = []
+
+        async def measured_send(message):
+            if message['type'] == 'http.response.start':
+                sent["status"] = message['status']
+                message['headers'] = list(message['headers']) + extra_headers
+            else:
+                sent["size"] += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            request = Request(build_environ(scope, io.BytesIO()))
+            key = authenticate(request.headers.get('X-API-Key'), self.flask_app)
+            if key is None:
+                return await self.send_json(measured_send, {"error": "Invalid API key"}, 401)
+            limit = check_rate_limit(key, self.flask_app)
+            if limit is not None:
+                extra_headers += [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                  for name, value in limit.headers().items()]
+                if not limit.allowed:
+                    return await self.send_json(measured_send, {"error": "Rate limit exceeded. Retry later."}, 429)
+            return await handler(request, measured_send, *args)
+        finally:
+            self.flask_app.extensions['metrics'].record(
+                endpoint, 'GET', sent["status"] or 500, time.perf_counter() - started,
+                sent["size"], finish_request())
+
+    def match(self, path, query_string=b''):
+        """Return (handler, blueprint endpoint name, args) for natively served paths."""
+        if path == '/api/books':
+            if 'ids' in parse_qs(query_string.decode('latin-1')):
+                return None, None, ()  # batch lookups by ID are served by Flask
+            return self.get_books, 'api.get_books', ()
+        if path == '/api/books/search':
+            return self.search_books, 'api.search_books', ()
+        book_path = _BOOK_PATH.match(path)
+        if book_path:
+            return self.get_book, 'api.get_book', (int(book_path.group(1)),)
+        return None, None, ()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispose(self):
+        await self.engine.dispose()
+        for engine in self.replicas.engines if self.replicas is not None else []:
+            await engine.dispose()
+
+    @asynccontextmanager
+    async def connect(self):
+        """Connection for a read: to a healthy replica if there is one, like @replica_reads.
+
+        A replica that can't be connected to is skipped for REPLICA_RETRY_AFTER
+        seconds and the read goes to the primary.
+        """
+        engine = self.replicas.choose() if self.replicas is not None else None
+        conn = None
+        if engine is not None:
+            try:
+                conn = await engine.connect().start()
+            except UNAVAILABLE_ERRORS:
+                self.flask_app.logger.warning("Replica %s unavailable, reading from the primary",
+                                              engine.url.render_as_string(hide_password=True), exc_info=True)
+                self.replicas.mark_down(engine)
+        if conn is None:
+            conn = await self.engine.connect().start()
+        try:
+            yield conn
+        finally:
+            await conn.close()
+
+    # Responses
+
+    async def send_response(self, send, response):
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in response.headers.to_wsgi_list()],
+        })
+        await send({'type': 'http.response.body', 'body': response.get_data()})
+
+    async def send_json(self, send, payload, status=200, etag=None, headers=None, request=None, cache_etag=None):
+        """Send `payload`; given the request, compressed (and cached) like the Flask routes' responses."""
+        response = self.flask_app.json.response(payload)
+        response.status_code = status
+        if etag:
+            response.set_etag(etag)
+        response.headers.extend(headers or {})
+        if request is not None:
+            # Compression and the sqlite cache's writes block; keep them off the event loop
+            await asyncio.to_thread(finish_response, self.flask_app, request, response, cache_etag)
+        await self.send_response(send, response)
+
+    async def send_not_modified(self, send, etag):
+        response = self.flask_app.response_class(status=304)
+        response.set_etag(etag)
+        await self.send_response(send, response)
+
+    def page_limit(self, request):
+        return parse_limit(request.args.get('limit'),
+                           self.config['BOOKS_DEFAULT_PAGE_SIZE'],
+                           self.config['BOOKS_MAX_PAGE_SIZE'])
+
+    # Endpoints, mirroring api/routes.py
+
+    async def get_books(self, request, send):
+        try:
+            filters = book_filters(request.args)
+            sort = book_sort(request.args)
+            paginate = 'limit' in request.args or 'cursor' in request.args
+            if paginate:
+                limit = self.page_limit(request)
+                position = decode_position(request.args['cursor'], sort) if request.args.get('cursor') else None
+        except ValueError as e:
+            return await self.send_json(send, {"error": str(e)}, 400)
+
+        ndjson = wants_ndjson(request)
+        async with self.connect() as conn:
+            state = catalog_state((await conn.execute(catalog_state_select())).first())
+            etag = collection_etag(state, request.query_string.decode(),
+                                   NDJSON_MIMETYPE if ndjson else 'application/json')
+            if request.if_none_match.contains_weak(etag):
+                return await self.send_not_modified(send, etag)
+
+            if ndjson:
+                return await self.stream_books(conn, send, books_select(filters, sort), etag)
+
+            # In a thread: a sqlite cache hit may write (LRU touch, counters). Without waiting for
+            # other workers' fills, which would tie up the thread pool.
+            cached = await asyncio.to_thread(cached_response, self.flask_app, request, etag, False)
+            if cached is not None:
+                return await self.send_response(send, cached)
+
+            if not paginate:
+                rows = await conn.execute(books_select(filters, sort))
+                return await self.send_json(send, [serialize_row(row) for row in rows], etag=etag,
+                                            request=request, cache_etag=etag)
+
+            query = books_select(filters, sort)
+            if position is not None:
+                query = seek(query, sort, position)
+            # Fetch one extra row to know whether another page exists
+            books = (await conn.execute(query.limit(limit + 1))).all()
+
+        next_url = None
+        headers = {}
+        if len(books) > limit:
+            books = books[:limit]
+            args = request.args.to_dict()
+            args.update(limit=limit, cursor=encode_position(books[-1], sort))
+            next_url = f"/api/books?{urlencode(args)}"
+            headers['Link'] = f'<{next_url}>; rel="next"'
+        await self.send_json(send, {"books": [serialize_row(book) for book in books], "next": next_url},
+                             etag=etag, headers=headers, request=request, cache_etag=etag)
+
+    async def stream_books(self, conn, send, query, etag):
+        batch_size = self.config['BOOKS_STREAM_BATCH_SIZE']
+        response = self.flask_app.response_class(mimetype=NDJSON_MIMETYPE)
+        response.set_etag(etag)
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in response.headers.to_wsgi_list()
+                        if name.lower() != 'content-length'],
+        })
+        dumps = self.flask_app.json.dumps
+        result = await conn.stream(query.execution_options(yield_per=batch_size))
+        async for rows in result.partitions():
+            body = ''.join(dumps(serialize_row(row), separators=(',', ':')) + '\n' for row in rows)
+            await send({'type': 'http.response.body', 'body': body.encode(), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def get_book(self, request, send, book_id):
+        cache = self.flask_app.extensions['book_cache']
+        entry = cache.get(book_id)
+        if entry is None:
+            async with self.connect() as conn:
+                row = (await conn.execute(
+                    select(*BOOK_COLUMNS, Book.__table__.c.version).where(Book.__table__.c.id == book_id)
+                )).first()
+                on_replica = conn.engine is not self.engine
+            if row is None:
+                return await self.send_json(send, {"error": "Book not found"}, 404)
+            entry = (book_etag(row.id, row.version), serialize_row(row[:len(BOOK_COLUMNS)]))
+            if not on_replica:
+                cache.set(book_id, entry)  # a lagging replica's row could outlive the write that replaced it
+        etag, payload = entry
+        if request.if_none_match.contains_weak(etag):
+            return await self.send_not_modified(send, etag)
+        await self.send_json(send, payload, etag=etag, request=request)
+
+    async def search_books(self, request, send):
+        q = request.args.get('q', '')
+        terms = search_terms(q)
+        if not terms:
+            return await self.send_json(send, {"error": "Missing search query. Use ?q=<terms>."}, 400)
+        try:
+            limit = self.page_limit(request)
+            offset = decode_offset(request.args['cursor']) if request.args.get('cursor') else 0
+        except ValueError as e:
+            return await self.send_json(send, {"error": str(e)}, 400)
+
+        try:
+            statement, params = search_statement(terms, self.engine.dialect.name)
+        except NotImplementedError as e:
+            return await self.send_json(send, {"error": str(e)}, 501)
+        async with self.connect() as conn:
+            books = (await conn.execute(statement, {**params, "limit": limit + 1, "offset": offset})).all()
+        next_url = None
+        if len(books) > limit:
+            books = books[:limit]
+            if offset + limit <= MAX_SEARCH_OFFSET:
+                cursor = encode_cursor({"offset": offset + limit})
+                next_url = f"/api/books/search?{urlencode({'q': q, 'limit': limit, 'cursor': cursor})}"
+        await self.send_json(send, {"books": [serialize_row(book) for book in books], "next": next_url},
+                             request=request)
@@ -1,12 +1,84 @@
-from flask import request, jsonify, current_app
+import hashlib
 from functools import wraps
 
+from flask import request, jsonify, current_app, g
+
+from .ratelimit import create_rate_limiter
+
+
+class ApiKey:
+    """A configured key: its name and token-bucket settings (see api/ratelimit.py)."""
+    __slots__ = ('name', 'rate', 'burst')
+
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+
+
+def hash_api_key(api_key):
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+def load_api_keys(config):
+    """Map sha256(key) -> ApiKey from API_KEY and API_KEY_HASHES.
+
+    API_KEY_HASHES is a comma-separated list of name:sha256hex, optionally
+    followed by :rate:burst to override RATE_LIMIT_RATE/RATE_LIMIT_BURST.
+    """
+    rate, burst = config['RATE_LIMIT_RATE'], config['RATE_LIMIT_BURST']
+    keys = {}
+    if config.get('API_KEY'):
+        keys[hash_api_key(config['API_KEY'])] = ApiKey('default', rate, burst)
+    for entry in filter(None, (part.strip() for part in config.get('API_KEY_HASHES', '').split(','))):
+        name, digest, *limits = entry.split(':')
+        key_rate = float(limits[0]) if limits else rate
+        key_burst = int(limits[1]) if len(limits) > 1 else burst
+        keys[digest.lower()] = ApiKey(name, key_rate, key_burst)
+    return keys
+
+
+def authenticate(api_key, app):
+    """The ApiKey for a presented key, or None. One hash and one dict lookup."""
+    if api_key is None:
+        return None
+    return app.extensions['api_keys'].get(hash_api_key(api_key))
+
+
+def check_rate_limit(key, app):
+    """Take a token for `key`; None when rate limiting is off."""
+    limiter = app.extensions['rate_limiter']
+    return limiter.check(key) if limiter is not None else None
+
+
+def configure_auth(app):
+    """(Re)load the keys and their rate limiter from app.config."""
+    keys = app.extensions['api_keys'] = load_api_keys(app.config)
+    # Keys sharing a name (e.g. old and new during a rotation) share a bucket
+    app.extensions['rate_limiter'] = create_rate_limiter(
+        app.config, sorted({key.name for key in keys.values()}))
+
+
+def init_auth(app):
+    configure_auth(app)
+
+    @app.after_request
+    def add_rate_limit_headers(response):
+        limit = g.get('rate_limit')
+        if limit is not None:
+            response.headers.extend(limit.headers())
+        return response
+
+
 # Decorator to require API key for a route
 def require_api_key(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        api_key = request.headers.get('X-API-Key')
-        if api_key == current_app.config["API_KEY"]:  # Fetch the API key from config
-            return f(*args, **kwargs)
-        return jsonify({"error": "Invalid API key"}), 401
+        key = authenticate(request.headers.get('X-API-Key'), current_app)
+        if key is None:
+            return jsonify({"error": "Invalid API key"}), 401
+        limit = g.rate_limit = check_rate_limit(key, current_app)
+        if limit is not None and not limit.allowed:
+            return jsonify({"error": "Rate limit exceeded. Retry later."}), 429
+        return f(*args, **kwargs)
     return decorated
@@ -0,0 +1,152 @@
+"""Change feed behind GET /api/books/changes.
+
+Every write through the API bumps catalog_state.version and, in the same
+transaction, appends one book_change row per book it touched, tagged
+with that version. The catalog_state row stays locked from the bump to the
+commit, so versions become visible in commit order. Once a reader sees
+version N, nothing can still commit at N or below. Reading the log in
+(catalog_version, id) order after a cursor therefore never skips a
+change, and it costs one index range scan over the changes since the
+cursor, not the catalog.
+
+Deletes are logged like other changes, so a client that applies the feed in
+order converges on the catalog without downloading it again. To start,
+take a snapshot (GET /api/books or an export) and read the feed from its
+catalog version.
+
+Long polls and event streams hold a worker thread while they wait, so at
+most CHANGES_MAX_WAITERS of them wait at once per worker. Past that, a long
+poll answers right away and a stream is refused with 503, leaving the
+other threads free for the rest of the API.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+
+from flask import current_app
+from werkzeug.http import http_date
+
+from . import db
+from .models import Book, BookChange
+from .pagination import decode_cursor, encode_cursor, is_cursor_int
+from .serializers import BOOK_COLUMNS, serialize_row
+from .versioning import catalog_version
+
+
+def init_changes(app):
+    # Slots for long polls and event streams, see the module docstring
+    app.extensions['changes_waiters'] = threading.BoundedSemaphore(app.config['CHANGES_MAX_WAITERS'])
+
+
+def record_changes(op, book_ids, version, connection=None):
+    """Log `op` for `book_ids` at catalog `version`, inside the current transaction.
+
+    Uses the session unless a Core `connection` is given.
+    """
+    executor = connection if connection is not None else db.session
+    now = datetime.now(timezone.utc)
+    rows = [{"catalog_version": version, "book_id": book_id, "op": op, "changed_at": now}
+            for book_id in book_ids]
+    if rows:
+        executor.execute(db.insert(BookChange), rows)
+
+
+def parse_since(value):
+    """Position (version, change id or None) after which to read.
+
+    `value` is a cursor returned by the feed, or a bare catalog version
+    (e.g. an export's catalog_version) meaning "after everything in it".
+    """
+    if not value:
+        return 0, None
+    if value.isascii() and value.isdigit():
+        if not is_cursor_int(int(value)):
+            raise ValueError("Invalid since. The catalog version is out of range.")
+        return int(value), None
+    position = decode_cursor(value)
+    version, change_id = position.get('v'), position.get('id')
+    if not is_cursor_int(version) or not (change_id is None or is_cursor_int(change_id)):
+        raise ValueError("Invalid cursor.")
+    return version, change_id
+
+
+def encode_since(version, change_id):
+    return encode_cursor({"v": version, "id": change_id})
+
+
+def changes_select(version, change_id, limit):
+    """Changes after (version, change_id), each with the book's current columns (NULL once deleted)."""
+    after = BookChange.catalog_version > version
+    if change_id is not None:
+        after = after | ((BookChange.catalog_version == version) & (BookChange.id > change_id))
+    return (
+        db.select(BookChange.id, BookChange.catalog_version, BookChange.book_id, BookChange.op,
+                  BookChange.changed_at, *BOOK_COLUMNS)
+        .outerjoin(Book, Book.id == BookChange.book_id)
+        .where(after)
+        .order_by(BookChange.catalog_version, BookChange.id)
+        .limit(limit)
+    )
+
+
+def serialize_change(row):
+    change_id, version, book_id, op, changed_at, *book = row
+    return {
+        "id": book_id,
+        "op": op,
+        "version": version,
+        "changed_at": http_date(changed_at.replace(tzinfo=timezone.utc)),
+        # The book as it is now, which may be newer than this change; null once deleted
+        "book": serialize_row(book) if book[0] is not None else None,
+    }
+
+
+def read_changes(version, change_id, limit):
+    """Returns (changes, cursor after them, whether more are waiting)."""
+    rows = db.session.execute(changes_select(version, change_id, limit + 1)).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        change_id, version = rows[-1][0], rows[-1][1]
+    return [serialize_change(row) for row in rows], encode_since(version, change_id), more
+
+
+def wait_for_changes(version, change_id, limit, timeout):
+    """read_changes, polling catalog_state for up to `timeout` seconds while there are none."""
+    interval = current_app.config['CHANGES_POLL_INTERVAL']
+    deadline = time.monotonic() + timeout
+    while True:
+        result = read_changes(version, change_id, limit)
+        if result[0] or time.monotonic() >= deadline:
+            return result
+        # End the transaction so the next poll sees new commits, and give the connection back meanwhile
+        db.session.rollback()
+        while time.monotonic() < deadline:
+            time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+            current = catalog_version()
+            db.session.rollback()
+            if current > version:
+                break
+
+
+def sse_events(version, change_id, limit, duration):
+    """Server-Sent Events for the feed: one `change` event per change, `id` is the resume cursor."""
+    interval = current_app.config['CHANGES_POLL_INTERVAL']
+    dumps = current_app.json.dumps
+    deadline = time.monotonic() + duration
+    keepalive_at = time.monotonic() + current_app.config['CHANGES_KEEPALIVE_INTERVAL']
+    yield "retry: 1000\n\n"
+    while time.monotonic() < deadline:
+        rows = db.session.execute(changes_select(version, change_id, limit)).all()
+        db.session.rollback()
+        for row in rows:
+            change_id, version = row[0], row[1]
+            yield (f"id: {encode_since(version, change_id)}\nevent: change\n"
+                   f"data: {dumps(serialize_change(row), separators=(',', ':'))}\n\n")
+        if len(rows) == limit:
+            continue
+        if time.monotonic() >= keepalive_at:
+            keepalive_at = time.monotonic() + current_app.config['CHANGES_KEEPALIVE_INTERVAL']
+            yield ": keepalive\n\n"
+        time.sleep(interval)
+    # The client reconnects with Last-Event-ID and picks up where this stream stopped
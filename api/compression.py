@@ -0,0 +1,130 @@
+"""Content-negotiated gzip/brotli for the API blueprint.
+
+Responses of at least COMPRESS_MIN_SIZE bytes with a JSON or text
+mimetype are compressed with the best encoding the client accepts: br if
+the optional brotli package is installed, otherwise gzip. Streamed bodies
+(NDJSON) are left alone. Compressed responses get a weak ETag, as nginx
+does: same content, different bytes. If-None-Match uses weak comparison,
+so conditional GETs keep working.
+
+GET /api/books and /api/books/stats also cache the final bytes per (path,
+collection ETag, encoding) in the collection cache (see
+api/response_cache.py). The ETag includes the catalog version, so a write
+makes the old entries unreachable. Until then, repeated requests skip the
+query, serialization and compression.
+"""
+import gzip
+
+from flask import current_app, g, request
+
+from .response_cache import create_response_cache
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is always available
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson')
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+READ_ONLY_ENDPOINTS = ('api.batch_get_books',)  # POSTs that change nothing
+# Headers worth replaying from a cached listing
+_CACHED_HEADERS = ('Content-Type', 'Content-Encoding', 'ETag', 'Link', 'Vary')
+
+
+def negotiate_encoding(request):
+    """'br', 'gzip' or None for the request's Accept-Encoding."""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding, config):
+    if encoding == 'br':
+        return brotli.compress(data, quality=config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(data, compresslevel=config['COMPRESS_GZIP_LEVEL'], mtime=0)
+
+
+def compress_response(response, request, config):
+    """Compress `response` in place for `request` if it is worth it."""
+    if (response.direct_passthrough or response.is_streamed or not 200 <= response.status_code < 300
+            or 'Content-Encoding' in response.headers
+            or not (response.mimetype in COMPRESSIBLE_MIMETYPES or response.mimetype.startswith('text/'))):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(request)
+    if encoding is None or response.content_length is None or response.content_length < config['COMPRESS_MIN_SIZE']:
+        return response
+    response.set_data(compress(response.get_data(), encoding, config))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def _cache_key(app, request, etag):
+    encoding = negotiate_encoding(request) if app.config['COMPRESS_ENABLED'] else None
+    return f"{request.path} {etag} {encoding or 'identity'}"
+
+
+def cached_response(app, request, etag, wait=True):
+    """A ready response for this path, collection ETag and the request's encoding, or None.
+
+    With a shared cache, `wait` lets the caller wait briefly for another
+    worker that is already building the same response.
+    """
+    cache = app.extensions['collection_cache']
+    if cache is None:
+        return None
+    entry = cache.get(_cache_key(app, request, etag), wait=wait)
+    if entry is None:
+        return None
+    body, headers = entry
+    return app.response_class(body, headers=headers)
+
+
+def finish_response(app, request, response, cache_etag=None):
+    """Compress an API response and, given its collection ETag, cache the result."""
+    if app.config['COMPRESS_ENABLED']:
+        compress_response(response, request, app.config)
+    cache = app.extensions['collection_cache']
+    if (cache_etag is not None and cache is not None
+            and response.status_code == 200 and not response.is_streamed):
+        headers = [(name, response.headers[name]) for name in _CACHED_HEADERS if name in response.headers]
+        cache.set(_cache_key(app, request, cache_etag), response.get_data(), headers)
+    return response
+
+
+def init_compression(app):
+    app.extensions['collection_cache'] = create_response_cache(app.config)
+
+    @app.after_request
+    def compress_api_response(response):
+        if request.blueprint != 'api':
+            return response
+        cache = app.extensions['collection_cache']
+        if (cache is not None and request.method in WRITE_METHODS and request.endpoint not in READ_ONLY_ENDPOINTS
+                and response.status_code < 400):
+            # Cached entries are for the old catalog version now; free their space
+            cache.invalidate()
+        return finish_response(app, request, response, g.pop('collection_cache_etag', None))
+
+    @app.teardown_request
+    def release_cache_leases(exception=None):
+        # Fills this request claimed but did not store (errors, oversized bodies)
+        cache = app.extensions['collection_cache']
+        if cache is not None:
+            cache.release()
+
+
+def mark_cacheable(etag):
+    """Have this request's response cached under the collection `etag` once it is compressed."""
+    g.collection_cache_etag = etag
+
+
+def cached_collection_response(etag):
+    """Cached GET /api/books response for `etag`, or None. For use inside a request."""
+    return cached_response(current_app, request, etag)
@@ -1,26 +1,95 @@
 # api/config.py
 
 import os
+from .pool import InstrumentedQueuePool
+
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 15000))  # Postgres only
+
+
+def engine_options(uri):
+    """SQLALCHEMY_ENGINE_OPTIONS for `uri`, tunable from the environment."""
+    if not uri or uri in ('sqlite://', 'sqlite:///:memory:'):
+        return {}  # in-memory SQLite must keep SQLAlchemy's single-connection pool
+    options = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": int(os.environ.get('DB_POOL_SIZE', 5)),
+        "max_overflow": int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        "pool_timeout": float(os.environ.get('DB_POOL_TIMEOUT', 10)),  # seconds to wait for a checkout
+        "pool_recycle": int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        "pool_pre_ping": os.environ.get('DB_POOL_PRE_PING', '1') == '1',  # survives RDS failovers
+    }
+    if uri.startswith('postgres'):
+        options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    elif uri.startswith('sqlite'):
+        options["pool_pre_ping"] = False  # nothing to go stale on a local file
+        options["connect_args"] = {"timeout": float(os.environ.get('SQLITE_BUSY_TIMEOUT', 15))}
+    return options
+
 
 class Config:
     """Base config class."""
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = os.environ.get('SECRET_KEY', 'aJNisndsjd6YVHDS') # app key
     API_KEY = os.environ.get("API_KEY", "fake-key")  # Default API key for development
+    API_KEY_HASHES = os.environ.get('API_KEY_HASHES', '')  # more keys: "name:sha256hex[:rate:burst],..."
+    RATE_LIMIT_RATE = float(os.environ.get('RATE_LIMIT_RATE', 50))  # requests per second per key, sustained
+    RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 200))  # requests per key allowed at once
+    RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')  # memory, mmap (shared per host), module:Class or none
+    RATE_LIMIT_FILE = os.environ.get('RATE_LIMIT_FILE', '/tmp/io-library-ratelimit')  # mmap backend state
+    BOOKS_DEFAULT_PAGE_SIZE = int(os.environ.get('BOOKS_DEFAULT_PAGE_SIZE', 100))
+    BOOKS_MAX_PAGE_SIZE = int(os.environ.get('BOOKS_MAX_PAGE_SIZE', 1000))  # hard cap for ?limit=
+    BOOKS_STREAM_BATCH_SIZE = int(os.environ.get('BOOKS_STREAM_BATCH_SIZE', 1000))  # rows per fetch when streaming NDJSON
+    BOOKS_BULK_MAX_ITEMS = int(os.environ.get('BOOKS_BULK_MAX_ITEMS', 5000))  # books per POST /books/bulk
+    BOOKS_BATCH_GET_MAX_ITEMS = int(os.environ.get('BOOKS_BATCH_GET_MAX_ITEMS', 5000))  # ids/isbns per batch get
+    CHANGES_MAX_WAIT = float(os.environ.get('CHANGES_MAX_WAIT', 30))  # cap for ?wait= long polls on /books/changes
+    CHANGES_POLL_INTERVAL = float(os.environ.get('CHANGES_POLL_INTERVAL', 0.5))  # seconds between catalog_state checks while waiting
+    CHANGES_STREAM_SECONDS = float(os.environ.get('CHANGES_STREAM_SECONDS', 300))  # SSE streams end after this; clients reconnect
+    CHANGES_MAX_WAITERS = int(os.environ.get('CHANGES_MAX_WAITERS', 2))  # long polls + SSE streams waiting at once per worker; keep below GUNICORN_THREADS
+    CHANGES_KEEPALIVE_INTERVAL = float(os.environ.get('CHANGES_KEEPALIVE_INTERVAL', 15))  # SSE comment lines keep proxies from timing out
+    STATS_COUNT_LIMIT = int(os.environ.get('STATS_COUNT_LIMIT', 10000))  # SQLite stops counting filtered views here
+    BOOK_CACHE_MAX_ENTRIES = int(os.environ.get('BOOK_CACHE_MAX_ENTRIES', 10000))  # per worker, 0 disables
+    BOOK_CACHE_TTL = float(os.environ.get('BOOK_CACHE_TTL', 30))  # seconds; staleness bound across workers
+    # Host advertised in the Swagger spec; when unset the docs use the request's host
+    SWAGGER_HOST = os.environ.get('SWAGGER_HOST') or (
+        f"{os.environ['PUBLIC_IP']}:80" if os.environ.get('PUBLIC_IP') else None)
+    SWAGGER_USE_IMDS = os.environ.get('SWAGGER_USE_IMDS') == '1'  # look the host up from EC2 metadata, lazily
+    COMPRESS_ENABLED = os.environ.get('COMPRESS_ENABLED', '1') == '1'  # gzip/brotli for /api responses
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))  # bytes; smaller bodies are sent as is
+    COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+    COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))  # used only if brotli is installed
+    COLLECTION_CACHE_MAX_BYTES = int(os.environ.get('COLLECTION_CACHE_MAX_BYTES', 64 * 1024 * 1024))  # per worker (memory) or host (sqlite), 0 disables
+    COLLECTION_CACHE_BACKEND = os.environ.get('COLLECTION_CACHE_BACKEND', 'memory')  # memory, sqlite (shared per host) or module:Class
+    COLLECTION_CACHE_FILE = os.environ.get('COLLECTION_CACHE_FILE', '/tmp/io-library-responses.db')  # sqlite backend
+    COLLECTION_CACHE_FILL_WAIT = float(os.environ.get('COLLECTION_CACHE_FILL_WAIT', 2))  # seconds to wait for another worker's fill
+    JSON_USE_ORJSON = os.environ.get('JSON_USE_ORJSON', '1') == '1'  # used only if orjson is installed
+    BOOKS_IMPORT_BATCH_SIZE = int(os.environ.get('BOOKS_IMPORT_BATCH_SIZE', 50000))  # rows per transaction in `flask books import`
+    BOOKS_IN_CLAUSE_CHUNK_SIZE = 500  # keeps IN (...) lists under driver/SQLite parameter limits
+    DB_STATEMENT_TIMEOUT_MS = DB_STATEMENT_TIMEOUT_MS
+    METRICS_DIR = os.environ.get('METRICS_DIR')  # shared by all workers on a host; unset = this process only
+    METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))  # seconds between snapshots
+    EXPORTS_DIR = os.environ.get('EXPORTS_DIR')  # where export files are written; defaults to <instance>/exports
+    EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', 1))  # export processes per web worker
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 5000))  # rows per server-side cursor fetch
+    REPLICA_DATABASE_URIS = os.environ.get('REPLICA_DATABASE_URIS', '')  # comma-separated; GET /books, /books/<id> and search read from these
+    REPLICA_RETRY_AFTER = float(os.environ.get('REPLICA_RETRY_AFTER', 30))  # seconds a failed replica is skipped
+    SQLITE_WAL = True  # journal_mode=WAL for file-backed SQLite databases
 
 class DevelopmentConfig(Config):
     """Development environment settings."""
     SQLALCHEMY_DATABASE_URI = os.environ.get('DEV_DATABASE_URI', 'sqlite:///library.db')
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
     DEBUG = True
 
 class AcceptanceConfig(Config): # api docs (/apidocs) more likely to point to
     """Testing environment settings."""
     SQLALCHEMY_DATABASE_URI = os.environ.get('ACC_DATABASE_URI', 'sqlite:///test_library.db')
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
     TESTING = True
     DEBUG = True
 
 class ProductionConfig(Config):
     """Production environment settings."""
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URI')  # treating the EC2 instances as PRD
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
     DEBUG = False
     TESTING = False
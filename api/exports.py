@@ -0,0 +1,319 @@
+"""Background exports of the whole catalog to a compressed file.
+
+POST /api/exports records a job and hands it to a small process pool
+(EXPORT_WORKERS processes per web worker, started on first use). The export
+process opens its own database connection, reads Book through a server-side
+cursor inside one snapshot (REPEATABLE READ on Postgres; an explicit read
+transaction in WAL-mode SQLite) and writes gzip or zstd compressed CSV or
+NDJSON to EXPORTS_DIR. The catalog_version a job records is read in the
+same snapshot, so the change feed resumes exactly after the file. Serializing and compressing happen outside the web worker, so
+they don't compete with requests for its GIL.
+
+Job state lives in the export_job table, so any worker can answer
+GET /api/exports/<id>. Finished files are served by send_file, which
+gunicorn turns into sendfile(2).
+"""
+import csv
+import gzip
+import io
+import json
+import logging
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+
+from flask import Blueprint, current_app, jsonify, request, send_file, url_for
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.pool import NullPool
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for compression=zstd
+    zstandard = None
+
+from . import db
+from .auth import require_api_key
+from .models import Book, ExportJob
+from .serializers import BOOK_COLUMNS, serialize_row
+from .versioning import catalog_version_select
+
+exports_bp = Blueprint('exports', __name__)
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'ndjson')
+COMPRESSIONS = {  # name -> (file suffix, mimetype)
+    'gzip': ('gz', 'application/gzip'),
+    'zstd': ('zst', 'application/zstd'),
+}
+
+
+def export_filename(job):
+    return f"{job.id}.{job.format}.{COMPRESSIONS[job.compression][0]}"
+
+
+def _open_compressed(path, compression):
+    """Text stream writing compressed bytes to `path`."""
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', encoding='utf-8', newline='', compresslevel=6)
+    raw = open(path, 'wb')
+    return io.TextIOWrapper(zstandard.ZstdCompressor(level=3).stream_writer(raw), encoding='utf-8', newline='')
+
+
+def _csv_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def write_snapshot(connection, out, file_format, batch_size):
+    """Write every book to `out`, reading through a server-side cursor.
+
+    Returns (rows written, catalog version). Call inside a transaction.
+    """
+    version = connection.scalar(catalog_version_select()) or 0
+    result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(
+        select(*BOOK_COLUMNS).order_by(Book.id))
+    rows = 0
+    if file_format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow([column.name for column in BOOK_COLUMNS])
+        for partition in result.partitions():
+            writer.writerows([_csv_value(value) for value in row] for row in partition)
+            rows += len(partition)
+    else:
+        for partition in result.partitions():
+            # Same objects and key order as GET /api/books?stream=1
+            out.write(''.join(json.dumps(serialize_row(row), sort_keys=True, separators=(',', ':')) + '\n'
+                              for row in partition))
+            rows += len(partition)
+    return rows, version
+
+
+def run_export(database_uri, job_id, directory, batch_size):
+    """Entry point in the export process: build the file and record the outcome."""
+    engine = create_engine(database_uri, poolclass=NullPool)
+    table = ExportJob.__table__
+    try:
+        with engine.begin() as connection:
+            job = connection.execute(select(table).where(table.c.id == job_id)).one()
+            connection.execute(update(table).where(table.c.id == job_id).values(status='running'))
+        path = os.path.join(directory, export_filename(job))
+        tmp_path = f"{path}.tmp"
+        try:
+            snapshot = engine.connect()
+            if engine.dialect.name == 'postgresql':
+                snapshot = snapshot.execution_options(isolation_level='REPEATABLE READ', postgresql_readonly=True)
+            with snapshot, snapshot.begin(), _open_compressed(tmp_path, job.compression) as out:
+                if engine.dialect.name == 'sqlite':
+                    # pysqlite only opens a transaction before writes. Without one, the version
+                    # and the rows would be read from two different states of the database
+                    snapshot.exec_driver_sql('BEGIN')
+                rows, version = write_snapshot(snapshot, out, job.format, batch_size)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            with engine.begin() as connection:
+                connection.execute(update(table).where(table.c.id == job_id).values(
+                    status='failed', error=str(e), finished_at=datetime.now(timezone.utc)))
+            raise
+        with engine.begin() as connection:
+            connection.execute(update(table).where(table.c.id == job_id).values(
+                status='done', rows=rows, size=os.path.getsize(path), catalog_version=version,
+                finished_at=datetime.now(timezone.utc)))
+    finally:
+        engine.dispose()
+
+
+class ExportRunner:
+    """Per-worker process pool that runs exports."""
+
+    def __init__(self, app):
+        self.app = app
+        self.directory = app.config.get('EXPORTS_DIR') or os.path.join(app.instance_path, 'exports')
+        self.max_workers = app.config['EXPORT_WORKERS']
+        self.batch_size = app.config['EXPORT_BATCH_SIZE']
+        self._executor = None
+        self._pid = None
+
+    def submit(self, job_id):
+        if self._pid != os.getpid():
+            # Created lazily so each gunicorn worker gets its own, never the preloading master.
+            # spawn, not fork: forking a threaded worker can copy held locks
+            self._pid = os.getpid()
+            self._executor = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+        os.makedirs(self.directory, exist_ok=True)
+        database_uri = db.engine.url.render_as_string(hide_password=False)
+        future = self._executor.submit(run_export, database_uri, job_id, self.directory, self.batch_size)
+        future.add_done_callback(lambda f: self._finished(job_id, f))
+
+    def _finished(self, job_id, future):
+        error = future.exception()
+        if error is None:
+            return
+        logger.error("Export %s failed", job_id, exc_info=error)
+        if isinstance(error, BrokenProcessPool):
+            self._pid = None  # replace the pool on the next submit
+        # The export process may have died before it could record the failure itself
+        with self.app.app_context():
+            db.session.execute(update(ExportJob).where(
+                ExportJob.id == job_id, ExportJob.status.in_(('pending', 'running'))
+            ).values(status='failed', error=str(error) or type(error).__name__,
+                     finished_at=datetime.now(timezone.utc)))
+            db.session.commit()
+            db.session.remove()
+
+
+def init_exports(app):
+    app.extensions['exports'] = ExportRunner(app)
+
+
+def job_json(job):
+    return {
+        "id": job.id,
+        "status": job.status,
+        "format": job.format,
+        "compression": job.compression,
+        "rows": job.rows,
+        "size": job.size,
+        "catalog_version": job.catalog_version,
+        "error": job.error,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+        "download": url_for('exports.download_export', job_id=job.id) if job.status == 'done' else None,
+    }
+
+
+@exports_bp.route('', methods=['POST'])
+@require_api_key
+def create_export():
+    """Start exporting the whole catalog to a compressed file.
+    ---
+    tags:
+      - Exports
+    parameters:
+      - name: body
+        in: body
+        required: false
+        schema:
+          type: object
+          properties:
+            format:
+              type: string
+              enum: [csv, ndjson]
+              default: ndjson
+            compression:
+              type: string
+              enum: [gzip, zstd]
+              default: gzip
+    responses:
+      202:
+        description: Export queued; poll the Location header for its status
+      400:
+        description: Body is not an object, or unknown format or compression
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+    """
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}  # no body: all defaults
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be an object."}), 400
+    file_format = data.get('format', 'ndjson')
+    compression = data.get('compression', 'gzip')
+    if file_format not in FORMATS:
+        return jsonify({"error": f"Invalid format. Use one of: {', '.join(FORMATS)}."}), 400
+    if compression not in COMPRESSIONS:
+        return jsonify({"error": f"Invalid compression. Use one of: {', '.join(COMPRESSIONS)}."}), 400
+    if compression == 'zstd' and zstandard is None:
+        return jsonify({"error": "zstd compression is not available on this server."}), 400
+
+    job = ExportJob(id=uuid.uuid4().hex, format=file_format, compression=compression)
+    db.session.add(job)
+    db.session.commit()
+    current_app.extensions['exports'].submit(job.id)
+    return jsonify(job_json(job)), 202, {"Location": url_for('exports.get_export', job_id=job.id)}
+
+
+@exports_bp.route('/<job_id>', methods=['GET'])
+@require_api_key
+def get_export(job_id):
+    """Status of an export job.
+    ---
+    tags:
+      - Exports
+    parameters:
+      - name: job_id
+        in: path
+        type: string
+        required: true
+    responses:
+      200:
+        description: Job status; `download` is set once the file is ready
+        schema:
+          type: object
+          properties:
+            id:
+              type: string
+            status:
+              type: string
+              enum: [pending, running, done, failed]
+            format:
+              type: string
+            compression:
+              type: string
+            rows:
+              type: integer
+            size:
+              type: integer
+            catalog_version:
+              type: integer
+            error:
+              type: string
+            download:
+              type: string
+      404:
+        description: Unknown job
+    """
+    job = db.session.get(ExportJob, job_id)
+    if job is None:
+        return jsonify({"error": "Export not found"}), 404
+    return jsonify(job_json(job)), 200
+
+
+@exports_bp.route('/<job_id>/download', methods=['GET'])
+@require_api_key
+def download_export(job_id):
+    """Download a finished export.
+    ---
+    tags:
+      - Exports
+    produces:
+      - application/gzip
+      - application/zstd
+    parameters:
+      - name: job_id
+        in: path
+        type: string
+        required: true
+    responses:
+      200:
+        description: The compressed export file
+      404:
+        description: Unknown job, or the export has not finished
+    """
+    job = db.session.get(ExportJob, job_id)
+    if job is None or job.status != 'done':
+        return jsonify({"error": "Export not found or not finished"}), 404
+    filename = export_filename(job)
+    path = os.path.join(current_app.extensions['exports'].directory, filename)
+    if not os.path.exists(path):
+        return jsonify({"error": "Export file is no longer available"}), 404
+    # Served through wsgi.file_wrapper, i.e. sendfile(2) under gunicorn
+    return send_file(path, mimetype=COMPRESSIONS[job.compression][1], as_attachment=True,
+                     download_name=f"books-{filename}", conditional=True)
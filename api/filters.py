@@ -0,0 +1,103 @@
+from datetime import date, datetime, timezone
+from sqlalchemy import select, tuple_
+from .models import Book
+from .pagination import encode_cursor, decode_cursor, is_cursor_int
+from .serializers import BOOK_COLUMNS
+
+# ?sort= values and the columns they order by; each is backed by a
+# (column, id) index on Book so sorted keyset pages are index scans.
+SORT_COLUMNS = {
+    "title": Book.title,
+    "author": Book.author,
+    "publish_date": Book.publish_date,
+}
+
+
+def _parse_date(name, value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError(f"Invalid date format for {name}. Use YYYY-MM-DD.")
+
+
+def _parse_datetime(name, value):
+    if value.endswith(('Z', 'z')):
+        value = value[:-1] + '+00:00'  # fromisoformat only accepts Z from Python 3.11 (the image runs 3.9)
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid datetime format for {name}. Use ISO 8601.")
+    if moment.tzinfo is not None:
+        # Timestamps are stored as naive UTC
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def book_filters(args):
+    """Translate collection query parameters into WHERE clauses. Raises ValueError on bad input."""
+    clauses = []
+    if args.get('author'):
+        clauses.append(Book.author == args['author'])
+    if args.get('published_after'):
+        clauses.append(Book.publish_date >= _parse_date('published_after', args['published_after']))
+    if args.get('published_before'):
+        clauses.append(Book.publish_date <= _parse_date('published_before', args['published_before']))
+    if args.get('updated_since'):
+        clauses.append(Book.updated_at >= _parse_datetime('updated_since', args['updated_since']))
+    return clauses
+
+
+def book_sort(args):
+    """Return (sort name, column, descending) for ?sort=, e.g. "title" or "-publish_date".
+
+    Column is None when sorting by id (the default).
+    """
+    value = args.get('sort', 'id')
+    descending = value.startswith('-')
+    name = value[1:] if descending else value
+    if name == 'id':
+        return name, None, descending
+    if name not in SORT_COLUMNS:
+        raise ValueError(f"Invalid sort. Use one of: id, {', '.join(SORT_COLUMNS)} (prefix with - for descending).")
+    return name, SORT_COLUMNS[name], descending
+
+
+def books_select(filters, sort):
+    """SELECT of BOOK_COLUMNS with `filters` applied, ordered by (sort column, id)."""
+    name, column, descending = sort
+    keys = [Book.id] if column is None else [column, Book.id]
+    return select(*BOOK_COLUMNS).where(*filters).order_by(
+        *[key.desc() if descending else key for key in keys])
+
+
+def decode_position(cursor, sort):
+    """Decode a listing cursor for `sort`. Raises ValueError if it is malformed or for another sort."""
+    name, column, descending = sort
+    position = decode_cursor(cursor)
+    if not is_cursor_int(position.get('id')) or position.get('sort', 'id') != name:
+        raise ValueError("Invalid cursor.")
+    if column is not None:
+        if not isinstance(position.get('key'), str):
+            raise ValueError("Invalid cursor.")
+        if name == 'publish_date':
+            position['key'] = _parse_date('cursor', position['key'])
+    return position
+
+
+def seek(query, sort, position):
+    """Restrict an ordered books_select() to rows after `position` (keyset pagination)."""
+    name, column, descending = sort
+    if column is None:
+        return query.where(Book.id < position['id'] if descending else Book.id > position['id'])
+    row, last = tuple_(column, Book.id), (position['key'], position['id'])
+    return query.where(row < last if descending else row > last)
+
+
+def encode_position(row, sort):
+    """Cursor pointing just after `row` (a BOOK_COLUMNS row) in `sort` order."""
+    name, column, descending = sort
+    position = {"sort": name, "id": row.id}
+    if column is not None:
+        key = getattr(row, name)
+        position["key"] = key.isoformat() if isinstance(key, date) else key
+    return encode_cursor(position)
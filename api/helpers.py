@@ -1,4 +1,33 @@
-from datetime import datetime
+import re
+from datetime import date, datetime
+
+from .models import Book
+
+_ISO_DATE = re.compile(r'([0-9]{4})-([0-9]{2})-([0-9]{2})')
+
+def parse_publish_date(value):
+    """Parse a YYYY-MM-DD date. Raises ValueError, like datetime.strptime(value, '%Y-%m-%d')."""
+    match = _ISO_DATE.fullmatch(value)
+    if match:
+        # Fast path for the zero-padded form; same result as strptime, several times quicker
+        return date(int(match[1]), int(match[2]), int(match[3]))
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+# title and author are String(100)
+MAX_TEXT_LENGTH = Book.title.type.length
+
+def validate_book_fields(data):
+    """Check the types and lengths of the book fields present in `data`.
+
+    validate_book_data only checks that the fields are there; this catches a
+    null title, or one longer than its column, before the database does.
+    """
+    for field in ("title", "author"):
+        if field in data and (not isinstance(data[field], str) or not 0 < len(data[field]) <= MAX_TEXT_LENGTH):
+            return f"{field} must be a string of 1 to {MAX_TEXT_LENGTH} characters."
+    if 'publish_date' in data and not isinstance(data['publish_date'], str):
+        return "Invalid date format for publish_date. Use YYYY-MM-DD."
+    return None
 
 def validate_book_data(data):
     required_fields = ["title", "author", "isbn", "publish_date"]
@@ -6,7 +35,7 @@ def validate_book_data(data):
         if field not in data:
             return f"Missing field: {field}"
     try:
-        datetime.strptime(data['publish_date'], '%Y-%m-%d')
+        parse_publish_date(data['publish_date'])
     except ValueError:
         return "Invalid date format for publish_date. Use YYYY-MM-DD."
     return None
@@ -0,0 +1,258 @@
+"""`flask books import`: bulk-load a CSV or NDJSON file of books.
+
+    flask --app main books import books.csv
+    flask --app main books import books.ndjson --batch-size 50000 --rejects rejects.ndjson
+
+The file is read as a stream, so memory stays flat whatever its size. Every
+record gets the same checks as POST /api/books/bulk (validate_isbn,
+validate_book_fields and validate_book_data). Valid rows are loaded one batch per transaction:
+
+- Postgres: COPY into a temporary staging table, then one
+  INSERT ... SELECT ... ON CONFLICT (isbn) DO NOTHING.
+- SQLite: executemany of INSERT ... ON CONFLICT (isbn) DO NOTHING, with
+  synchronous=OFF for the duration of the import. The per-row full-text
+  and stats triggers are dropped inside each batch's transaction and
+  replaced by one INSERT ... SELECT each, which is several times faster.
+
+Each batch logs its inserted books to book_change in the same transaction,
+so the import shows up in GET /api/books/changes. The catalog version is
+bumped only after the books are in, just before that log insert. API
+writes also lock book rows first and catalog_state last, so the two never
+deadlock, and catalog_state stays free while a batch loads.
+
+Books whose ISBN already exists are skipped, not updated. After each commit
+the number of records consumed is written to a checkpoint file next to the
+input. An interrupted import picks up from there when run again; use
+--restart to start over. Re-loading a batch is harmless because existing
+ISBNs are skipped.
+"""
+import csv
+import io
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from . import db
+from .helpers import parse_publish_date, validate_book_data, validate_book_fields
+from .models import Book, SQLITE_FTS_INSERT_TRIGGER, SQLITE_STATS_INSERT_TRIGGER
+from .routes import validate_isbn
+from .versioning import bump_catalog_version
+
+books_cli = AppGroup('books', help="Manage the book catalog.")
+
+def read_records(path, file_format):
+    """Yield book dicts from a CSV (with a header row) or NDJSON file."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if file_format == 'csv':
+            yield from csv.DictReader(f)
+            return
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield "Invalid JSON."
+
+
+def validate_record(record):
+    """Return (row, None) for a valid record, or (None, error)."""
+    if not isinstance(record, dict):
+        return None, record if isinstance(record, str) else "Book must be an object."
+    # Short CSV lines fill the missing columns with None
+    record = {key: value for key, value in record.items() if value is not None}
+    isbn = record.get('isbn', '')
+    error = validate_isbn(isbn) if isinstance(isbn, str) else "Invalid ISBN format. ISBN must be 13 digits."
+    error = error or validate_book_fields(record) or validate_book_data(record)
+    if error:
+        return None, error
+    return {
+        "title": record['title'],
+        "author": record['author'],
+        "isbn": isbn,
+        "publish_date": parse_publish_date(record['publish_date']),
+    }, None
+
+
+class Checkpoint:
+    """Records consumed from an input file, tied to its size and mtime."""
+
+    def __init__(self, path, source):
+        self.path = path
+        stat = os.stat(source)
+        self.fingerprint = {"source": os.path.abspath(source), "size": stat.st_size, "mtime": stat.st_mtime}
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if state.get("fingerprint") != self.fingerprint:
+            raise click.ClickException(
+                f"{self.path} belongs to a different or modified input file. Use --restart to start over.")
+        return state["records"]
+
+    def save(self, records):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"fingerprint": self.fingerprint, "records": records}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# Per-row insert triggers, and the set-based statements over a batch's new
+# rows (id > ?) that stand in for them during an import
+SQLITE_BATCH_TRIGGERS = [
+    ('book_fts_ai', SQLITE_FTS_INSERT_TRIGGER, [
+        "INSERT INTO book_fts(rowid, title, author) SELECT id, title, author FROM book WHERE id > ?",
+    ]),
+    ('book_stats_ai', SQLITE_STATS_INSERT_TRIGGER, [
+        "INSERT INTO author_stats(author, books) SELECT author, count(*) FROM book WHERE id > ? GROUP BY author "
+        "ON CONFLICT(author) DO UPDATE SET books = books + excluded.books",
+        "INSERT INTO year_stats(year, books) SELECT CAST(substr(publish_date, 1, 4) AS INTEGER), count(*) "
+        "FROM book WHERE id > ? GROUP BY 1 ON CONFLICT(year) DO UPDATE SET books = books + excluded.books",
+    ]),
+]
+
+
+def load_batch_sqlite(connection, rows):
+    # DDL is transactional in SQLite and writers are serialized, so no other
+    # writer ever sees the table without its triggers
+    swapped = []
+    for name, trigger, statements in SQLITE_BATCH_TRIGGERS:
+        if connection.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,)).first():
+            connection.exec_driver_sql(f"DROP TRIGGER {name}")
+            swapped.append((trigger, statements))
+    last_id = connection.scalar(db.select(db.func.coalesce(db.func.max(Book.id), 0)))
+    statement = sqlite_insert(Book).on_conflict_do_nothing(index_elements=['isbn'])
+    inserted = connection.execute(statement, rows).rowcount
+    # New rows get ids above the previous maximum
+    for trigger, statements in swapped:
+        for batch_statement in statements:
+            connection.exec_driver_sql(batch_statement, (last_id,))
+        connection.exec_driver_sql(trigger)
+    connection.exec_driver_sql(
+        "INSERT INTO book_change (catalog_version, book_id, op, changed_at) "
+        "SELECT ?, id, 'insert', ? FROM book WHERE id > ?",
+        (bump_catalog_version(connection), datetime.now(timezone.utc).replace(tzinfo=None).isoformat(' '), last_id))
+    return inserted
+
+
+def load_batch_postgres(connection, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows((seq, row['title'], row['author'], row['isbn'], row['publish_date'].isoformat())
+                                 for seq, row in enumerate(rows))
+    buffer.seek(0)
+    connection.exec_driver_sql(
+        "CREATE TEMP TABLE IF NOT EXISTS book_import "
+        "(seq integer, title text, author text, isbn text, publish_date date) ON COMMIT DELETE ROWS")
+    cursor = connection.connection.driver_connection.cursor()
+    cursor.copy_expert("COPY book_import (seq, title, author, isbn, publish_date) FROM STDIN WITH (FORMAT csv)",
+                       buffer)
+    cursor.close()
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    # DISTINCT ON keeps the first of any ISBN repeated within the batch (the
+    # lowest seq, i.e. input order, as on SQLite)
+    ids = connection.exec_driver_sql(
+        "INSERT INTO book (title, author, isbn, publish_date, created_at, updated_at, version) "
+        "SELECT DISTINCT ON (isbn) title, author, isbn, publish_date, %(now)s, %(now)s, 1 FROM book_import "
+        "ORDER BY isbn, seq ON CONFLICT (isbn) DO NOTHING RETURNING id",
+        {"now": now}).scalars().all()
+    # Bumped last, so catalog_state is locked after the book rows, as in API writes
+    connection.exec_driver_sql(
+        "INSERT INTO book_change (catalog_version, book_id, op, changed_at) "
+        "SELECT %(version)s, id, 'insert', %(now)s FROM unnest(%(ids)s::integer[]) AS id",
+        {"version": bump_catalog_version(connection), "now": now, "ids": ids})
+    return len(ids)
+
+
+def import_books(path, file_format, batch_size, checkpoint, rejects=None, progress=None):
+    """Load `path` into the catalog. Returns counts of read, inserted, skipped and invalid records."""
+    engine = db.engine
+    load_batch = load_batch_postgres if engine.dialect.name == 'postgresql' else load_batch_sqlite
+    done = checkpoint.load()
+    counts = {"read": done, "inserted": 0, "skipped": 0, "invalid": 0}
+
+    def flush(connection, rows):
+        inserted = load_batch(connection, rows) if rows else 0
+        connection.commit()
+        counts["inserted"] += inserted
+        counts["skipped"] += len(rows) - inserted
+        checkpoint.save(counts["read"])
+        if progress:
+            progress(counts)
+
+    with engine.connect() as connection:
+        if engine.dialect.name == 'sqlite':
+            # Durability of each batch isn't needed: a crash just replays from the checkpoint
+            connection.exec_driver_sql("PRAGMA synchronous=OFF")
+            connection.commit()
+        try:
+            rows = []
+            for number, record in enumerate(read_records(path, file_format), start=1):
+                if number <= done:
+                    continue
+                counts["read"] = number
+                row, error = validate_record(record)
+                if error:
+                    counts["invalid"] += 1
+                    if rejects:
+                        rejects.write(json.dumps({"record": number, "error": error}) + '\n')
+                    continue
+                rows.append(row)
+                if len(rows) >= batch_size:
+                    flush(connection, rows)
+                    rows = []
+            flush(connection, rows)
+        finally:
+            if engine.dialect.name == 'sqlite':
+                connection.rollback()
+                connection.exec_driver_sql("PRAGMA synchronous=NORMAL")
+                connection.commit()
+    return counts
+
+
+@books_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']),
+              help="Defaults to the file extension (.csv, otherwise NDJSON).")
+@click.option('--batch-size', type=int, default=None, help="Rows per transaction.")
+@click.option('--checkpoint', 'checkpoint_path', type=click.Path(dir_okay=False),
+              help="Defaults to PATH.checkpoint.")
+@click.option('--restart', is_flag=True, help="Ignore any checkpoint and start from the first record.")
+@click.option('--rejects', type=click.File('a'), help="Append invalid records (number and error) here as NDJSON.")
+def import_command(path, file_format, batch_size, checkpoint_path, restart, rejects):
+    """Import books from a CSV or NDJSON file."""
+    file_format = file_format or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+    batch_size = batch_size or current_app.config['BOOKS_IMPORT_BATCH_SIZE']
+    checkpoint = Checkpoint(checkpoint_path or f"{path}.checkpoint", path)
+    if restart:
+        checkpoint.clear()
+
+    started = time.perf_counter()
+    resumed_at = checkpoint.load()
+    if resumed_at:
+        click.echo(f"Resuming after record {resumed_at}", err=True)
+
+    def progress(counts):
+        rate = (counts["read"] - resumed_at) / max(time.perf_counter() - started, 1e-9)
+        click.echo(f"\r{counts['read']} read, {counts['inserted']} inserted, {counts['skipped']} skipped, "
+                   f"{counts['invalid']} invalid ({rate:,.0f} rows/s)", nl=False, err=True)
+
+    counts = import_books(path, file_format, batch_size, checkpoint, rejects, progress)
+    checkpoint.clear()
+    click.echo(err=True)
+    click.echo(f"Imported {counts['inserted']} books in {time.perf_counter() - started:.1f}s "
+               f"({counts['skipped']} existing ISBNs skipped, {counts['invalid']} invalid).")
@@ -0,0 +1,142 @@
+from flask import Blueprint, jsonify, current_app
+from . import db
+from .auth import require_api_key
+from .pool import pool_stats
+
+instrumentation_bp = Blueprint('instrumentation', __name__)
+
+
+@instrumentation_bp.route('/cache', methods=['GET'])
+@require_api_key
+def cache_stats():
+    """Counters for this worker's single-book cache.
+    ---
+    tags:
+      - Instrumentation
+    responses:
+      200:
+        description: Hit, miss, eviction and expiration counters
+        schema:
+          type: object
+          properties:
+            entries:
+              type: integer
+            max_entries:
+              type: integer
+            ttl:
+              type: number
+            hits:
+              type: integer
+            misses:
+              type: integer
+            evictions:
+              type: integer
+            expirations:
+              type: integer
+    """
+    return jsonify(current_app.extensions['book_cache'].stats()), 200
+
+
+@instrumentation_bp.route('/responses', methods=['GET'])
+@require_api_key
+def response_cache_stats():
+    """Counters for the cache of finished /books and /books/stats responses.
+
+    With the sqlite backend these cover every worker on the host.
+    ---
+    tags:
+      - Instrumentation
+    responses:
+      200:
+        description: Size, hit, miss and eviction counters
+        schema:
+          type: object
+          properties:
+            entries:
+              type: integer
+            bytes:
+              type: integer
+            max_bytes:
+              type: integer
+            hits:
+              type: integer
+            misses:
+              type: integer
+            evictions:
+              type: integer
+            hit_rate:
+              type: number
+    """
+    cache = current_app.extensions['collection_cache']
+    if cache is None:
+        return jsonify({"error": "The response cache is disabled."}), 404
+    stats = cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return jsonify(stats), 200
+
+
+@instrumentation_bp.route('/pool', methods=['GET'])
+@require_api_key
+def connection_pool_stats():
+    """Connection pool usage for this worker.
+    ---
+    tags:
+      - Instrumentation
+    responses:
+      200:
+        description: Pool size, in-use and overflow counts, and checkout wait times
+        schema:
+          type: object
+          properties:
+            size:
+              type: integer
+            checked_out:
+              type: integer
+            checked_in:
+              type: integer
+            overflow:
+              type: integer
+            max_overflow:
+              type: integer
+            checkouts:
+              type: integer
+            checkout_timeouts:
+              type: integer
+            checkout_wait_seconds_total:
+              type: number
+            checkout_wait_seconds_max:
+              type: number
+    """
+    return jsonify(pool_stats(db.engine)), 200
+
+
+@instrumentation_bp.route('/replicas', methods=['GET'])
+@require_api_key
+def replica_stats():
+    """Read replicas configured for this worker and whether they are in rotation.
+    ---
+    tags:
+      - Instrumentation
+    responses:
+      200:
+        description: Replica URLs (without passwords), health, and how often reads fell back to the primary
+        schema:
+          type: object
+          properties:
+            replicas:
+              type: array
+              items:
+                type: object
+                properties:
+                  url:
+                    type: string
+                  healthy:
+                    type: boolean
+            fallbacks:
+              type: integer
+    """
+    replicas = current_app.extensions['replicas']
+    if replicas is None:
+        return jsonify({"replicas": [], "fallbacks": 0}), 200
+    return jsonify(replicas.stats()), 200
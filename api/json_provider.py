@@ -0,0 +1,37 @@
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional speed-up, falls back to the stdlib encoder
+    orjson = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that encodes compact output with orjson.
+
+    Only used when the result is byte-for-byte what the default provider
+    would produce: compact separators, sorted keys and ASCII-only output.
+    Anything else (indented debug output, non-ASCII text that must be
+    \\u-escaped, custom kwargs) goes through the stdlib encoder.
+    """
+
+    _options = 0 if orjson is None else (
+        orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+    )
+
+    def dumps(self, obj, **kwargs):
+        if (self.sort_keys and self.ensure_ascii
+                and set(kwargs) == {'separators'} and kwargs['separators'] == (',', ':')):
+            try:
+                encoded = orjson.dumps(obj, default=self.default, option=self._options)
+            except TypeError:
+                pass
+            else:
+                if encoded.isascii():
+                    return encoded.decode()
+        return super().dumps(obj, **kwargs)
+
+
+def init_json_provider(app):
+    if orjson is not None and app.config['JSON_USE_ORJSON']:
+        app.json = OrjsonProvider(app)
@@ -0,0 +1,344 @@
+"""Per-request instrumentation exported in Prometheus text format at /metrics.
+
+Every worker keeps its own in-memory registry. With METRICS_DIR set (as
+gunicorn.conf.py does) a background thread in each worker also writes a
+snapshot of it to METRICS_DIR/<pid>-<id>.json every METRICS_FLUSH_INTERVAL
+seconds while there is new data. /metrics
+sums the snapshots of every worker on the host, so the numbers are right
+whichever worker answers the scrape. Counters and histograms of workers that
+have exited are kept so totals never go backwards; their gauges are dropped.
+When gunicorn reaps a worker, retire() folds its snapshot into one
+retired.json and deletes it, so recycled workers (max_requests) don't pile
+up files for every scrape to read.
+"""
+import contextvars
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+
+from flask import Blueprint, Response, current_app, request
+from sqlalchemy import event
+
+from . import db
+from .pool import pool_stats
+
+metrics_bp = Blueprint('metrics', __name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+REQUEST_LABELS = ("endpoint", "method", "status")
+HISTOGRAMS = {  # name -> (help, buckets, label names)
+    "http_request_duration_seconds": (
+        "Request latency by endpoint, method and status.", LATENCY_BUCKETS, REQUEST_LABELS),
+    "http_response_size_bytes": (
+        "Response body size by endpoint, method and status.", SIZE_BUCKETS, REQUEST_LABELS),
+    "http_request_db_statements": (
+        "SQL statements executed per request.", STATEMENT_BUCKETS, ("endpoint",)),
+    "http_request_db_duration_seconds": (
+        "Time spent in SQL statements per request.", LATENCY_BUCKETS, ("endpoint",)),
+}
+GAUGES = {
+    "db_pool_size": "Connections kept in the pool.",
+    "db_pool_checked_out": "Connections currently in use.",
+    "db_pool_overflow": "Connections open beyond the pool size.",
+}
+COUNTERS = {
+    "db_pool_checkouts_total": "Connection checkouts.",
+    "db_pool_checkout_timeouts_total": "Checkouts that timed out waiting for a connection.",
+    "db_pool_checkout_wait_seconds_total": "Time spent waiting for a connection.",
+}
+
+# Totals of exited workers, see retire()
+RETIRED_FILE = 'retired.json'
+
+# (statement count, seconds in SQL) for the request running in this context;
+# a ContextVar works for both threaded WSGI workers and asyncio tasks.
+_request_db = contextvars.ContextVar('request_db', default=None)
+
+
+class Registry:
+    """Histograms for one worker process. Thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> {labels: [bucket counts..., sum, count]}
+        self._histograms = {name: {} for name in HISTOGRAMS}
+
+    def observe(self, name, labels, value):
+        buckets = HISTOGRAMS[name][1]
+        with self._lock:
+            series = self._histograms[name].get(labels)
+            if series is None:
+                series = self._histograms[name][labels] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {name: [[list(labels), list(series)] for labels, series in histograms.items()]
+                    for name, histograms in self._histograms.items()}
+
+
+def _pool_snapshot():
+    stats = pool_stats(db.engine)
+    if 'checkouts' not in stats:
+        return {}, {}
+    gauges = {"db_pool_size": stats['size'], "db_pool_checked_out": stats['checked_out'],
+              "db_pool_overflow": stats['overflow']}
+    counters = {"db_pool_checkouts_total": stats['checkouts'],
+                "db_pool_checkout_timeouts_total": stats['checkout_timeouts'],
+                "db_pool_checkout_wait_seconds_total": stats['checkout_wait_seconds_total']}
+    return gauges, counters
+
+
+class Metrics:
+    def __init__(self, app):
+        self.app = app
+        self.registry = Registry()
+        self.directory = app.config.get('METRICS_DIR')
+        self.flush_interval = app.config['METRICS_FLUSH_INTERVAL']
+        self._dirty = False
+        self._flush_lock = threading.Lock()
+        self._flusher_pid = None
+        self._pid = None
+        self._path = None
+
+    def record(self, endpoint, method, status, seconds, size, db_stats):
+        if self.directory and self._flusher_pid != os.getpid():
+            self._start_flusher()
+        self._dirty = True
+        labels = (endpoint, method, str(status))
+        self.registry.observe("http_request_duration_seconds", labels, seconds)
+        if size is not None:
+            self.registry.observe("http_response_size_bytes", labels, size)
+        if db_stats is not None:
+            self.registry.observe("http_request_db_statements", (endpoint,), db_stats[0])
+            self.registry.observe("http_request_db_duration_seconds", (endpoint,), db_stats[1])
+
+    def snapshot(self):
+        gauges, counters = _pool_snapshot()
+        return {"pid": os.getpid(), "histograms": self.registry.snapshot(),
+                "gauges": gauges, "counters": counters}
+
+    def _start_flusher(self):
+        # Started lazily so it runs in the worker, not in a preloading master
+        self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self._dirty:
+                self._dirty = False
+                with self.app.app_context():
+                    self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            if self._pid != os.getpid():
+                # New file per process, so a reused pid never overwrites older totals
+                self._pid = os.getpid()
+                self._path = os.path.join(self.directory, f"{self._pid}-{uuid.uuid4().hex}.json")
+                os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{self._path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, self._path)
+
+    def collect(self):
+        """Snapshots of every worker on the host (just this one without METRICS_DIR)."""
+        if not self.directory:
+            return [self.snapshot()]
+        self.flush()
+        workers = {os.path.basename(path): _load_snapshot(path)
+                   for path in glob.glob(os.path.join(self.directory, '*.json'))}
+        # Read last: a worker retired meanwhile is either in the files above or listed as absorbed here
+        retired = _load_snapshot(os.path.join(self.directory, RETIRED_FILE)) or {}
+        absorbed = set(retired.get("absorbed", ())) | {RETIRED_FILE}
+        return [retired] + [snapshot for name, snapshot in workers.items()
+                            if snapshot is not None and name not in absorbed]
+
+
+def _load_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None  # removed or replaced while we were reading it
+
+
+def retire(directory, pid):
+    """Fold the snapshots of exited worker `pid` into retired.json and delete them.
+
+    Run by the gunicorn master (child_exit), one worker at a time. The
+    directory then holds one file per live worker plus retired.json. The
+    retired totals are written before the worker's file is removed, and
+    list it as absorbed meanwhile, so a scrape never counts it twice.
+    """
+    retired_path = os.path.join(directory, RETIRED_FILE)
+    paths = glob.glob(os.path.join(directory, f"{pid}-*.json"))
+    if not paths:
+        return
+    retired = _load_snapshot(retired_path) or {}
+    histograms, counters = _sum_snapshots([retired] + [_load_snapshot(path) or {} for path in paths])
+    absorbed = [name for name in retired.get("absorbed", ()) if os.path.exists(os.path.join(directory, name))]
+    tmp_path = f"{retired_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"histograms": {name: [[list(labels), values] for labels, values in series.items()]
+                                  for name, series in histograms.items()},
+                   "counters": counters,
+                   "absorbed": absorbed + [os.path.basename(path) for path in paths]}, f)
+    os.replace(tmp_path, retired_path)
+    for path in paths + glob.glob(os.path.join(directory, f"{pid}-*.json.tmp")):
+        os.remove(path)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _label_text(names, values):
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+def _sum_snapshots(snapshots):
+    """Histograms ({name: {labels: values}}) and counters summed over `snapshots`."""
+    histograms = {name: {} for name in HISTOGRAMS}
+    counters = dict.fromkeys(COUNTERS, 0)
+    for snapshot in snapshots:
+        for name, series in snapshot.get("histograms", {}).items():
+            if name not in histograms:
+                continue
+            for labels, values in series:
+                total = histograms[name].setdefault(tuple(labels), [0] * len(values))
+                for i, value in enumerate(values):
+                    total[i] += value
+        for name, value in snapshot.get("counters", {}).items():
+            if name in counters:
+                counters[name] += value
+    return histograms, counters
+
+
+def render(snapshots):
+    """Sum worker snapshots and render them in the Prometheus text format."""
+    histograms, counters = _sum_snapshots(snapshots)
+    gauges = dict.fromkeys(GAUGES, 0)
+    for snapshot in snapshots:
+        if snapshot.get("pid") and _pid_alive(snapshot["pid"]):
+            for name, value in snapshot.get("gauges", {}).items():
+                if name in gauges:
+                    gauges[name] += value
+
+    lines = []
+    for name, (help_text, buckets, label_names) in HISTOGRAMS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for labels, values in sorted(histograms[name].items()):
+            base = _label_text(label_names, labels)
+            cumulative = 0
+            for bound, count in zip(buckets, values):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{base},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{base},le="+Inf"}} {values[-1]}')
+            lines.append(f'{name}_sum{{{base}}} {values[-2]}')
+            lines.append(f'{name}_count{{{base}}} {values[-1]}')
+    for name, help_text in GAUGES.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {gauges[name]}"]
+    for name, help_text in COUNTERS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter", f"{name} {counters[name]}"]
+    return '\n'.join(lines) + '\n'
+
+
+def start_request():
+    _request_db.set([0, 0.0])
+
+
+def finish_request():
+    db_stats = _request_db.get()
+    _request_db.set(None)
+    return db_stats
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_start', {})[id(cursor)] = time.perf_counter()
+
+
+def _finish_statement(conn, cursor):
+    started = conn.info.get('metrics_query_start', {}).pop(id(cursor), None)
+    db_stats = _request_db.get()
+    if started is not None and db_stats is not None:
+        db_stats[0] += 1
+        db_stats[1] += time.perf_counter() - started
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _finish_statement(conn, cursor)
+
+
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute; drop its start time here
+    # so the map does not grow for the life of the pooled connection
+    execution = context.execution_context
+    if context.connection is not None and execution is not None:
+        _finish_statement(context.connection, execution.cursor)
+
+
+def instrument_engine(engine):
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+
+
+def init_metrics(app, engines):
+    metrics = app.extensions['metrics'] = Metrics(app)
+    for engine in engines:
+        instrument_engine(engine)
+
+    @app.before_request
+    def start_timer():
+        request.environ['metrics.start'] = time.perf_counter()
+        start_request()
+
+    @app.after_request
+    def record_request(response):
+        started = request.environ.get('metrics.start')
+        if started is not None:
+            # Streamed bodies have no length yet; their time-to-first-byte is what's recorded
+            metrics.record(request.endpoint or 'unmatched', request.method, response.status_code,
+                           time.perf_counter() - started, response.calculate_content_length(),
+                           finish_request())
+        return response
+
+    app.register_blueprint(metrics_bp)
+
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics for every worker on this host.
+    ---
+    tags:
+      - Instrumentation
+    security: []
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: Metrics in the Prometheus text exposition format
+    """
+    body = render(current_app.extensions['metrics'].collect())
+    return Response(body, content_type='text/plain; version=0.0.4; charset=utf-8')
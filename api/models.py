@@ -1,11 +1,232 @@
+import uuid
 from . import db
 from datetime import datetime, timezone
+from sqlalchemy import DDL, event, inspect
 
 class Book(db.Model):
+    # (column, id) indexes back the filters and ?sort= options on /books,
+    # including keyset pagination in either direction. Also created on
+    # databases whose book table predates them, see _create_book_indexes.
+    __table_args__ = (
+        db.Index('ix_book_author_id', 'author', 'id'),
+        db.Index('ix_book_title_id', 'title', 'id'),
+        db.Index('ix_book_publish_date_id', 'publish_date', 'id'),
+        db.Index('ix_book_updated_at_id', 'updated_at', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     author = db.Column(db.String(100), nullable=False)
     isbn = db.Column(db.String(13), unique=True, nullable=False)
     publish_date = db.Column(db.Date, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
-    updated_at = db.Column(db.DateTime, default=datetime.now(timezone.utc), onupdate=datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    # Bumped by the ORM on every UPDATE; used for item ETags
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    __mapper_args__ = {"version_id_col": version}
+
+
+class CatalogState(db.Model):
+    """Single-row table holding a counter bumped by every write through the API.
+
+    Lets the collection ETag be computed with one primary-key lookup.
+    `token` is random per database (drawn when the row is created), so a
+    recreated or reseeded catalog whose version starts again at 0 never
+    matches ETags or cached responses of the previous one.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    token = db.Column(db.String(32), nullable=False, default=lambda: uuid.uuid4().hex)
+
+
+def _add_columns(target, connection, **kw):
+    # create_all never alters a table that exists: add the columns added since
+    # (book versions start at 1, an existing catalog draws its token now)
+    inspector = inspect(connection)
+    if 'version' not in {column['name'] for column in inspector.get_columns('book')}:
+        connection.execute(DDL("ALTER TABLE book ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+    if 'token' not in {column['name'] for column in inspector.get_columns('catalog_state')}:
+        connection.execute(DDL("ALTER TABLE catalog_state ADD COLUMN token VARCHAR(32) NOT NULL DEFAULT ''"))
+        connection.execute(CatalogState.__table__.update().values(token=uuid.uuid4().hex))
+
+
+def _create_book_indexes(target, connection, **kw):
+    # Nor does it add indexes to one
+    for index in Book.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+
+event.listen(db.metadata, 'after_create', _add_columns)
+event.listen(db.metadata, 'after_create', _create_book_indexes)
+
+
+def _insert_catalog_state(target, connection, **kw):
+    connection.execute(target.insert().values(id=1, version=0))  # draws a new token
+
+
+event.listen(CatalogState.__table__, 'after_create', _insert_catalog_state)
+
+
+class BookChange(db.Model):
+    """One insert, update or delete of a book, for GET /books/changes.
+
+    catalog_version is the version the write's transaction bumped to. No
+    foreign key to book: a delete's row is its tombstone.
+    """
+    __table_args__ = (
+        db.Index('ix_book_change_version_id', 'catalog_version', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    catalog_version = db.Column(db.Integer, nullable=False)
+    book_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(6), nullable=False)  # insert, update or delete
+    changed_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+
+class AuthorStats(db.Model):
+    """Books per author, kept current by triggers on book (see api/stats.py)."""
+    __table_args__ = (
+        db.Index('ix_author_stats_books', 'books', 'author'),  # top authors, and pruning emptied rows
+    )
+
+    author = db.Column(db.String(100), primary_key=True)
+    books = db.Column(db.Integer, nullable=False)
+
+
+class YearStats(db.Model):
+    """Books per publication year, kept current by triggers on book (see api/stats.py)."""
+    year = db.Column(db.Integer, primary_key=True)
+    books = db.Column(db.Integer, nullable=False)
+
+
+class ExportJob(db.Model):
+    """A snapshot of the catalog written to a file by a background export (see api/exports.py)."""
+    id = db.Column(db.String(32), primary_key=True)
+    status = db.Column(db.String(16), nullable=False, default='pending')  # pending, running, done, failed
+    format = db.Column(db.String(8), nullable=False)  # csv or ndjson
+    compression = db.Column(db.String(8), nullable=False)  # gzip or zstd
+    rows = db.Column(db.Integer)
+    size = db.Column(db.BigInteger)  # bytes, compressed
+    catalog_version = db.Column(db.Integer)  # catalog_state.version the snapshot reflects
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    finished_at = db.Column(db.DateTime)
+
+
+# Full-text index over title and author (see api/search.py).
+# SQLite: an external-content FTS5 table kept in sync by triggers.
+# Postgres: a generated tsvector column with a GIN index.
+# Both are maintained by the database itself, so every write path stays in sync.
+# The insert trigger is named so `flask books import` can swap it for one set-based insert per batch.
+SQLITE_FTS_INSERT_TRIGGER = """CREATE TRIGGER IF NOT EXISTS book_fts_ai AFTER INSERT ON book BEGIN
+        INSERT INTO book_fts(rowid, title, author) VALUES (new.id, new.title, new.author);
+    END"""
+_sqlite_search_ddl = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS book_fts USING fts5(title, author, content='book', content_rowid='id')",
+    SQLITE_FTS_INSERT_TRIGGER,
+    """CREATE TRIGGER IF NOT EXISTS book_fts_ad AFTER DELETE ON book BEGIN
+        INSERT INTO book_fts(book_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_au AFTER UPDATE OF title, author ON book BEGIN
+        INSERT INTO book_fts(book_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+        INSERT INTO book_fts(rowid, title, author) VALUES (new.id, new.title, new.author);
+    END""",
+    # Index the books already there when book_fts is new (e.g. a database created before search existed)
+    """INSERT INTO book_fts(book_fts) SELECT 'rebuild'
+        WHERE EXISTS (SELECT 1 FROM book) AND NOT EXISTS (SELECT 1 FROM book_fts_docsize)""",
+]
+_postgres_search_ddl = [
+    """ALTER TABLE book ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('simple', coalesce(title, '') || ' ' || coalesce(author, ''))) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_book_search_vector ON book USING GIN (search_vector)",
+]
+
+# On the metadata, not the book table: every create_all runs these (they are
+# idempotent), so databases whose book table predates them get them too
+for statement in _sqlite_search_ddl:
+    event.listen(db.metadata, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+for statement in _postgres_search_ddl:
+    event.listen(db.metadata, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+event.listen(Book.__table__, 'before_drop', DDL("DROP TABLE IF EXISTS book_fts").execute_if(dialect='sqlite'))
+
+
+# Per-author and per-year counts (see api/stats.py), maintained like the
+# full-text index so every write path keeps them in step.
+# SQLite: row-level triggers. As with book_fts_ai, `flask books import` swaps
+# the insert trigger for set-based statements per batch.
+# Postgres: statement-level triggers over transition tables, one
+# aggregated upsert per statement.
+_SQLITE_YEAR = "CAST(substr({row}.publish_date, 1, 4) AS INTEGER)"
+_SQLITE_STATS_ADD = f"""
+        INSERT INTO author_stats(author, books) VALUES (new.author, 1)
+            ON CONFLICT(author) DO UPDATE SET books = books + 1;
+        INSERT INTO year_stats(year, books) VALUES ({_SQLITE_YEAR.format(row='new')}, 1)
+            ON CONFLICT(year) DO UPDATE SET books = books + 1;"""
+_SQLITE_STATS_REMOVE = f"""
+        UPDATE author_stats SET books = books - 1 WHERE author = old.author;
+        DELETE FROM author_stats WHERE author = old.author AND books <= 0;
+        UPDATE year_stats SET books = books - 1 WHERE year = {_SQLITE_YEAR.format(row='old')};
+        DELETE FROM year_stats WHERE year = {_SQLITE_YEAR.format(row='old')} AND books <= 0;"""
+SQLITE_STATS_INSERT_TRIGGER = f"""CREATE TRIGGER IF NOT EXISTS book_stats_ai AFTER INSERT ON book BEGIN{_SQLITE_STATS_ADD}
+    END"""
+_sqlite_stats_ddl = [
+    SQLITE_STATS_INSERT_TRIGGER,
+    f"""CREATE TRIGGER IF NOT EXISTS book_stats_ad AFTER DELETE ON book BEGIN{_SQLITE_STATS_REMOVE}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS book_stats_au AFTER UPDATE OF author, publish_date ON book
+    WHEN old.author IS NOT new.author OR old.publish_date IS NOT new.publish_date BEGIN{_SQLITE_STATS_REMOVE}{_SQLITE_STATS_ADD}
+    END""",
+    # Databases that had books before these tables existed
+    """INSERT INTO author_stats(author, books) SELECT author, count(*) FROM book
+        WHERE NOT EXISTS (SELECT 1 FROM author_stats) GROUP BY author""",
+    f"""INSERT INTO year_stats(year, books) SELECT {_SQLITE_YEAR.format(row='book')}, count(*) FROM book
+        WHERE NOT EXISTS (SELECT 1 FROM year_stats) GROUP BY 1""",
+]
+
+
+def _postgres_stats_delta(source):
+    """Statements applying `source` (rows of author, publish_date, delta) to the stats tables."""
+    return f"""
+        INSERT INTO author_stats (author, books)
+            SELECT author, sum(delta) FROM ({source}) AS changed GROUP BY author HAVING sum(delta) <> 0
+            ON CONFLICT (author) DO UPDATE SET books = author_stats.books + excluded.books;
+        INSERT INTO year_stats (year, books)
+            SELECT extract(year FROM publish_date)::int, sum(delta) FROM ({source}) AS changed
+            GROUP BY 1 HAVING sum(delta) <> 0
+            ON CONFLICT (year) DO UPDATE SET books = year_stats.books + excluded.books;"""
+
+
+_postgres_stats_ddl = [
+    f"""CREATE OR REPLACE FUNCTION book_stats_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN{_postgres_stats_delta("SELECT author, publish_date, 1 AS delta FROM new_rows")}
+        ELSIF TG_OP = 'DELETE' THEN{_postgres_stats_delta("SELECT author, publish_date, -1 AS delta FROM old_rows")}
+        ELSE{_postgres_stats_delta("SELECT author, publish_date, 1 AS delta FROM new_rows "
+                                   "UNION ALL SELECT author, publish_date, -1 FROM old_rows")}
+        END IF;
+        DELETE FROM author_stats WHERE books <= 0;
+        DELETE FROM year_stats WHERE books <= 0;
+        RETURN NULL;
+    END $$""",
+    "DROP TRIGGER IF EXISTS book_stats_ai ON book",
+    """CREATE TRIGGER book_stats_ai AFTER INSERT ON book REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION book_stats_apply()""",
+    "DROP TRIGGER IF EXISTS book_stats_ad ON book",
+    """CREATE TRIGGER book_stats_ad AFTER DELETE ON book REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION book_stats_apply()""",
+    "DROP TRIGGER IF EXISTS book_stats_au ON book",
+    """CREATE TRIGGER book_stats_au AFTER UPDATE ON book REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION book_stats_apply()""",
+    """INSERT INTO author_stats (author, books) SELECT author, count(*) FROM book
+        WHERE NOT EXISTS (SELECT 1 FROM author_stats) GROUP BY author""",
+    """INSERT INTO year_stats (year, books) SELECT extract(year FROM publish_date)::int, count(*) FROM book
+        WHERE NOT EXISTS (SELECT 1 FROM year_stats) GROUP BY 1""",
+]
+
+# On the metadata, not the book table: the triggers need the stats tables too
+for statement in _sqlite_stats_ddl:
+    event.listen(db.metadata, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+for statement in _postgres_stats_ddl:
+    event.listen(db.metadata, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
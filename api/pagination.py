@@ -0,0 +1,41 @@
+import base64
+import json
+
+# Largest integer a bind parameter can carry (signed 64-bit); drivers overflow past it
+MAX_INTEGER = 2 ** 63 - 1
+
+
+def encode_cursor(position):
+    """Encode a keyset position (dict of column values) as an opaque cursor."""
+    raw = json.dumps(position, separators=(',', ':'), sort_keys=True).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor. Raises ValueError if malformed."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor.")
+    if not isinstance(position, dict):
+        raise ValueError("Invalid cursor.")
+    return position
+
+
+def is_cursor_int(value, maximum=MAX_INTEGER):
+    """True for an int from 0 to `maximum`, as cursor positions are. JSON true is a bool, not one."""
+    return type(value) is int and 0 <= value <= maximum
+
+
+def parse_limit(value, default, maximum):
+    """Parse the ?limit= query parameter, clamping it to the hard maximum."""
+    if value is None:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError("Invalid limit. Must be a positive integer.")
+    if limit < 1:
+        raise ValueError("Invalid limit. Must be a positive integer.")
+    return min(limit, maximum)
@@ -0,0 +1,145 @@
+"""Read-replica routing for db.session.
+
+With REPLICA_DATABASE_URIS set, views decorated with @replica_reads run
+their queries on a replica picked round-robin. Everything else, and any
+query a session makes once it has written (flush or INSERT/UPDATE/DELETE),
+goes to the primary, so a request reads its own writes.
+
+Health checks are passive: a replica whose connection fails is skipped for
+REPLICA_RETRY_AFTER seconds and the view is retried on the primary. When
+every replica is down, reads go to the primary.
+
+Replicas lag the primary. The collection ETag is read from the same
+replica as the rows, so it always describes what was served, but a book
+created a moment ago may still 404 on GET /api/books/<id>. Rows read from a
+replica are not put in the book cache: one written just before the read
+would be cached at its old version for the whole BOOK_CACHE_TTL.
+"""
+import itertools
+import threading
+import time
+from functools import wraps
+
+import sqlalchemy as sa
+from flask import current_app
+from flask_sqlalchemy.session import Session
+from sqlalchemy import exc
+
+from .config import engine_options
+
+# Errors that mean the replica could not be reached (or dropped the connection), not a bad query
+UNAVAILABLE_ERRORS = (exc.OperationalError, exc.InterfaceError)
+
+
+class RoutingSession(Session):
+    """Session that sends reads to `info['replica']` until it writes."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = self.info.get('replica')
+        if replica is not None and bind is None:
+            if not self._flushing and not isinstance(clause, sa.UpdateBase):
+                return replica
+            del self.info['replica']  # reads after a write stay on the primary
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaSet:
+    """Round-robin over replica engines, skipping ones that recently failed."""
+
+    def __init__(self, engines, retry_after):
+        self.engines = engines
+        self.retry_after = retry_after
+        self._down_until = [0.0] * len(engines)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self.fallbacks = 0
+
+    def choose(self):
+        """A healthy replica engine, or None to use the primary."""
+        now = time.monotonic()
+        for _ in range(len(self.engines)):
+            index = next(self._counter) % len(self.engines)
+            if self._down_until[index] <= now:
+                return self.engines[index]
+        return None
+
+    def mark_down(self, engine):
+        with self._lock:
+            self._down_until[self.engines.index(engine)] = time.monotonic() + self.retry_after
+            self.fallbacks += 1
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "replicas": [
+                    {"url": engine.url.render_as_string(hide_password=True), "healthy": down_until <= now}
+                    for engine, down_until in zip(self.engines, self._down_until)
+                ],
+                "fallbacks": self.fallbacks,
+            }
+
+
+def create_replica_set(config):
+    """A ReplicaSet for REPLICA_DATABASE_URIS, or None when it is empty."""
+    uris = [uri.strip() for uri in config.get('REPLICA_DATABASE_URIS', '').split(',') if uri.strip()]
+    if not uris:
+        return None
+    return ReplicaSet([sa.create_engine(uri, **engine_options(uri)) for uri in uris],
+                      config['REPLICA_RETRY_AFTER'])
+
+
+def configure_replicas(app):
+    """(Re)create the replica engines from app.config."""
+    from .metrics import instrument_engine
+    from .pool import init_pool
+    old = app.extensions.get('replicas')
+    if old is not None:
+        for engine in old.engines:
+            engine.dispose()
+    replicas = app.extensions['replicas'] = create_replica_set(app.config)
+    if replicas is not None:
+        init_pool(app, replicas.engines)
+        for engine in replicas.engines:
+            instrument_engine(engine)
+
+
+def init_replicas(app):
+    configure_replicas(app)
+
+    @app.teardown_request
+    def release_replica(exception=None):
+        # Runs once a streamed body is done, so NDJSON streams stay on the replica
+        session = app.extensions['sqlalchemy'].session
+        if session.registry.has():
+            session.info.pop('replica', None)
+
+
+def reading_from_replica():
+    """True while this request's session still sends its reads to a replica."""
+    session = current_app.extensions['sqlalchemy'].session
+    return session.registry.has() and session.info.get('replica') is not None
+
+
+def replica_reads(f):
+    """Run the view's queries on a replica, falling back to the primary."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        replicas = current_app.extensions['replicas']
+        engine = replicas.choose() if replicas is not None else None
+        if engine is None:
+            return f(*args, **kwargs)
+        session = current_app.extensions['sqlalchemy'].session
+        session.info['replica'] = engine
+        try:
+            return f(*args, **kwargs)
+        except UNAVAILABLE_ERRORS:
+            if session.info.get('replica') is not engine:
+                raise  # failed on the primary, after a write
+            current_app.logger.warning("Replica %s unavailable, reading from the primary",
+                                       engine.url.render_as_string(hide_password=True), exc_info=True)
+            replicas.mark_down(engine)
+            session.rollback()
+            del session.info['replica']
+            return f(*args, **kwargs)
+    return decorated
@@ -0,0 +1,302 @@
+"""Caches of finished responses for GET /api/books and /api/books/stats.
+
+Entries are keyed by path, collection ETag (catalog version, query string,
+media type) and content encoding. They hold the final bytes, already
+serialized and compressed (see api/compression.py). A write through the
+API changes the version, so old entries can never be served again; writes
+through api_bp also drop them at once to free the space. The backend is
+chosen with COLLECTION_CACHE_BACKEND:
+
+- memory: an LRU in this process. Each gunicorn worker builds and holds its
+  own copy of every response.
+- sqlite: one SQLite file per host (COLLECTION_CACHE_FILE, ideally on
+  /dev/shm), memory-mapped by every worker. A response is built once per
+  host per version. The first worker to miss takes a short lease on the
+  key, and the others wait up to COLLECTION_CACHE_FILL_WAIT seconds for
+  its bytes instead of building them again. A request that ends without
+  storing its response (an error, or a body too large to cache) releases
+  the lease. This is what gunicorn.conf.py selects.
+- module:Class: any class with the same constructor and methods.
+
+Both bound the total body size at COLLECTION_CACHE_MAX_BYTES and evict the
+least recently used entries first. The cache is best effort: if the file
+is locked or unwritable, requests are treated as misses.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from werkzeug.utils import import_string
+
+
+class MemoryResponseCache:
+    """Thread-safe LRU of (body, headers) in this process, bounded by total body bytes."""
+
+    def __init__(self, config):
+        self.max_bytes = config['COLLECTION_CACHE_MAX_BYTES']
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, wait=True):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, body, headers):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            self._entries[key] = (body, headers)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def release(self):
+        """Nothing to give back: this cache has no fill leases."""
+
+    def invalidate(self):
+        """Drop every entry; counters are kept."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def clear(self):
+        self.invalidate()
+        with self._lock:
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS response (
+    key TEXT PRIMARY KEY, body BLOB NOT NULL, headers TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS ix_response_used ON response (used);
+CREATE TABLE IF NOT EXISTS lease (key TEXT PRIMARY KEY, expires REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS counter (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO counter (name, value) VALUES ('bytes', 0), ('hits', 0), ('misses', 0), ('evictions', 0);
+"""
+
+
+class SqliteResponseCache:
+    """Responses in a SQLite file shared by every worker on the host.
+
+    Reads go through SQLite's mmap. Hits update the LRU clock and the
+    shared hit/miss counters at most once per second per worker, so a hit
+    is normally a read with no write lock.
+    """
+    TOUCH_INTERVAL = 1.0  # seconds between LRU/counter writes per worker
+    POLL_INTERVAL = 0.01  # seconds between checks while another worker fills a key
+
+    def __init__(self, config):
+        self.path = config['COLLECTION_CACHE_FILE']
+        self.max_bytes = config['COLLECTION_CACHE_MAX_BYTES']
+        self.fill_wait = config['COLLECTION_CACHE_FILL_WAIT']
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = {"hits": 0, "misses": 0}  # not yet added to the shared counters
+        self._flushed_at = 0.0
+        connection = self._connect()
+        try:
+            connection.executescript(_SCHEMA)
+        finally:
+            connection.close()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=0.5, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=OFF")  # a cache: losing it on a crash is fine
+        connection.execute(f"PRAGMA mmap_size={max(self.max_bytes * 2, 1 << 20)}")
+        return connection
+
+    @property
+    def _db(self):
+        # One connection per thread, opened after fork (the app is preloaded in the gunicorn master)
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.connection = self._connect()
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def _count(self, name):
+        with self._lock:
+            self._pending[name] += 1
+
+    def _lookup(self, key):
+        row = self._db.execute("SELECT body, headers, used FROM response WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        body, headers, used = row
+        now = time.time()
+        if now - used > self.TOUCH_INTERVAL:
+            self._write(lambda db: db.execute("UPDATE response SET used = ? WHERE key = ?", (now, key)))
+        return body, json.loads(headers)
+
+    @property
+    def _leases(self):
+        """Keys this thread holds the fill lease for and has not stored yet."""
+        if not hasattr(self._local, 'leases'):
+            self._local.leases = set()
+        return self._local.leases
+
+    def _lease(self, key):
+        """True if this worker now fills `key`; False if another worker is already doing it."""
+        now = time.time()
+        cursor = self._db.execute(
+            "INSERT INTO lease (key, expires) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET expires = excluded.expires WHERE lease.expires < ?",
+            (key, now + self.fill_wait, now))
+        if cursor.rowcount == 1:
+            self._leases.add(key)
+            return True
+        return False
+
+    def get(self, key, wait=True):
+        try:
+            entry = self._lookup(key)
+            if entry is None and wait and not self._lease(key):
+                deadline = time.monotonic() + self.fill_wait
+                while entry is None and time.monotonic() < deadline:
+                    time.sleep(self.POLL_INTERVAL)
+                    entry = self._lookup(key)
+        except sqlite3.Error:
+            entry = None
+        self._count("misses" if entry is None else "hits")
+        self._flush_counters()
+        return entry
+
+    def _write(self, apply):
+        """Run `apply(connection)` in a write transaction; give up quietly if the file stays locked."""
+        db = self._db
+        try:
+            db.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            return False
+        try:
+            apply(db)
+            db.execute("COMMIT")
+            return True
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _flush_counters(self, force=False):
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._flushed_at < self.TOUCH_INTERVAL:
+                return
+            pending, self._pending = self._pending, {"hits": 0, "misses": 0}
+            self._flushed_at = now
+
+        def apply(db):
+            db.executemany("UPDATE counter SET value = value + ? WHERE name = ?",
+                           [(count, name) for name, count in pending.items() if count])
+        try:
+            flushed = self._write(apply)
+        except sqlite3.Error:
+            flushed = False
+        if not flushed:
+            with self._lock:
+                for name, count in pending.items():
+                    self._pending[name] += count
+
+    def set(self, key, body, headers):
+        if len(body) > self.max_bytes:
+            return
+
+        def apply(db):
+            old = db.execute("SELECT size FROM response WHERE key = ?", (key,)).fetchone()
+            db.execute("INSERT OR REPLACE INTO response (key, body, headers, size, used) VALUES (?, ?, ?, ?, ?)",
+                       (key, body, json.dumps(headers), len(body), time.time()))
+            db.execute("DELETE FROM lease WHERE key = ?", (key,))
+            total = db.execute("UPDATE counter SET value = value + ? WHERE name = 'bytes' RETURNING value",
+                               (len(body) - (old[0] if old else 0),)).fetchone()[0]
+            evicted = 0
+            while total > self.max_bytes:
+                oldest = db.execute("SELECT key, size FROM response ORDER BY used LIMIT 16").fetchall()
+                for old_key, size in oldest:
+                    db.execute("DELETE FROM response WHERE key = ?", (old_key,))
+                    total -= size
+                    evicted += 1
+                    if total <= self.max_bytes:
+                        break
+            db.execute("UPDATE counter SET value = ? WHERE name = 'bytes'", (total,))
+            db.execute("UPDATE counter SET value = value + ? WHERE name = 'evictions'", (evicted,))
+        try:
+            if self._write(apply):
+                self._leases.discard(key)
+        except sqlite3.Error:
+            pass
+
+    def release(self):
+        """Give up the leases this thread took but never filled, so other workers stop waiting.
+
+        Called at the end of every request: the response may have been an
+        error, too large to cache, or failed to store.
+        """
+        leases = self._leases
+        if not leases:
+            return
+        keys = [(key,) for key in leases]
+        leases.clear()
+        try:
+            self._write(lambda db: db.executemany("DELETE FROM lease WHERE key = ?", keys))
+        except sqlite3.Error:
+            pass  # it expires after COLLECTION_CACHE_FILL_WAIT anyway
+
+    def invalidate(self):
+        def apply(db):
+            db.execute("DELETE FROM response")
+            db.execute("DELETE FROM lease")
+            db.execute("UPDATE counter SET value = 0 WHERE name = 'bytes'")
+        try:
+            self._write(apply)
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        with self._lock:
+            self._pending = {"hits": 0, "misses": 0}
+        self._write(lambda db: (db.execute("DELETE FROM response"), db.execute("DELETE FROM lease"),
+                                db.execute("UPDATE counter SET value = 0")))
+
+    def stats(self):
+        self._flush_counters(force=True)
+        counters = dict(self._db.execute("SELECT name, value FROM counter"))
+        entries = self._db.execute("SELECT count(*) FROM response").fetchone()[0]
+        with self._lock:
+            pending = dict(self._pending)
+        return {"entries": entries, "bytes": counters["bytes"], "max_bytes": self.max_bytes,
+                "hits": counters["hits"] + pending["hits"], "misses": counters["misses"] + pending["misses"],
+                "evictions": counters["evictions"]}
+
+
+BACKENDS = {'memory': MemoryResponseCache, 'sqlite': SqliteResponseCache}
+
+
+def create_response_cache(config):
+    """The configured cache, or None when COLLECTION_CACHE_MAX_BYTES is 0."""
+    if config['COLLECTION_CACHE_MAX_BYTES'] <= 0:
+        return None
+    name = config['COLLECTION_CACHE_BACKEND']
+    backend_class = BACKENDS[name] if name in BACKENDS else import_string(name)
+    return backend_class(config)
@@ -1,73 +1,607 @@
+import math
 import re
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, url_for, current_app, stream_with_context
 from .models import Book
-from . import db
+from . import db, search
 from .auth import require_api_key
-from .helpers import validate_book_data
+from .replicas import reading_from_replica, replica_reads
+from .helpers import validate_book_data, validate_book_fields
+from .changes import parse_since, record_changes, sse_events, wait_for_changes
+from .compression import cached_collection_response, mark_cacheable
+from .stats import catalog_stats, matching_count
+from .serializers import BOOK_COLUMNS, serialize_book, serialize_row
+from .pagination import MAX_INTEGER, encode_cursor, parse_limit
+from .versioning import catalog_state, bump_catalog_version, book_etag, collection_etag
+from .filters import book_filters, book_sort, books_select, decode_position, seek, encode_position
 from datetime import datetime
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 
 api_bp = Blueprint('api', __name__)
 
 # Regular expression for a valid ISBN (13 digits)
 ISBN_REGEX = r'^\d{13}$'
 
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
 def validate_isbn(isbn):
     """Validate the ISBN format (must be 13 digits)."""
-    if not re.match(ISBN_REGEX, isbn):
+    if not isinstance(isbn, str) or not re.match(ISBN_REGEX, isbn):
         return "Invalid ISBN format. ISBN must be 13 digits."
     return None
 
+def is_isbn_conflict(error):
+    """True if an IntegrityError comes from the unique index on book.isbn, not another constraint."""
+    constraint = getattr(getattr(error.orig, 'diag', None), 'constraint_name', None)  # psycopg2
+    if constraint is not None:
+        return constraint == 'book_isbn_key'
+    return 'book.isbn' in str(error.orig)  # SQLite: "UNIQUE constraint failed: book.isbn"
+
 @api_bp.route('/books', methods=['GET'])
 @require_api_key
+@replica_reads
 def get_books():
     """Get all books.
+
+    Passing ?limit= and/or ?cursor= switches to keyset pagination: the
+    response becomes {"books": [...], "next": <url or null>} and every page
+    seeks on (sort column, id), so deep pages cost the same as the first one.
+    Filters and ?sort= apply to every mode and are backed by indexes on Book.
+
+    Sending Accept: application/x-ndjson (or ?stream=1) streams the whole
+    collection instead, one JSON object per line.
+
+    The ETag is derived from the catalog version (bumped by every write made
+    through the API) and the query string; a matching If-None-Match returns
+    304 after a single primary-key lookup.
     ---
     tags:
       - Books
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (capped at BOOKS_MAX_PAGE_SIZE)
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor taken from the "next" link of the previous page
+      - name: stream
+        in: query
+        type: integer
+        required: false
+        description: Set to 1 to stream the collection as NDJSON
+      - name: author
+        in: query
+        type: string
+        required: false
+        description: Only books by this author (exact match)
+      - name: published_after
+        in: query
+        type: string
+        format: date
+        required: false
+        description: Only books published on or after this date (YYYY-MM-DD)
+      - name: published_before
+        in: query
+        type: string
+        format: date
+        required: false
+        description: Only books published on or before this date (YYYY-MM-DD)
+      - name: updated_since
+        in: query
+        type: string
+        format: date-time
+        required: false
+        description: Only books updated at or after this ISO 8601 timestamp
+      - name: sort
+        in: query
+        type: string
+        required: false
+        enum: [id, title, author, publish_date, -id, -title, -author, -publish_date]
+        description: Sort order; prefix with - for descending (default id)
+      - name: ids
+        in: query
+        type: string
+        required: false
+        description: Comma-separated book IDs to fetch in one call; returns the same results as POST /books/batch-get
+    produces:
+      - application/json
+      - application/x-ndjson
     responses:
       200:
-        description: A list of all books
+        description: >
+          One page of books when ?limit= or ?cursor= is given. Without either,
+          the body is just the array of all books (the "books" items below).
         schema:
-          type: array
-          items:
-            type: object
-            properties:
-              id:
-                type: integer
-              title:
-                type: string
-              author:
-                type: string
-              isbn:
-                type: string
-              publish_date:
-                type: string
-                format: date
-              created_at:
-                type: string
-                format: date-time
-              updated_at:
-                type: string
-                format: date-time
+          type: object
+          properties:
+            books:
+              type: array
+              items:
+                type: object
+                properties:
+                  id:
+                    type: integer
+                  title:
+                    type: string
+                  author:
+                    type: string
+                  isbn:
+                    type: string
+                  publish_date:
+                    type: string
+                    format: date
+                  created_at:
+                    type: string
+                    format: date-time
+                  updated_at:
+                    type: string
+                    format: date-time
+            next:
+              type: string
+              description: URL of the next page (also sent as a Link header), or null on the last page
+      304:
+        description: Not modified (If-None-Match matched the current ETag)
     security:
       - APIKeyHeader: []  # Add security for this route
     """
-    books = Book.query.all()
-    return jsonify([{
-        "id": book.id,
-        "title": book.title,
-        "author": book.author,
-        "isbn": book.isbn,
-        "publish_date": book.publish_date.strftime('%Y-%m-%d'),
-        "created_at": book.created_at,
-        "updated_at": book.updated_at
-    } for book in books]), 200
+    if 'ids' in request.args:
+        return get_books_by_ids()
+    try:
+        filters = book_filters(request.args)
+        sort = book_sort(request.args)
+        # Paging parameters are checked now, so a bad one never claims a response cache fill
+        paginate = 'limit' in request.args or 'cursor' in request.args
+        if paginate:
+            limit, position = page_params(sort)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Read the version before the rows: a concurrent write can only make the
+    # data newer than the ETag claims, never older.
+    ndjson = wants_ndjson(request)
+    etag = collection_etag(catalog_state(), request.query_string.decode(),
+                           NDJSON_MIMETYPE if ndjson else 'application/json')
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
+    if ndjson:
+        response = stream_books(filters, sort)
+    else:
+        # Same version and variant: replay the bytes (already compressed) from the last time
+        cached = cached_collection_response(etag)
+        if cached is not None:
+            return cached
+        if paginate:
+            response = get_books_page(filters, sort, limit, position)
+        else:
+            rows = db.session.execute(books_select(filters, sort))
+            response = jsonify([serialize_row(row) for row in rows])
+    if response.status_code == 200:
+        response.set_etag(etag)
+        if not ndjson:
+            mark_cacheable(etag)
+    return response
+
+
+def not_modified(etag):
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def wants_ndjson(request):
+    if request.args.get('stream') == '1':
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def stream_books(filters, sort):
+    """Stream every book as NDJSON, reading rows in batches through a server-side cursor."""
+    batch_size = current_app.config['BOOKS_STREAM_BATCH_SIZE']
+
+    def generate():
+        rows = db.session.execute(
+            books_select(filters, sort).execution_options(yield_per=batch_size)
+        )
+        dumps = current_app.json.dumps
+        for row in rows:
+            yield dumps(serialize_row(row), separators=(',', ':')) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+def page_params(sort):
+    """(limit, position) from ?limit= and ?cursor=. Raises ValueError on bad input."""
+    limit = parse_limit(request.args.get('limit'),
+                        current_app.config['BOOKS_DEFAULT_PAGE_SIZE'],
+                        current_app.config['BOOKS_MAX_PAGE_SIZE'])
+    position = None
+    if request.args.get('cursor'):
+        position = decode_position(request.args['cursor'], sort)
+    return limit, position
+
+
+def get_books_page(filters, sort, limit, position):
+    """Keyset-paginated listing, seeking on (sort column, id)."""
+    query = books_select(filters, sort)
+    if position is not None:
+        query = seek(query, sort, position)
+    # Fetch one extra row to know whether another page exists
+    books = db.session.execute(query.limit(limit + 1)).all()
+
+    next_url = None
+    if len(books) > limit:
+        books = books[:limit]
+        args = request.args.to_dict()
+        args.update(limit=limit, cursor=encode_position(books[-1], sort))
+        next_url = url_for('api.get_books', **args)
+
+    response = jsonify({"books": [serialize_row(book) for book in books], "next": next_url})
+    if next_url:
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
+
+
+def get_books_by_ids():
+    """GET /books?ids=1,2,3: batch_get by ID, with the collection ETag and response cache."""
+    if set(request.args) - {'ids'}:
+        return jsonify({"error": "ids cannot be combined with other query parameters."}), 400
+    try:
+        ids = [int(value) for value in request.args['ids'].split(',')]
+    except ValueError:
+        return jsonify({"error": "Invalid ids. Use comma-separated book IDs."}), 400
+    max_items = current_app.config['BOOKS_BATCH_GET_MAX_ITEMS']
+    if len(ids) > max_items:
+        return jsonify({"error": f"Too many ids. At most {max_items} per request."}), 400
+
+    etag = collection_etag(catalog_state(), request.query_string.decode(), 'application/json')
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    cached = cached_collection_response(etag)
+    if cached is not None:
+        return cached
+    # Read every row: the response is cached host-wide under the current catalog version,
+    # which entries up to BOOK_CACHE_TTL old from this worker's book cache may predate
+    response = jsonify(batch_get('id', ids, use_book_cache=False))
+    response.set_etag(etag)
+    mark_cacheable(etag)
+    return response
+
+
+def batch_get(key, values, use_book_cache=True):
+    """Look up books by 'id' or 'isbn', answering in request order with not_found markers.
+
+    IDs already in the single-book cache are served from it unless
+    `use_book_cache` is false; the rest are fetched with one IN (...) query
+    per BOOKS_IN_CLAUSE_CHUNK_SIZE values, and cached on the way out (not
+    when read from a replica, as in get_book).
+    """
+    cache = current_app.extensions['book_cache']
+    found = {}
+    if key == 'id' and use_book_cache:
+        for book_id in set(values):
+            entry = cache.get(book_id)
+            if entry is not None:
+                found[book_id] = entry[1]
+
+    column = Book.id if key == 'id' else Book.isbn
+    # An ID no integer column can hold is simply not found; the driver would overflow binding it
+    missing = [value for value in dict.fromkeys(values) if value not in found
+               and (key != 'id' or -MAX_INTEGER - 1 <= value <= MAX_INTEGER)]
+    chunk_size = current_app.config['BOOKS_IN_CLAUSE_CHUNK_SIZE']
+    cache_rows = not reading_from_replica()
+    for start in range(0, len(missing), chunk_size):
+        rows = db.session.execute(
+            db.select(*BOOK_COLUMNS, Book.version).where(column.in_(missing[start:start + chunk_size])))
+        for row in rows:
+            payload = serialize_row(row[:-1])
+            if cache_rows:
+                cache.set(row.id, (book_etag(row.id, row.version), payload))
+            found[row.id if key == 'id' else row.isbn] = payload
+
+    results = [{key: value, "status": "found", "book": found[value]} if value in found
+               else {key: value, "status": "not_found"} for value in values]
+    summary = {"found": sum(result["status"] == "found" for result in results)}
+    summary["not_found"] = len(results) - summary["found"]
+    return {**summary, "results": results}
+
+
+@api_bp.route('/books/search', methods=['GET'])
+@require_api_key
+@replica_reads
+def search_books():
+    """Full-text search over book titles and authors.
+    ---
+    tags:
+      - Books
+    parameters:
+      - name: q
+        in: query
+        type: string
+        required: true
+        description: Search terms; all must match, the last one as a prefix
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (capped at BOOKS_MAX_PAGE_SIZE)
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor taken from the "next" link of the previous page
+    responses:
+      200:
+        description: Matching books, best match first
+        schema:
+          type: object
+          properties:
+            books:
+              type: array
+              items:
+                type: object
+            next:
+              type: string
+      400:
+        description: Missing query or invalid paging parameters
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+      501:
+        description: The database has no full-text index this API can query
+    """
+    q = request.args.get('q', '')
+    terms = search.search_terms(q)
+    if not terms:
+        return jsonify({"error": "Missing search query. Use ?q=<terms>."}), 400
+    try:
+        limit = parse_limit(request.args.get('limit'),
+                            current_app.config['BOOKS_DEFAULT_PAGE_SIZE'],
+                            current_app.config['BOOKS_MAX_PAGE_SIZE'])
+        offset = 0
+        if request.args.get('cursor'):
+            offset = search.decode_offset(request.args['cursor'])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Ranked results are paged by position; the cursor carries the offset
+    try:
+        books = search.search_books(terms, limit + 1, offset)
+    except NotImplementedError as e:
+        return jsonify({"error": str(e)}), 501
+    next_url = None
+    if len(books) > limit:
+        books = books[:limit]
+        if offset + limit <= search.MAX_SEARCH_OFFSET:
+            next_url = url_for('api.search_books', q=q, limit=limit,
+                               cursor=encode_cursor({"offset": offset + limit}))
+
+    return jsonify({"books": [serialize_row(book) for book in books], "next": next_url}), 200
+
+
+@api_bp.route('/books/stats', methods=['GET'])
+@require_api_key
+@replica_reads
+def get_book_stats():
+    """Catalog statistics: total, books per publication year and top authors.
+
+    Read from per-author and per-year count tables that triggers keep
+    current, so the cost does not grow with the catalog. With any of the
+    GET /books filters, "matching" also gives the count for that view:
+    exact for one author or whole years, otherwise an estimate.
+    ---
+    tags:
+      - Books
+    parameters:
+      - name: authors
+        in: query
+        type: integer
+        required: false
+        description: Number of top authors to return (default 10, capped at BOOKS_MAX_PAGE_SIZE)
+      - name: author
+        in: query
+        type: string
+        required: false
+      - name: published_after
+        in: query
+        type: string
+        format: date
+        required: false
+      - name: published_before
+        in: query
+        type: string
+        format: date
+        required: false
+      - name: updated_since
+        in: query
+        type: string
+        format: date-time
+        required: false
+    responses:
+      200:
+        description: Catalog statistics
+        schema:
+          type: object
+          properties:
+            total:
+              type: integer
+            by_year:
+              type: array
+              items:
+                type: object
+                properties:
+                  year:
+                    type: integer
+                  books:
+                    type: integer
+            top_authors:
+              type: array
+              items:
+                type: object
+                properties:
+                  author:
+                    type: string
+                  books:
+                    type: integer
+            matching:
+              type: object
+              description: Only when filters are given
+              properties:
+                count:
+                  type: integer
+                exact:
+                  type: boolean
+      304:
+        description: Not modified (If-None-Match matched the current ETag)
+      400:
+        description: Invalid filter or authors value
+    """
+    try:
+        book_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        top_authors = parse_limit(request.args.get('authors'), 10, current_app.config['BOOKS_MAX_PAGE_SIZE'])
+    except ValueError:
+        return jsonify({"error": "Invalid authors. Must be a positive integer."}), 400
+
+    etag = collection_etag(catalog_state(), request.query_string.decode(), 'stats')
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    cached = cached_collection_response(etag)
+    if cached is not None:
+        return cached
+
+    stats = catalog_stats(top_authors)
+    if any(request.args.get(name) for name in ('author', 'published_after', 'published_before', 'updated_since')):
+        stats["matching"] = matching_count(request.args)
+    response = jsonify(stats)
+    response.set_etag(etag)
+    mark_cacheable(etag)
+    return response
+
+
+@api_bp.route('/books/changes', methods=['GET'])
+@require_api_key
+@replica_reads
+def get_book_changes():
+    """Inserts, updates and deletes since a cursor, in commit order.
+
+    Sync a copy of the catalog by applying the changes in order and
+    sending the returned cursor back as ?since= next time; start from 0 or
+    from the catalog version of a snapshot. ?wait=<seconds> long-polls
+    when there is nothing new yet. Accept: text/event-stream streams the
+    changes as Server-Sent Events instead (resumable with Last-Event-ID).
+    ---
+    tags:
+      - Books
+    parameters:
+      - name: since
+        in: query
+        type: string
+        required: false
+        description: Cursor from the previous response, or a catalog version (default 0, the beginning)
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Changes per response (capped at BOOKS_MAX_PAGE_SIZE)
+      - name: wait
+        in: query
+        type: number
+        required: false
+        description: Seconds to wait for a change when there is none (capped at CHANGES_MAX_WAIT)
+    responses:
+      200:
+        description: Changes after the cursor, and the cursor to continue from
+        schema:
+          type: object
+          properties:
+            changes:
+              type: array
+              items:
+                type: object
+                properties:
+                  id:
+                    type: integer
+                    description: Book ID
+                  op:
+                    type: string
+                    enum: [insert, update, delete]
+                  version:
+                    type: integer
+                    description: Catalog version the change was committed at
+                  changed_at:
+                    type: string
+                    format: date-time
+                  book:
+                    type: object
+                    description: The book's current state, or null if it has since been deleted
+            cursor:
+              type: string
+            more:
+              type: boolean
+              description: True if more changes are waiting; fetch again right away
+      400:
+        description: Invalid cursor, limit or wait
+      503:
+        description: Event stream refused, CHANGES_MAX_WAITERS streams and long polls are already open on this worker
+    """
+    try:
+        version, change_id = parse_since(request.headers.get('Last-Event-ID') or request.args.get('since'))
+        limit = parse_limit(request.args.get('limit'),
+                            current_app.config['BOOKS_DEFAULT_PAGE_SIZE'],
+                            current_app.config['BOOKS_MAX_PAGE_SIZE'])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        wait = math.nan
+    if math.isnan(wait):
+        return jsonify({"error": "Invalid wait. Must be a number of seconds."}), 400
+    wait = min(max(wait, 0), current_app.config['CHANGES_MAX_WAIT'])
+
+    # Each waiting request holds a worker thread; CHANGES_MAX_WAITERS bounds how many per worker
+    waiters = current_app.extensions['changes_waiters']
+    if request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream':
+        if not waiters.acquire(blocking=False):
+            return jsonify({"error": "Too many open change streams. Retry later, or long-poll with ?wait=."}), \
+                503, {"Retry-After": "5"}
+        events = sse_events(version, change_id, limit, current_app.config['CHANGES_STREAM_SECONDS'])
+        response = Response(stream_with_context(events), mimetype='text/event-stream',
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        response.call_on_close(waiters.release)  # called by the server even if the client goes away
+        return response
+
+    # With every slot taken, answer right away; the client simply polls again
+    waiting = wait > 0 and waiters.acquire(blocking=False)
+    try:
+        changes, cursor, more = wait_for_changes(version, change_id, limit, wait if waiting else 0)
+    finally:
+        if waiting:
+            waiters.release()
+    return jsonify({"changes": changes, "cursor": cursor, "more": more}), 200
 
 
 @api_bp.route('/books/<int:id>', methods=['GET'])
 @require_api_key
+@replica_reads
 def get_book(id):
     """Get a specific book by ID.
+
+    Served from the worker's LRU cache when possible; update_book and
+    delete_book invalidate the entry on write. Rows read from a replica
+    are not cached. The ETag comes from the row
+    version, so a matching If-None-Match on a cached entry is answered with
+    304 without touching the database.
     ---
     tags:
       - Books
@@ -100,6 +634,8 @@ def get_book(id):
             updated_at:
               type: string
               format: date-time
+      304:
+        description: Not modified (If-None-Match matched the current ETag)
       404:
         description: Book not found
         schema:
@@ -108,18 +644,94 @@ def get_book(id):
             error:
               type: string
     """
-    book = db.session.get(Book, id)
-    if not book:
-        return jsonify({"error": "Book not found"}), 404
-    return jsonify({
-        "id": book.id,
-        "title": book.title,
-        "author": book.author,
-        "isbn": book.isbn,
-        "publish_date": book.publish_date.strftime('%Y-%m-%d'),
-        "created_at": book.created_at,
-        "updated_at": book.updated_at
-    }), 200
+    cache = current_app.extensions['book_cache']
+    entry = cache.get(id)
+    if entry is None:
+        book = db.session.get(Book, id)
+        if not book:
+            return jsonify({"error": "Book not found"}), 404
+        entry = (book_etag(book.id, book.version), serialize_book(book))
+        if not reading_from_replica():
+            cache.set(id, entry)
+    etag, payload = entry
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    response = jsonify(payload)
+    response.set_etag(etag)
+    return response
+
+@api_bp.route('/books/batch-get', methods=['POST'])
+@require_api_key
+@replica_reads
+def batch_get_books():
+    """Fetch many books by ID or ISBN in one call.
+    ---
+    tags:
+      - Books
+    parameters:
+      - name: body
+        in: body
+        required: true
+        description: Either "ids" or "isbns", up to BOOKS_BATCH_GET_MAX_ITEMS values
+        schema:
+          type: object
+          properties:
+            ids:
+              type: array
+              items:
+                type: integer
+            isbns:
+              type: array
+              items:
+                type: string
+    responses:
+      200:
+        description: One result per requested value, in request order
+        schema:
+          type: object
+          properties:
+            found:
+              type: integer
+            not_found:
+              type: integer
+            results:
+              type: array
+              items:
+                type: object
+                properties:
+                  id:
+                    type: integer
+                    description: The requested ID (for "ids")
+                  isbn:
+                    type: string
+                    description: The requested ISBN (for "isbns")
+                  status:
+                    type: string
+                    enum: [found, not_found]
+                  book:
+                    type: object
+                    description: The book, when found
+      400:
+        description: Invalid body, or too many values
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or len({'ids', 'isbns'} & set(data)) != 1:
+        return jsonify({"error": 'Request body must be an object with either "ids" or "isbns".'}), 400
+    key, values = ('id', data['ids']) if 'ids' in data else ('isbn', data['isbns'])
+    value_type = int if key == 'id' else str
+    if not isinstance(values, list) or not all(type(value) is value_type for value in values):
+        return jsonify({"error": "ids must be a list of integers." if key == 'id'
+                        else "isbns must be a list of strings."}), 400
+    max_items = current_app.config['BOOKS_BATCH_GET_MAX_ITEMS']
+    if len(values) > max_items:
+        return jsonify({"error": f"Too many {key}s. At most {max_items} per request."}), 400
+    return jsonify(batch_get(key, values)), 200
+
 
 @api_bp.route('/books', methods=['POST'])
 @require_api_key
@@ -178,19 +790,16 @@ def add_book():
               example: "ISBN already exists. Please provide a unique ISBN."
     """
     data = request.get_json()
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a book object."}), 400
 
     # Validate ISBN
     isbn_error = validate_isbn(data.get('isbn', ''))
     if isbn_error:
         return jsonify({"error": isbn_error}), 400
 
-    # Check if the ISBN already exists in the database
-    existing_book = Book.query.filter_by(isbn=data['isbn']).first()
-    if existing_book:
-        return jsonify({"error": "ISBN already exists. Please provide a unique ISBN."}), 409
-
     # Validate other fields
-    error = validate_book_data(data)
+    error = validate_book_fields(data) or validate_book_data(data)
     if error:
         return jsonify({"error": error}), 400
 
@@ -201,13 +810,279 @@ def add_book():
         publish_date=datetime.strptime(data['publish_date'], '%Y-%m-%d')
     )
     db.session.add(new_book)
-    db.session.commit()
+    # The unique index on isbn is the check: no SELECT first, and no race between two posts
+    try:
+        db.session.flush()  # INSERT now, for new_book.id
+        version = bump_catalog_version()
+        record_changes('insert', [new_book.id], version)
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        if not is_isbn_conflict(e):
+            raise
+        return jsonify({"error": "ISBN already exists. Please provide a unique ISBN."}), 409
     return jsonify({"message": "Book added successfully", "id": new_book.id}), 201
 
+@api_bp.route('/books/isbn/<isbn>', methods=['PUT'])
+@require_api_key
+def upsert_book(isbn):
+    """Create or replace the book with this ISBN.
+
+    One INSERT ... ON CONFLICT (isbn) DO UPDATE ... RETURNING, so a sync job
+    can replay the same request safely.
+    ---
+    tags:
+      - Books
+    parameters:
+      - name: isbn
+        in: path
+        type: string
+        required: true
+        description: The ISBN of the book (13 digits)
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            title:
+              type: string
+            author:
+              type: string
+            publish_date:
+              type: string
+              format: date
+    responses:
+      200:
+        description: Existing book replaced
+        schema:
+          type: object
+          properties:
+            message:
+              type: string
+              example: "Book updated successfully"
+            id:
+              type: integer
+      201:
+        description: Book created
+        schema:
+          type: object
+          properties:
+            message:
+              type: string
+              example: "Book added successfully"
+            id:
+              type: integer
+      400:
+        description: Invalid input data, or a body ISBN that differs from the path
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+    """
+    data = request.get_json()
+    isbn_error = validate_isbn(isbn)
+    if isbn_error:
+        return jsonify({"error": isbn_error}), 400
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a book object."}), 400
+    if data.get('isbn', isbn) != isbn:
+        return jsonify({"error": "ISBN in the body does not match the URL."}), 400
+    error = validate_book_fields(data) or validate_book_data({**data, "isbn": isbn})
+    if error:
+        return jsonify({"error": error}), 400
+
+    insert = postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+    statement = insert(Book).values(
+        title=data['title'],
+        author=data['author'],
+        isbn=isbn,
+        publish_date=datetime.strptime(data['publish_date'], '%Y-%m-%d').date()
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[Book.isbn],
+        set_={
+            "title": statement.excluded.title,
+            "author": statement.excluded.author,
+            "publish_date": statement.excluded.publish_date,
+            "updated_at": statement.excluded.updated_at,
+            "version": Book.version + 1,
+        },
+    ).returning(Book.id, Book.version)
+    book_id, version = db.session.execute(statement).one()
+    # A new row starts at version 1; the conflict branch always bumps it
+    created = version == 1
+    record_changes('insert' if created else 'update', [book_id], bump_catalog_version())
+    db.session.commit()
+    current_app.extensions['book_cache'].delete(book_id)
+
+    response = jsonify({"message": "Book added successfully" if created else "Book updated successfully",
+                        "id": book_id})
+    response.set_etag(book_etag(book_id, version))
+    if created:
+        return response, 201, {"Location": url_for('api.get_book', id=book_id)}
+    return response, 200
+
+@api_bp.route('/books/bulk', methods=['POST'])
+@require_api_key
+def add_books_bulk():
+    """Add many books in one request.
+
+    Every item is validated, existing ISBNs are looked up with one set-based
+    query per chunk and all new books are inserted in a single transaction.
+    ---
+    tags:
+      - Books
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: array
+          items:
+            type: object
+            properties:
+              title:
+                type: string
+              author:
+                type: string
+              isbn:
+                type: string
+                description: 13-digit ISBN
+              publish_date:
+                type: string
+                format: date
+    responses:
+      200:
+        description: Per-item results, in request order
+        schema:
+          type: object
+          properties:
+            created:
+              type: integer
+            conflict:
+              type: integer
+            invalid:
+              type: integer
+            results:
+              type: array
+              items:
+                type: object
+                properties:
+                  index:
+                    type: integer
+                  status:
+                    type: string
+                    enum: [created, conflict, invalid]
+                  id:
+                    type: integer
+                  error:
+                    type: string
+      400:
+        description: Body is not a list of books or is too large
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+      409:
+        description: A concurrent request inserted one of the ISBNs; nothing was written
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+    """
+    data = request.get_json()
+    if isinstance(data, dict):
+        data = data.get('books')
+    if not isinstance(data, list):
+        return jsonify({"error": "Request body must be a list of books."}), 400
+    max_items = current_app.config['BOOKS_BULK_MAX_ITEMS']
+    if len(data) > max_items:
+        return jsonify({"error": f"Too many books. At most {max_items} per request."}), 400
+
+    results = [None] * len(data)
+    candidates = {}  # isbn -> index of the first item carrying it
+    for index, item in enumerate(data):
+        if not isinstance(item, dict):
+            results[index] = {"index": index, "status": "invalid", "error": "Book must be an object."}
+            continue
+        isbn = item.get('isbn', '')
+        error = validate_isbn(isbn) or validate_book_fields(item) or validate_book_data(item)
+        if error:
+            results[index] = {"index": index, "status": "invalid", "error": error}
+        elif isbn in candidates:
+            results[index] = {"index": index, "status": "conflict",
+                              "error": "Duplicate ISBN in request."}
+        else:
+            candidates[isbn] = index
+
+    # One IN (...) lookup per chunk instead of one SELECT per book
+    isbns = list(candidates)
+    chunk_size = current_app.config['BOOKS_IN_CLAUSE_CHUNK_SIZE']
+    for start in range(0, len(isbns), chunk_size):
+        chunk = isbns[start:start + chunk_size]
+        for isbn in db.session.scalars(db.select(Book.isbn).where(Book.isbn.in_(chunk))):
+            index = candidates.pop(isbn)
+            results[index] = {"index": index, "status": "conflict",
+                              "error": "ISBN already exists. Please provide a unique ISBN."}
+
+    if candidates:
+        rows = [{
+            "title": data[index]['title'],
+            "author": data[index]['author'],
+            "isbn": isbn,
+            "publish_date": datetime.strptime(data[index]['publish_date'], '%Y-%m-%d').date()
+        } for isbn, index in candidates.items()]
+        try:
+            # executemany / multi-row VALUES, ids come back through RETURNING
+            created = db.session.execute(db.insert(Book).returning(Book.id, Book.isbn), rows).all()
+            record_changes('insert', [book_id for book_id, _ in created], bump_catalog_version())
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            if not is_isbn_conflict(e):
+                raise
+            return jsonify({"error": "ISBN already exists. A concurrent request inserted one of these books; nothing was written."}), 409
+        for book_id, isbn in created:
+            index = candidates[isbn]
+            results[index] = {"index": index, "status": "created", "id": book_id}
+
+    summary = {status: 0 for status in ("created", "conflict", "invalid")}
+    for result in results:
+        summary[result["status"]] += 1
+    return jsonify({**summary, "results": results}), 200
+
+def if_match_versions(book_id):
+    """Versions of `book_id` accepted by the If-Match header.
+
+    None means no precondition (header absent or `*`); an empty set means
+    no tag names this book, so the request can only fail with 412.
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    prefix = f"b{book_id}-"
+    return {int(tag[len(prefix):]) for tag in request.if_match.as_set()
+            if tag.startswith(prefix) and tag[len(prefix):].isdigit()}
+
+
+def write_failed(book_id, versions):
+    """Response for an UPDATE/DELETE that matched no row: 404, or 412 if the book exists."""
+    if versions is not None and db.session.get(Book, book_id) is not None:
+        return jsonify({"error": "Book was modified by another request. Fetch it again and retry."}), 412
+    return jsonify({"error": "Book not found"}), 404
+
+
 @api_bp.route('/books/<int:id>', methods=['PUT'])
 @require_api_key
 def update_book(id):
     """Update an existing book by ID.
+
+    Only the fields present in the body change. Runs as a single
+    UPDATE ... RETURNING; send the book's ETag in If-Match to make it
+    conditional.
     ---
     tags:
       - Books
@@ -217,6 +1092,11 @@ def update_book(id):
         type: integer
         required: true
         description: The ID of the book to update
+      - name: If-Match
+        in: header
+        type: string
+        required: false
+        description: ETag from GET /books/<id>; the update fails with 412 if the book changed since
       - name: body
         in: body
         required: true
@@ -245,6 +1125,8 @@ def update_book(id):
             message:
               type: string
               example: "Book updated successfully"
+            id:
+              type: integer
       400:
         description: Invalid input data
         schema:
@@ -261,39 +1143,63 @@ def update_book(id):
             error:
               type: string
               example: "Book not found"
+      409:
+        description: Another book already has this ISBN
+      412:
+        description: If-Match does not name the book's current version
     """
-    book = db.session.get(Book, id)
-    if not book:
-        return jsonify({"error": "Book not found"}), 404
-
     data = request.get_json()
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a book object."}), 400
 
-    # Validate ISBN
+    # Validate everything before writing anything
+    values = {field: data[field] for field in ('title', 'author', 'isbn') if field in data}
     if 'isbn' in data:
         isbn_error = validate_isbn(data['isbn'])
         if isbn_error:
             return jsonify({"error": isbn_error}), 400
-
-    # Update other fields
-    if 'title' in data:
-        book.title = data['title']
-    if 'author' in data:
-        book.author = data['author']
-    if 'isbn' in data:
-        book.isbn = data['isbn']
+    error = validate_book_fields(data)
+    if error:
+        return jsonify({"error": error}), 400
     if 'publish_date' in data:
         try:
-            book.publish_date = datetime.strptime(data['publish_date'], '%Y-%m-%d')
+            values['publish_date'] = datetime.strptime(data['publish_date'], '%Y-%m-%d').date()
         except ValueError:
             return jsonify({"error": "Invalid date format for publish_date. Use YYYY-MM-DD."}), 400
 
-    db.session.commit()
-    return jsonify({"message": "Book updated successfully"}), 200
+    versions = if_match_versions(id)
+    statement = db.update(Book).where(Book.id == id)
+    if versions is not None:
+        statement = statement.where(Book.version.in_(versions))
+    statement = statement.values(**values, version=Book.version + 1).returning(Book.version)
+    try:
+        version = db.session.execute(statement, execution_options={"synchronize_session": False}).scalar()
+        if version is None:
+            db.session.rollback()
+            return write_failed(id, versions)
+        record_changes('update', [id], bump_catalog_version())
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        if not is_isbn_conflict(e):
+            raise
+        return jsonify({"error": "ISBN already exists. Please provide a unique ISBN."}), 409
+    current_app.extensions['book_cache'].delete(id)
+
+    response = jsonify({"message": "Book updated successfully", "id": id})
+    response.set_etag(book_etag(id, version))
+    return response, 200
+
+# PATCH is the natural verb for the partial update PUT has always done
+api_bp.add_url_rule('/books/<int:id>', 'patch_book', update_book, methods=['PATCH'])
 
 @api_bp.route('/books/<int:id>', methods=['DELETE'])
 @require_api_key
 def delete_book(id):
     """Delete a book by ID.
+
+    A single DELETE ... RETURNING; send the book's ETag in If-Match to make
+    it conditional.
     ---
     tags:
       - Books
@@ -303,15 +1209,14 @@ def delete_book(id):
         type: integer
         required: true
         description: ID of the book to delete
+      - name: If-Match
+        in: header
+        type: string
+        required: false
+        description: ETag from GET /books/<id>; the delete fails with 412 if the book changed since
     responses:
-      200:
+      204:
         description: Successfully deleted the book
-        schema:
-          type: object
-          properties:
-            message:
-              type: string
-              example: "Book deleted successfully"
       404:
         description: Book not found
         schema:
@@ -320,11 +1225,19 @@ def delete_book(id):
             error:
               type: string
               example: "Book not found"
+      412:
+        description: If-Match does not name the book's current version
     """
-    book = db.session.get(Book, id)
-    if not book:
-        return jsonify({"error": "Book not found"}), 404
-
-    db.session.delete(book)
+    versions = if_match_versions(id)
+    statement = db.delete(Book).where(Book.id == id)
+    if versions is not None:
+        statement = statement.where(Book.version.in_(versions))
+    deleted = db.session.execute(statement.returning(Book.id),
+                                 execution_options={"synchronize_session": False}).scalar()
+    if deleted is None:
+        db.session.rollback()
+        return write_failed(id, versions)
+    record_changes('delete', [id], bump_catalog_version())
     db.session.commit()
-    return jsonify({"message": "Book deleted successfully"}), 204
\ No newline at end of file
+    current_app.extensions['book_cache'].delete(id)
+    return jsonify({"message": "Book deleted successfully"}), 204
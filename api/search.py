@@ -0,0 +1,65 @@
+import re
+from sqlalchemy import text
+from . import db
+from .pagination import decode_cursor, is_cursor_int
+from .serializers import BOOK_COLUMNS
+
+# Only word characters reach the index query, so user input can never
+# produce an FTS5/tsquery syntax error.
+_TERM_REGEX = re.compile(r'\w+', re.UNICODE)
+
+# Deepest result a search cursor may page to. Ranked pages are read with
+# OFFSET, so each page costs as much as all the ones before it.
+MAX_SEARCH_OFFSET = 10000
+
+_SQLITE_SEARCH = text("""
+    SELECT book.id, book.title, book.author, book.isbn, book.publish_date, book.created_at, book.updated_at
+    FROM book_fts JOIN book ON book.id = book_fts.rowid
+    WHERE book_fts MATCH :query
+    ORDER BY book_fts.rank, book.id
+    LIMIT :limit OFFSET :offset
+""")
+
+_POSTGRES_SEARCH = text("""
+    SELECT book.id, book.title, book.author, book.isbn, book.publish_date, book.created_at, book.updated_at
+    FROM book, to_tsquery('simple', :query) AS query
+    WHERE book.search_vector @@ query
+    ORDER BY ts_rank(book.search_vector, query) DESC, book.id
+    LIMIT :limit OFFSET :offset
+""")
+
+
+def search_terms(q):
+    return _TERM_REGEX.findall(q or '')
+
+
+def search_statement(terms, dialect):
+    """Return (statement, params) selecting rows of BOOK_COLUMNS that match all terms.
+
+    The last term is matched as a prefix so partially typed queries work.
+    Results are ranked best match first; add "limit" and "offset" to params.
+    """
+    if dialect == 'postgresql':
+        query = ' & '.join(terms[:-1] + [terms[-1] + ':*'])
+        statement = _POSTGRES_SEARCH
+    elif dialect == 'sqlite':
+        quoted = ['"%s"' % term for term in terms]
+        query = ' '.join(quoted[:-1] + [quoted[-1] + '*'])
+        statement = _SQLITE_SEARCH
+    else:
+        raise NotImplementedError(f"Full-text search is not supported on {dialect}")
+    return statement.columns(*BOOK_COLUMNS), {"query": query}
+
+
+def decode_offset(cursor):
+    """Search pages are ranked, so their cursors carry a position rather than a key."""
+    offset = decode_cursor(cursor).get('offset')
+    if not is_cursor_int(offset, MAX_SEARCH_OFFSET):
+        raise ValueError("Invalid cursor.")
+    return offset
+
+
+def search_books(terms, limit, offset=0):
+    """Return up to `limit` rows of BOOK_COLUMNS matching all terms, best match first."""
+    statement, params = search_statement(terms, db.session.get_bind().dialect.name)
+    return db.session.execute(statement, {**params, "limit": limit, "offset": offset}).all()
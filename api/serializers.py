@@ -0,0 +1,49 @@
+from datetime import timezone
+from .models import Book
+
+# Columns selected by the read paths. They are plain table columns, so
+# listings run as Core selects that yield row tuples, skipping ORM object
+# construction and the identity map.
+_columns = Book.__table__.c
+BOOK_COLUMNS = (_columns.id, _columns.title, _columns.author, _columns.isbn,
+                _columns.publish_date, _columns.created_at, _columns.updated_at)
+
+
+_DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+           'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def _http_date(value):
+    """Same RFC 2822 string Flask's default JSON provider emits for datetimes
+    (werkzeug.http.http_date), without the email.utils round-trip."""
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return (f"{_DAYS[value.weekday()]}, {value.day:02d} {_MONTHS[value.month - 1]} {value.year:04d} "
+            f"{value.hour:02d}:{value.minute:02d}:{value.second:02d} GMT")
+
+
+def serialize_row(row):
+    """Serialize a row of BOOK_COLUMNS into a JSON-ready dict.
+
+    Dates are encoded here, in a single pass, so the JSON encoder only ever
+    sees strings and ints.
+    """
+    book_id, title, author, isbn, publish_date, created_at, updated_at = row
+    return {
+        "id": book_id,
+        "title": title,
+        "author": author,
+        "isbn": isbn,
+        "publish_date": publish_date.isoformat(),
+        "created_at": _http_date(created_at),
+        "updated_at": _http_date(updated_at)
+    }
+
+
+def serialize_book(book):
+    """Serialize a Book instance; same output as serialize_row."""
+    return serialize_row((book.id, book.title, book.author, book.isbn,
+                          book.publish_date, book.created_at, book.updated_at))
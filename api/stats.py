@@ -0,0 +1,113 @@
+"""Catalog statistics behind GET /api/books/stats.
+
+author_stats and year_stats hold the number of books per author and per
+publication year. Triggers on book keep them current within each write's
+transaction (see api/models.py), so reading them costs the same however
+large the catalog is: the total is a sum over the years, and top authors
+come from an index scan of (books, author).
+
+Counts for a filtered view are answered from the same tables when they
+can be exact: one author, or whole publication years. Anything else is
+estimated. Postgres uses the planner's row estimate from EXPLAIN.
+SQLite counts, but stops at STATS_COUNT_LIMIT rows.
+
+`flask books refresh-stats` rebuilds both tables from book, e.g. after
+writes made with the triggers disabled.
+"""
+from datetime import date
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from . import db
+from .filters import book_filters
+from .models import AuthorStats, Book, YearStats
+from .versioning import bump_catalog_version
+
+# Filters of GET /api/books that year_stats answers exactly when they cover whole years
+_YEAR_FILTERS = {'published_after', 'published_before'}
+
+
+def catalog_stats(top_authors):
+    by_year = db.session.execute(db.select(YearStats.year, YearStats.books).order_by(YearStats.year)).all()
+    authors = db.session.execute(
+        db.select(AuthorStats.author, AuthorStats.books)
+        .order_by(AuthorStats.books.desc(), AuthorStats.author.desc())  # ix_author_stats_books, backwards
+        .limit(top_authors)
+    ).all()
+    return {
+        "total": sum(books for _, books in by_year),
+        "by_year": [{"year": year, "books": books} for year, books in by_year],
+        "top_authors": [{"author": author, "books": books} for author, books in authors],
+    }
+
+
+def _whole_years(args):
+    """(first, last) year if the publish date filters cover whole years, else None."""
+    after, before = args.get('published_after'), args.get('published_before')
+    try:
+        first = date.fromisoformat(after) if after else None
+        last = date.fromisoformat(before) if before else None
+    except ValueError:
+        return None
+    if (first and (first.month, first.day) != (1, 1)) or (last and (last.month, last.day) != (12, 31)):
+        return None
+    return first.year if first else None, last.year if last else None
+
+
+def matching_count(args):
+    """{"count", "exact"} for the books GET /api/books would return with these filters."""
+    filters = book_filters(args)  # validates, raises ValueError
+    used = {name for name in ('author', 'published_after', 'published_before', 'updated_since') if args.get(name)}
+    if used == {'author'}:
+        count = db.session.scalar(db.select(AuthorStats.books).where(AuthorStats.author == args['author']))
+        return {"count": count or 0, "exact": True}
+    years = _whole_years(args) if used <= _YEAR_FILTERS else None
+    if years is not None:
+        first, last = years
+        query = db.select(db.func.coalesce(db.func.sum(YearStats.books), 0))
+        if first is not None:
+            query = query.where(YearStats.year >= first)
+        if last is not None:
+            query = query.where(YearStats.year <= last)
+        return {"count": db.session.scalar(query), "exact": True}
+
+    matching = db.select(db.literal(1)).select_from(Book).where(*filters)
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return {"count": _planner_estimate(matching), "exact": False}
+    limit = current_app.config['STATS_COUNT_LIMIT']
+    count = db.session.scalar(db.select(db.func.count()).select_from(matching.limit(limit).subquery()))
+    return {"count": count, "exact": count < limit}
+
+
+def _planner_estimate(query):
+    """Rows Postgres expects `query` to return, from its statistics; no rows are read."""
+    compiled = query.compile(dialect=db.session.get_bind().dialect, compile_kwargs={"literal_binds": True})
+    plan = db.session.execute(db.text(f"EXPLAIN (FORMAT JSON) {compiled}")).scalar()
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def refresh_stats(connection):
+    """Recompute author_stats and year_stats from book, inside the caller's transaction."""
+    year = db.cast(db.extract('year', Book.publish_date) if connection.dialect.name == 'postgresql'
+                   else db.func.substr(Book.publish_date, 1, 4), db.Integer)
+    if connection.dialect.name == 'postgresql':
+        # Writes wait until the new counts commit; reads carry on (SQLite has a single writer anyway)
+        connection.exec_driver_sql("LOCK TABLE book IN SHARE MODE")
+    bump_catalog_version(connection)  # new stats ETag
+    connection.execute(db.delete(AuthorStats))
+    connection.execute(db.delete(YearStats))
+    connection.execute(db.insert(AuthorStats).from_select(
+        ['author', 'books'], db.select(Book.author, db.func.count()).group_by(Book.author)))
+    connection.execute(db.insert(YearStats).from_select(
+        ['year', 'books'], db.select(year, db.func.count()).group_by(year)))
+
+
+@click.command('refresh-stats')
+@with_appcontext
+def refresh_stats_command():
+    """Rebuild the per-author and per-year book counts."""
+    with db.engine.begin() as connection:
+        refresh_stats(connection)
+    click.echo("Catalog stats refreshed.")
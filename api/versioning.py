@@ -0,0 +1,55 @@
+import hashlib
+from . import db
+from .models import CatalogState
+
+
+def catalog_version_select():
+    return db.select(CatalogState.version).where(CatalogState.id == 1)
+
+
+def catalog_version():
+    return db.session.scalar(catalog_version_select()) or 0
+
+
+def catalog_state_select():
+    return db.select(CatalogState.version, CatalogState.token).where(CatalogState.id == 1)
+
+
+def catalog_state(row=None):
+    """(version, token) of the catalog, from `row` of catalog_state_select() or the session."""
+    if row is None:
+        row = db.session.execute(catalog_state_select()).first()
+    return (row.version, row.token) if row is not None else (0, '')
+
+
+def bump_catalog_version(connection=None):
+    """Increment the collection version inside the current transaction.
+
+    Uses the session unless a Core `connection` is given. Returns the new
+    version. The row stays locked until commit, so versions are handed out
+    in commit order (see api/changes.py).
+    """
+    executor = connection if connection is not None else db.session
+    version = executor.execute(
+        db.update(CatalogState).where(CatalogState.id == 1).values(version=CatalogState.version + 1)
+        .returning(CatalogState.version)
+    ).scalar()
+    if version is None:
+        executor.execute(db.insert(CatalogState).values(id=1, version=1))
+        version = 1
+    return version
+
+
+def book_etag(book_id, version):
+    return f"b{book_id}-{version}"
+
+
+def collection_etag(state, *variant):
+    """ETag for one representation (query string, media type...) of the catalog at `state`.
+
+    `state` is catalog_state(); its token keeps ETags, and the responses
+    cached under them, from matching across databases.
+    """
+    version, token = state
+    digest = hashlib.sha1('\0'.join((token, *variant)).encode()).hexdigest()[:16]
+    return f"c{version}-{digest}"
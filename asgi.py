@@ -0,0 +1,14 @@
+"""ASGI entry point with async read endpoints (see api/asgi.py).
+
+    uvicorn asgi:app --host 0.0.0.0 --port 80 --workers 4
+
+Uses the "production" config unless FLASK_ENV says otherwise.
+"""
+import os
+
+os.environ.setdefault("FLASK_ENV", "production")
+
+from main import app as flask_app  # noqa: E402  (FLASK_ENV must be set first)
+from api.asgi import AsyncReadApp  # noqa: E402
+
+app = AsyncReadApp(flask_app)
@@ -0,0 +1,81 @@
+"""Compare the old per-object serialization of GET /api/books with the
+column-tuple serializer and the orjson provider.
+
+    python benchmarks/bench_serialization.py --rows 10000
+
+Checks that both paths produce identical bytes, then prints the time per
+10k rows for each.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('FLASK_ENV', 'development')
+
+
+def legacy_payload(db, Book):
+    """The listing as built before the shared serializer."""
+    return [{
+        "id": book.id,
+        "title": book.title,
+        "author": book.author,
+        "isbn": book.isbn,
+        "publish_date": book.publish_date.strftime('%Y-%m-%d'),
+        "created_at": book.created_at,
+        "updated_at": book.updated_at
+    } for book in Book.query.all()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ['DEV_DATABASE_URI'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+
+    from flask.json.provider import DefaultJSONProvider
+    from api import create_app, db
+    from api.models import Book
+    from api.serializers import BOOK_COLUMNS, serialize_row
+
+    app = create_app('development')
+    app.debug = False  # production responses are compact
+    with app.app_context():
+        db.create_all()
+        db.session.execute(db.insert(Book), [{
+            "title": f"Book {i}",
+            "author": f"Author {i % 500}",
+            "isbn": f"{i:013d}",
+            "publish_date": date(2000 + i % 25, 1 + i % 12, 1 + i % 28)
+        } for i in range(args.rows)])
+        db.session.commit()
+
+        default_provider = DefaultJSONProvider(app)
+        fast_provider = app.json
+
+        def legacy():
+            db.session.expunge_all()
+            return default_provider.response(legacy_payload(db, Book)).get_data()
+
+        def fast():
+            rows = db.session.execute(db.select(*BOOK_COLUMNS).order_by(Book.id))
+            return fast_provider.response([serialize_row(row) for row in rows]).get_data()
+
+        if legacy() != fast():
+            sys.exit("Output differs between the legacy and fast paths")
+
+        scale = 10000 / args.rows
+        for name, fn in (("legacy", legacy), ("fast", fast)):
+            best = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+            print(f"{name:>7}: {best * scale * 1000:8.1f} ms per 10k rows "
+                  f"({type(fast_provider).__name__ if name == 'fast' else 'DefaultJSONProvider'})")
+
+
+if __name__ == '__main__':
+    main()
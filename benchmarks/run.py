@@ -0,0 +1,347 @@
+"""Benchmark every route in api/routes.py and compare against a stored baseline.
+
+    # in-process, through the Flask test client, on SQLite
+    python benchmarks/run.py --rows 10000,100000 --mode client
+
+    # through gunicorn and a threaded HTTP load generator, on a local Postgres
+    python benchmarks/run.py --database-uri postgresql://localhost/books_bench \\
+        --rows 10000,100000,1000000 --mode http --concurrency 16
+
+    # fail (exit 1) if p95 latency or throughput regressed by more than 20%
+    python benchmarks/run.py --rows 10000 --output current.json \\
+        --baseline benchmarks/baseline.json --tolerance 0.2
+
+For each dataset size the database is reseeded (see seed.py). Every
+scenario then reports p50/p95/p99 latency, throughput and peak RSS. The
+numbers are written as JSON (stdout or --output), so a later run can be
+compared with --baseline.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import resource
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from seed import book_row, create_bench_app, seed  # noqa: E402
+
+API_KEY = os.environ.get('API_KEY', 'fake-key')
+
+
+class Scenario:
+    """One route exercised with generated requests.
+
+    `build(rows, n)` returns (method, path, json body or None) for request
+    number n. `max_requests` caps scenarios whose cost grows with the
+    catalog (full listings), so big datasets finish in reasonable time.
+    """
+
+    def __init__(self, name, build, max_requests=None, expect=(200,)):
+        self.name = name
+        self.build = build
+        self.max_requests = max_requests
+        self.expect = expect
+
+
+def _isbn(n, offset):
+    # Outside the seeded range so creates never conflict
+    return f"{9790000000000 + offset + n:013d}"
+
+
+def scenarios(rows):
+    rng = random.Random(42)
+    deep_cursor = {}
+
+    def random_id(_n):
+        return rng.randint(1, rows)
+
+    def search_term(n):
+        return book_row(n)["title"].split()[1].lower()
+
+    return [
+        Scenario("list_all", lambda n: ("GET", "/api/books", None), max_requests=5),
+        Scenario("list_ndjson", lambda n: ("GET", "/api/books?stream=1", None), max_requests=5),
+        Scenario("list_page_first", lambda n: ("GET", "/api/books?limit=100", None)),
+        Scenario("list_page_deep", lambda n: ("GET", deep_cursor.setdefault("url", _deep_page_url(rows)), None)),
+        Scenario("list_filtered_sorted", lambda n: (
+            "GET", f"/api/books?author={quote(book_row(n)['author'])}&sort=-publish_date&limit=50", None)),
+        Scenario("get_book", lambda n: ("GET", f"/api/books/{random_id(n)}", None)),
+        Scenario("search", lambda n: ("GET", f"/api/books/search?q={search_term(n)}&limit=20", None)),
+        Scenario("stats", lambda n: ("GET", "/api/books/stats", None)),
+        Scenario("batch_get", lambda n: ("POST", "/api/books/batch-get", {
+            "ids": [random_id(n) for _ in range(100)]})),
+        Scenario("add_book", lambda n: ("POST", "/api/books", {
+            **_json_row(book_row(n)), "isbn": _isbn(n, 0)}), expect=(201,)),
+        Scenario("update_book", lambda n: ("PUT", f"/api/books/{random_id(n)}", {"title": f"Updated {n}"})),
+        Scenario("add_books_bulk", lambda n: ("POST", "/api/books/bulk", [
+            {**_json_row(book_row(i)), "isbn": _isbn(n * 1000 + i, 10 ** 8)} for i in range(1000)]),
+            max_requests=20),
+        Scenario("upsert_book", lambda n: ("PUT", f"/api/books/isbn/{book_row(random_id(n) - 1)['isbn']}", {
+            "title": f"Upserted {n}", "author": book_row(n)["author"], "publish_date": "2020-01-01"})),
+        Scenario("patch_book", lambda n: ("PATCH", f"/api/books/{random_id(n)}", {"title": f"Patched {n}"})),
+        # The first page of the feed, which the writes above have filled
+        Scenario("changes", lambda n: ("GET", "/api/books/changes?limit=100", None)),
+        Scenario("delete_book", lambda n: ("DELETE", f"/api/books/{rows - n}", None), expect=(204,)),
+    ]
+
+
+def _json_row(row):
+    return {**row, "publish_date": row["publish_date"].isoformat()}
+
+
+def _deep_page_url(rows):
+    # A cursor near the end of the id range: keyset pages should cost the same as the first one
+    from api.pagination import encode_cursor
+    return f"/api/books?limit=100&cursor={encode_cursor({'sort': 'id', 'id': max(rows - 200, 0)})}"
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarize(name, rows, mode, latencies, errors, elapsed, peak_rss_kb):
+    ms = [latency * 1000 for latency in latencies]
+    return {
+        "scenario": name,
+        "rows": rows,
+        "mode": mode,
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": percentile(ms, 50),
+        "p95_ms": percentile(ms, 95),
+        "p99_ms": percentile(ms, 99),
+        "mean_ms": statistics.fmean(ms) if ms else None,
+        "throughput_rps": len(latencies) / elapsed if elapsed else None,
+        "peak_rss_mb": peak_rss_kb / 1024 if peak_rss_kb else None,
+    }
+
+
+# Flask test client
+
+def run_client(app, rows, scenario_list, requests_per_scenario):
+    client = app.test_client()
+    headers = {"X-API-Key": API_KEY}
+    results = []
+    for scenario in scenario_list:
+        count = min(requests_per_scenario, scenario.max_requests or requests_per_scenario)
+        latencies, errors = [], 0
+        started = time.perf_counter()
+        for n in range(count):
+            method, path, body = scenario.build(n)
+            t0 = time.perf_counter()
+            response = client.open(path, method=method, json=body, headers=headers)
+            response.get_data()  # drain streamed bodies
+            latencies.append(time.perf_counter() - t0)
+            errors += response.status_code not in scenario.expect
+        elapsed = time.perf_counter() - started
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KiB on Linux
+        results.append(summarize(scenario.name, rows, "client", latencies, errors, elapsed, peak))
+    return results
+
+
+# Real HTTP through gunicorn
+
+def _process_tree_peak_rss_kb(pid):
+    """Sum of VmHWM (peak RSS) over a process and its children. Linux only."""
+    pids = [pid]
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                pids += [int(child) for child in f.read().split()]
+    except OSError:
+        return None
+    total = 0
+    for process in pids:
+        try:
+            with open(f"/proc/{process}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+        except OSError:
+            continue
+    return total
+
+
+def start_server(database_uri, port, workers):
+    env = {**os.environ, "FLASK_ENV": "production", "DATABASE_URI": database_uri,
+           "GUNICORN_BIND": f"127.0.0.1:{port}", "WEB_CONCURRENCY": str(workers),
+           "METRICS_DIR": tempfile.mkdtemp(prefix="bench-metrics-")}
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/metrics")
+            connection.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("gunicorn did not start")
+
+
+def run_http(host, port, rows, scenario_list, requests_per_scenario, concurrency, server_pid=None):
+    results = []
+    for scenario in scenario_list:
+        count = min(requests_per_scenario, scenario.max_requests or requests_per_scenario)
+        plan = [scenario.build(n) for n in range(count)]
+        latencies, errors = [], [0]
+        lock = threading.Lock()
+        next_index = [0]
+
+        def worker():
+            connection = http.client.HTTPConnection(host, port, timeout=300)
+            while True:
+                with lock:
+                    index = next_index[0]
+                    next_index[0] += 1
+                if index >= len(plan):
+                    break
+                method, path, body = plan[index]
+                headers = {"X-API-Key": API_KEY}
+                payload = None
+                if body is not None:
+                    payload = json.dumps(body)
+                    headers["Content-Type"] = "application/json"
+                t0 = time.perf_counter()
+                try:
+                    connection.request(method, path, body=payload, headers=headers)
+                    response = connection.getresponse()
+                    response.read()
+                    ok = response.status in scenario.expect
+                except (OSError, http.client.HTTPException):
+                    connection.close()
+                    connection = http.client.HTTPConnection(host, port, timeout=300)
+                    ok = False
+                elapsed = time.perf_counter() - t0
+                with lock:
+                    latencies.append(elapsed)
+                    errors[0] += not ok
+            connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(min(concurrency, count) or 1)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        peak = _process_tree_peak_rss_kb(server_pid) if server_pid else None
+        results.append(summarize(scenario.name, rows, "http", latencies, errors[0], elapsed, peak))
+    return results
+
+
+# Baseline comparison
+
+def compare(results, baseline, tolerance):
+    """Return a list of human-readable regressions against `baseline`."""
+    previous = {(r["scenario"], r["rows"], r["mode"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        before = previous.get((result["scenario"], result["rows"], result["mode"]))
+        if not before:
+            continue
+        label = f"{result['scenario']} rows={result['rows']} mode={result['mode']}"
+        if before.get("p95_ms") and result["p95_ms"] and result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{label}: p95 {before['p95_ms']:.2f}ms -> {result['p95_ms']:.2f}ms")
+        if (before.get("throughput_rps") and result["throughput_rps"]
+                and result["throughput_rps"] < before["throughput_rps"] * (1 - tolerance)):
+            regressions.append(f"{label}: throughput {before['throughput_rps']:.1f} -> "
+                               f"{result['throughput_rps']:.1f} req/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-uri', help="defaults to a temporary SQLite file")
+    parser.add_argument('--rows', default="10000", help="comma-separated dataset sizes, e.g. 10000,100000,1000000")
+    parser.add_argument('--mode', choices=("client", "http", "both"), default="client")
+    parser.add_argument('--requests', type=int, default=200, help="requests per scenario")
+    parser.add_argument('--concurrency', type=int, default=8, help="HTTP mode client threads")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="HTTP mode gunicorn workers")
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--scenarios', help="comma-separated subset of scenario names")
+    parser.add_argument('--output', help="write results JSON here instead of stdout")
+    parser.add_argument('--baseline', help="results JSON to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args()
+
+    database_uri = args.database_uri or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    app = create_bench_app(database_uri)
+    from api import db
+    from api.models import Book
+
+    results = []
+    for rows in [int(size) for size in args.rows.split(',')]:
+        with app.app_context():
+            seed(db, Book, rows)
+            db.session.remove()
+        app.extensions['book_cache'].clear()
+        selected = [s for s in scenarios(rows)
+                    if not args.scenarios or s.name in args.scenarios.split(',')]
+
+        if args.mode in ("client", "both"):
+            with app.app_context():
+                results += run_client(app, rows, selected, args.requests)
+            with app.app_context():
+                seed(db, Book, rows)  # writes above changed the data set
+        if args.mode in ("http", "both"):
+            with app.app_context():
+                for engine in db.engines.values():
+                    engine.dispose()
+            server = start_server(database_uri, args.port, args.workers)
+            try:
+                results += run_http("127.0.0.1", args.port, rows, selected,
+                                    args.requests, args.concurrency, server.pid)
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait(timeout=60)
+
+    report = {
+        "meta": {
+            "database": database_uri.split(':', 1)[0],
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "requests_per_scenario": args.requests,
+            "concurrency": args.concurrency,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
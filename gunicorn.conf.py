@@ -0,0 +1,101 @@
+# Gunicorn settings for serving wsgi:app in production.
+#
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#
+# Every setting can be overridden from the environment. Send HUP to the
+# master for a graceful reload: workers finish in-flight requests (up to
+# graceful_timeout) before being replaced. With preload_app the code is
+# loaded once in the master, so picking up new code needs a restart (or
+# USR2 + QUIT for a zero-downtime binary upgrade).
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND", f"0.0.0.0:{os.environ.get('PORT', '80')}")
+
+# Database-bound request handlers spend most of their time waiting on I/O,
+# so run a few threads per process on top of the usual 2 x cores + 1.
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# Change-feed long polls and streams may hold up to CHANGES_MAX_WAITERS of them (see api/changes.py).
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+worker_class = "gthread"
+
+# Import the app once in the master; workers share those pages copy-on-write
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+# Longer than the ALB idle timeout (60s) so the ALB closes idle connections first
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 75))
+# Recycle workers now and then to cap slow memory growth
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 10000))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 1000))
+
+accesslog = "-"
+errorlog = "-"
+
+# Workers write metric snapshots here and /metrics sums them (see api/metrics.py)
+os.environ.setdefault("METRICS_DIR", "/tmp/io-library-metrics")
+# One token bucket per API key shared by all workers (see api/ratelimit.py)
+os.environ.setdefault("RATE_LIMIT_BACKEND", "mmap")
+# Listing and stats responses built once per host, in a file under /dev/shm when there is one (see api/response_cache.py)
+os.environ.setdefault("COLLECTION_CACHE_BACKEND", "sqlite")
+if os.path.isdir("/dev/shm"):
+    os.environ.setdefault("COLLECTION_CACHE_FILE", "/dev/shm/io-library-responses.db")
+
+
+def on_starting(server):
+    """Start every server run with an empty metrics directory and response cache."""
+    import glob
+
+    for path in glob.glob(os.path.join(os.environ["METRICS_DIR"], "*.json")):
+        os.remove(path)
+
+    # The cache file outlives the process; its entries may be for a database that has since been replaced
+    from wsgi import app
+
+    if app.extensions["collection_cache"] is not None:
+        app.extensions["collection_cache"].clear()
+
+
+def when_ready(server):
+    """Create missing tables once, in the master, before any worker starts."""
+    from wsgi import app
+    from api import db
+
+    with app.app_context():
+        db.create_all()
+        # Don't let workers inherit the master's connections
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+def worker_exit(server, worker):
+    """Write the exiting worker's last metrics, so child_exit retires its final totals."""
+    from wsgi import app
+
+    metrics = app.extensions["metrics"]
+    if metrics.directory:
+        with app.app_context():
+            metrics.flush()
+
+
+def child_exit(server, worker):
+    """Fold an exited worker's metrics into the retired totals (see api/metrics.py)."""
+    from api.metrics import retire
+
+    retire(os.environ["METRICS_DIR"], worker.pid)
+
+
+def post_fork(server, worker):
+    """Give each worker a fresh connection pool.
+
+    Connections opened in the master (e.g. while preloading) must not be
+    shared across processes; close=False drops them from this worker's pool
+    without closing the parent's sockets.
+    """
+    from wsgi import app
+    from api import db
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
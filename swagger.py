@@ -1,15 +1,17 @@
 from flasgger import Swagger
-import os
-from setup_public_ip import get_public_ip
+from flask import request
+import setup_public_ip
+
 
 def init_swagger(app):
-    if os.getenv('FLASK_ENV') != "development": # dirty fix @TODO
-        """Initialize Swagger with the given Flask app."""
-        # Try to get the public IP from the function or fallback to environment variable/default
-        public_ip = get_public_ip() or os.getenv("PUBLIC_IP", "127.0.0.1")
-    else:
-        public_ip = "127.0.0.1"
+    """Initialize Swagger with the given Flask app.
 
+    Never does network I/O at startup. The spec's host comes from
+    SWAGGER_HOST (or PUBLIC_IP) when configured. With SWAGGER_USE_IMDS it is
+    looked up from EC2 instance metadata on the first /apidocs spec request
+    and cached. Otherwise it is left out, and Swagger UI uses the host the
+    docs were served from (the request's Host header).
+    """
     swagger_template = {
         "swagger": "2.0",
         "info": {
@@ -17,7 +19,6 @@ def init_swagger(app):
             "description": "API for managing a library of books.",
             "version": "1.0.0"
         },
-        "host": f"{public_ip}:80",  # Use the public IP dynamically
         "basePath": "/api",  # Set base path for API
         "tags": [  # Define API tags
             {
@@ -39,6 +40,22 @@ def init_swagger(app):
             }
         ]
     }
+    if app.config.get("SWAGGER_HOST"):
+        swagger_template["host"] = app.config["SWAGGER_HOST"]
+
+    swagger = Swagger(app, template=swagger_template)
+
+    if "host" not in swagger_template and app.config.get("SWAGGER_USE_IMDS"):
+        resolved = []
 
+        @app.before_request
+        def resolve_swagger_host():
+            # Only the docs need the host; look it up once, on first use
+            if resolved or request.blueprint != "flasgger":
+                return
+            resolved.append(True)
+            public_ip = setup_public_ip.get_public_ip()
+            if public_ip:
+                swagger.template["host"] = f"{public_ip}:80"
 
-    Swagger(app, template=swagger_template)
\ No newline at end of file
+    return swagger
@@ -45,6 +45,7 @@ echo "export DATABASE_URI=$DATABASE_URI" >> /etc/profile
 # Apply the environment variables
 source /etc/profile
 
-# Start application & keep logs in a file, TODO prd sever
+# Start application under gunicorn & keep logs in a file
 echo "starting application........"
-nohup python3 main.py > /var/log/io-library-app.log 2>&1 & 
\ No newline at end of file
+export FLASK_ENV=production
+nohup gunicorn -c gunicorn.conf.py wsgi:app > /var/log/io-library-app.log 2>&1 & 
\ No newline at end of file
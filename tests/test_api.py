@@ -1,3 +1,6 @@
+import asyncio
+import json
+import os
 import unittest
 from unittest.mock import patch
 from main import app, db
@@ -12,6 +15,9 @@ class TestBookAPI(unittest.TestCase):
             # Drop and recreate all tables to ensure a clean state for each test
             db.drop_all()
             db.create_all()
+        app.extensions['book_cache'].clear()
+        app.extensions['rate_limiter'].clear()
+        app.extensions['collection_cache'].clear()
 
         # Mocking get_public_ip to return a dummy IP during tests
         patch('setup_public_ip.get_public_ip', return_value='127.0.0.1').start()
@@ -102,6 +108,20 @@ class TestBookAPI(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertIn('error', response.json)  # Ensure error is returned
 
+    def test_book_fields_validated_before_writing(self):
+        """Test that column constraints are checked up front, not reported as ISBN conflicts."""
+        book = {"title": None, "author": "Author", "isbn": "1234567890123", "publish_date": "2024-01-01"}
+        response = self.app.post('/api/books', json=book, headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['error'], "title must be a string of 1 to 100 characters.")
+        response = self.app.put('/api/books/isbn/1234567890123', json=book, headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.status_code, 400)
+        book["title"] = "Valid Title"
+        book_id = self.app.post('/api/books', json=book, headers={"X-API-Key": "fake-key"}).json['id']
+        response = self.app.patch(f'/api/books/{book_id}', json={"author": "x" * 101},
+                                  headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.status_code, 400)
+
     # Edge Case 3: Adding a Book with a Duplicate ISBN
     def test_add_book_duplicate_isbn(self):
         """Test adding a book with a duplicate ISBN."""
@@ -125,5 +145,954 @@ class TestBookAPI(unittest.TestCase):
         self.assertIn('error', response.json)  # Ensure error is returned
         self.assertIn('ISBN already exists', response.json['error'])
 
+    def test_get_books_paginated(self):
+        """Test walking the collection with ?limit= and the next cursor."""
+        for i in range(3):
+            self.app.post('/api/books', json={
+                "title": f"Paged Book {i}",
+                "author": "Author Name",
+                "isbn": f"555000000000{i}",
+                "publish_date": "2024-01-01"
+            }, headers={"X-API-Key": "fake-key"})
+
+        response = self.app.get('/api/books?limit=2', headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json['books']), 2)
+        self.assertIsNotNone(response.json['next'])
+
+        response = self.app.get(response.json['next'], headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([b['title'] for b in response.json['books']], ["Paged Book 2"])
+        self.assertIsNone(response.json['next'])
+
+    def test_get_books_invalid_cursor(self):
+        """Test that a malformed cursor is rejected."""
+        response = self.app.get('/api/books?cursor=not-a-cursor', headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json)
+
+    def test_get_books_forged_cursor(self):
+        """Test that cursors whose id is not a plain in-range integer are rejected."""
+        from api.pagination import encode_cursor
+        for position in ({"id": True}, {"id": 2 ** 64}, {"id": 1.5}):
+            response = self.app.get('/api/books', query_string={"cursor": encode_cursor(position)},
+                                    headers={"X-API-Key": "fake-key"})
+            self.assertEqual(response.status_code, 400, position)
+
+    def test_get_books_ndjson_stream(self):
+        """Test streaming the collection as NDJSON."""
+        for i in range(2):
+            self.app.post('/api/books', json={
+                "title": f"Streamed Book {i}",
+                "author": "Author Name",
+                "isbn": f"666000000000{i}",
+                "publish_date": "2024-01-01"
+            }, headers={"X-API-Key": "fake-key"})
+
+        response = self.app.get('/api/books', headers={"X-API-Key": "fake-key",
+                                                       "Accept": "application/x-ndjson"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line)['title'] for line in lines],
+                         ["Streamed Book 0", "Streamed Book 1"])
+
+    def test_add_books_bulk(self):
+        """Test bulk creation with created, conflict and invalid items."""
+        self.app.post('/api/books', json={
+            "title": "Existing Book",
+            "author": "Author Name",
+            "isbn": "7770000000000",
+            "publish_date": "2024-01-01"
+        }, headers={"X-API-Key": "fake-key"})
+
+        response = self.app.post('/api/books/bulk', json=[
+            {"title": "Bulk Book", "author": "Author Name", "isbn": "7770000000001", "publish_date": "2024-01-01"},
+            {"title": "Existing Book", "author": "Author Name", "isbn": "7770000000000", "publish_date": "2024-01-01"},
+            {"title": "Bad Book", "author": "Author Name", "isbn": "invalidisbn", "publish_date": "2024-01-01"},
+            {"title": "Bulk Book Again", "author": "Author Name", "isbn": "7770000000001", "publish_date": "2024-01-01"},
+            {"title": None, "author": "Author Name", "isbn": "7770000000002", "publish_date": "2024-01-01"},
+            {"title": "Long Author", "author": "x" * 101, "isbn": "7770000000003", "publish_date": "2024-01-01"},
+        ], headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['status'] for r in response.json['results']],
+                         ["created", "conflict", "invalid", "conflict", "invalid", "invalid"])
+        self.assertEqual(response.json['created'], 1)
+        self.assertEqual(response.json['results'][4]['error'], "title must be a string of 1 to 100 characters.")
+
+        book_id = response.json['results'][0]['id']
+        response = self.app.get(f'/api/books/{book_id}', headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.json['title'], "Bulk Book")
+
+    def test_search_books(self):
+        """Test that search is ranked, prefix-aware and follows updates and deletes."""
+        ids = []
+        for i, (title, author) in enumerate([("The Hobbit", "J. R. R. Tolkien"),
+                                             ("Silmarillion", "Tolkien"),
+                                             ("Dune", "Frank Herbert")]):
+            response = self.app.post('/api/books', json={
+                "title": title,
+                "author": author,
+                "isbn": f"888000000000{i}",
+                "publish_date": "2024-01-01"
+            }, headers={"X-API-Key": "fake-key"})
+            ids.append(response.json['id'])
+
+        response = self.app.get('/api/books/search?q=tolk', headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(b['id'] for b in response.json['books']), ids[:2])
+
+        self.app.put(f'/api/books/{ids[2]}', json={"title": "Dune Messiah"}, headers={"X-API-Key": "fake-key"})
+        response = self.app.get('/api/books/search?q=messiah', headers={"X-API-Key": "fake-key"})
+        self.assertEqual([b['id'] for b in response.json['books']], [ids[2]])
+
+        self.app.delete(f'/api/books/{ids[0]}', headers={"X-API-Key": "fake-key"})
+        response = self.app.get('/api/books/search?q=tolkien&limit=1', headers={"X-API-Key": "fake-key"})
+        self.assertEqual([b['id'] for b in response.json['books']], [ids[1]])
+        self.assertIsNone(response.json['next'])
+
+    def test_search_cursor_depth_capped(self):
+        """Test that search cursors stop at MAX_SEARCH_OFFSET and forged deeper ones are rejected."""
+        from api import search
+        from api.pagination import encode_cursor
+        headers = {"X-API-Key": "fake-key"}
+        self.app.post('/api/books/bulk', json=[
+            {"title": f"Deep {i}", "author": "A", "isbn": f"978000000000{i}", "publish_date": "2020-01-01"}
+            for i in range(1, 4)
+        ], headers=headers)
+        forged = encode_cursor({"offset": 10 ** 30})
+        response = self.app.get('/api/books/search', query_string={"q": "deep", "cursor": forged}, headers=headers)
+        self.assertEqual(response.status_code, 400)
+        with patch.object(search, 'MAX_SEARCH_OFFSET', 1):
+            first = self.app.get('/api/books/search?q=deep&limit=1', headers=headers).json
+            self.assertIsNotNone(first['next'])
+            last = self.app.get(first['next'], headers=headers).json
+            self.assertEqual(len(last['books']), 1)
+            self.assertIsNone(last['next'])  # more match, but paging deeper is refused
+            cursor = encode_cursor({"offset": 2})
+            response = self.app.get('/api/books/search', query_string={"q": "deep", "cursor": cursor}, headers=headers)
+            self.assertEqual(response.status_code, 400)
+
+    def test_search_books_missing_query(self):
+        """Test that a search without terms is rejected."""
+        response = self.app.get('/api/books/search?q=%22%2A', headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_books_filtered_and_sorted(self):
+        """Test author/date filters combined with a descending sorted keyset walk."""
+        for i, (title, author, published) in enumerate([("Alpha", "Ann", "2020-01-01"),
+                                                        ("Bravo", "Ann", "2021-06-01"),
+                                                        ("Charlie", "Ann", "2023-03-01"),
+                                                        ("Delta", "Bob", "2022-01-01")]):
+            self.app.post('/api/books', json={
+                "title": title,
+                "author": author,
+                "isbn": f"999000000000{i}",
+                "publish_date": published
+            }, headers={"X-API-Key": "fake-key"})
+
+        response = self.app.get('/api/books?author=Ann&published_after=2021-01-01&sort=-title',
+                                headers={"X-API-Key": "fake-key"})
+        self.assertEqual([b['title'] for b in response.json], ["Charlie", "Bravo"])
+
+        titles = []
+        url = '/api/books?author=Ann&sort=-publish_date&limit=1'
+        while url:
+            response = self.app.get(url, headers={"X-API-Key": "fake-key"})
+            self.assertEqual(response.status_code, 200)
+            titles += [b['title'] for b in response.json['books']]
+            url = response.json['next']
+        self.assertEqual(titles, ["Charlie", "Bravo", "Alpha"])
+
+        response = self.app.get('/api/books?sort=isbn', headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.status_code, 400)
+        response = self.app.get('/api/books?sort=--title', headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.status_code, 400)
+        response = self.app.get('/api/books?updated_since=2024-01-01T00:00:00Z', headers={"X-API-Key": "fake-key"})
+        self.assertEqual(len(response.json), 4)
+
+    def test_get_book_cache(self):
+        """Test that repeated reads hit the cache and writes invalidate it."""
+        response = self.app.post('/api/books', json={
+            "title": "Cached Book",
+            "author": "Author Name",
+            "isbn": "4440000000000",
+            "publish_date": "2024-01-01"
+        }, headers={"X-API-Key": "fake-key"})
+        book_id = response.json['id']
+        cache = app.extensions['book_cache']
+
+        self.app.get(f'/api/books/{book_id}', headers={"X-API-Key": "fake-key"})
+        hits = cache.hits
+        response = self.app.get(f'/api/books/{book_id}', headers={"X-API-Key": "fake-key"})
+        self.assertEqual(cache.hits, hits + 1)
+
+        self.app.put(f'/api/books/{book_id}', json={"title": "Renamed Book"}, headers={"X-API-Key": "fake-key"})
+        response = self.app.get(f'/api/books/{book_id}', headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.json['title'], "Renamed Book")
+
+        self.app.delete(f'/api/books/{book_id}', headers={"X-API-Key": "fake-key"})
+        response = self.app.get(f'/api/books/{book_id}', headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.status_code, 404)
+
+        response = self.app.get('/api/instrumentation/cache', headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('evictions', response.json)
+
+    def test_conditional_get(self):
+        """Test ETag / If-None-Match on a book and on the collection."""
+        response = self.app.post('/api/books', json={
+            "title": "Polled Book",
+            "author": "Author Name",
+            "isbn": "3330000000000",
+            "publish_date": "2024-01-01"
+        }, headers={"X-API-Key": "fake-key"})
+        book_id = response.json['id']
+
+        response = self.app.get(f'/api/books/{book_id}', headers={"X-API-Key": "fake-key"})
+        etag = response.headers['ETag']
+        response = self.app.get(f'/api/books/{book_id}', headers={"X-API-Key": "fake-key",
+                                                                  "If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.app.get('/api/books', headers={"X-API-Key": "fake-key"})
+        collection_etag = response.headers['ETag']
+        response = self.app.get('/api/books', headers={"X-API-Key": "fake-key",
+                                                       "If-None-Match": collection_etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.app.put(f'/api/books/{book_id}', json={"title": "Renamed"}, headers={"X-API-Key": "fake-key"})
+        response = self.app.get(f'/api/books/{book_id}', headers={"X-API-Key": "fake-key",
+                                                                  "If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        response = self.app.get('/api/books', headers={"X-API-Key": "fake-key",
+                                                       "If-None-Match": collection_etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_serialization_matches_default_provider(self):
+        """Test the shared serializer and JSON provider produce the same bytes as before."""
+        from flask.json.provider import DefaultJSONProvider
+        from api.serializers import BOOK_COLUMNS, serialize_row
+
+        for i, title in enumerate(["Plain Title", "Caf\u00e9 \u00fcber alles"]):
+            self.app.post('/api/books', json={
+                "title": title,
+                "author": "Author Name",
+                "isbn": f"222000000000{i}",
+                "publish_date": "2024-01-01"
+            }, headers={"X-API-Key": "fake-key"})
+
+        with app.app_context():
+            legacy = [{
+                "id": book.id,
+                "title": book.title,
+                "author": book.author,
+                "isbn": book.isbn,
+                "publish_date": book.publish_date.strftime('%Y-%m-%d'),
+                "created_at": book.created_at,
+                "updated_at": book.updated_at
+            } for book in Book.query.order_by(Book.id)]
+            rows = db.session.execute(db.select(*BOOK_COLUMNS).order_by(Book.id))
+            fast = [serialize_row(row) for row in rows]
+            for compact in (True, False):
+                default_provider = DefaultJSONProvider(app)
+                default_provider.compact = compact
+                app.json.compact = compact
+                try:
+                    self.assertEqual(app.json.response(fast).get_data(),
+                                     default_provider.response(legacy).get_data())
+                finally:
+                    app.json.compact = None
+
+    def test_swagger_host_resolved_lazily(self):
+        """Test that app creation never calls IMDS and the spec host is looked up on first use."""
+        from api import create_app
+        with patch('setup_public_ip.get_public_ip', side_effect=AssertionError("IMDS called")):
+            docs_app = create_app('acceptance')
+        response = docs_app.test_client().get('/apispec_1.json')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('host', response.json)
+
+        with patch('setup_public_ip.get_public_ip', return_value='10.0.0.1') as imds:
+            from api.config import AcceptanceConfig
+            with patch.object(AcceptanceConfig, 'SWAGGER_USE_IMDS', True):
+                docs_app = create_app('acceptance')
+            imds.assert_not_called()
+            client = docs_app.test_client()
+            client.get('/apispec_1.json')
+            response = client.get('/apispec_1.json')
+            self.assertEqual(response.json['host'], '10.0.0.1:80')
+            imds.assert_called_once()
+
+    def test_pool_stats(self):
+        """Test the connection pool instrumentation endpoint."""
+        self.app.get('/api/books', headers={"X-API-Key": "fake-key"})
+        response = self.app.get('/api/instrumentation/pool', headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(response.json['checkouts'], 0)
+        self.assertIn('overflow', response.json)
+        self.assertIn('checkout_wait_seconds_total', response.json)
+
+    def test_asgi_read_path_matches_flask(self):
+        """Test the async read endpoints return the same responses as the Flask routes."""
+        from api.asgi import AsyncReadApp
+
+        for i, title in enumerate(["Async One", "Async Two", "Async Three"]):
+            response = self.app.post('/api/books', json={
+                "title": title,
+                "author": "Author Name",
+                "isbn": f"111000000000{i}",
+                "publish_date": "2024-01-01"
+            }, headers={"X-API-Key": "fake-key"})
+        book_id = response.json['id']
+
+        paths = [('/api/books', ''),
+                 ('/api/books', 'limit=2&sort=-title'),
+                 (f'/api/books/{book_id}', ''),
+                 ('/api/books/999999', ''),
+                 ('/api/books/search', 'q=async&limit=1'),
+                 ('/api/books', 'sort=bogus')]
+
+        async def fetch_all(asgi_app):
+            results = []
+            for path, query in paths + [('/api/books', '')]:
+                headers = [(b'x-api-key', b'fake-key')]
+                if query == '' and path == '/api/books' and results:
+                    headers = [(b'x-api-key', b'invalid-api-key')]
+                messages = []
+
+                async def receive():
+                    return {"type": "http.request", "body": b"", "more_body": False}
+
+                async def send(message):
+                    messages.append(message)
+
+                await asgi_app({"type": "http", "method": "GET", "path": path, "root_path": "",
+                                "query_string": query.encode(), "headers": headers,
+                                "http_version": "1.1", "scheme": "http"}, receive, send)
+                results.append((messages[0]['status'], b''.join(m.get('body', b'') for m in messages[1:])))
+            await asgi_app.engine.dispose()
+            return results
+
+        results = asyncio.run(fetch_all(AsyncReadApp(app)))
+        for (path, query), (status, body) in zip(paths, results):
+            expected = self.app.get(f'{path}?{query}', headers={"X-API-Key": "fake-key"})
+            self.assertEqual((status, json.loads(body)), (expected.status_code, expected.json), path)
+        self.assertEqual(results[-1][0], 401)
+
+    def test_metrics(self):
+        """Test /metrics is unauthenticated and reports per-endpoint latency and SQL counts."""
+        self.app.get('/api/books', headers={"X-API-Key": "fake-key"})
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        body = response.get_data(as_text=True)
+        self.assertIn('http_request_duration_seconds_count{endpoint="api.get_books",method="GET",status="200"}', body)
+        self.assertIn('http_request_db_statements_sum{endpoint="api.get_books"}', body)
+
+        # Failed statements don't leave timing state behind on the pooled connection
+        with app.app_context(), db.engine.connect() as connection:
+            for _ in range(3):
+                with self.assertRaises(Exception):
+                    connection.exec_driver_sql("SELECT * FROM no_such_table")
+            self.assertEqual(connection.info['metrics_query_start'], {})
+
+    def test_metrics_aggregate_workers(self):
+        """Test snapshots from several workers are summed, dropping gauges of exited workers."""
+        from api.metrics import render
+        series = [["api.get_book", "GET", "200"], [1] + [0] * 10 + [0.004, 1]]
+        snapshots = [
+            {"pid": os.getpid(), "histograms": {"http_request_duration_seconds": [series]},
+             "gauges": {"db_pool_checked_out": 2}, "counters": {"db_pool_checkouts_total": 5}},
+            {"pid": 2 ** 22 + 1, "histograms": {"http_request_duration_seconds": [series]},
+             "gauges": {"db_pool_checked_out": 3}, "counters": {"db_pool_checkouts_total": 7}},
+        ]
+        body = render(snapshots)
+        self.assertIn('http_request_duration_seconds_count{endpoint="api.get_book",method="GET",status="200"} 2', body)
+        self.assertIn('db_pool_checked_out 2\n', body)
+        self.assertIn('db_pool_checkouts_total 12\n', body)
+
+    def test_metrics_retire_worker(self):
+        """Test an exited worker's snapshots are folded into retired.json and their files removed."""
+        import tempfile
+        from api.metrics import Metrics, render, retire
+        series = [["api.get_book", "GET", "200"], [1] + [0] * 10 + [0.004, 1]]
+        dead = 2 ** 22 + 1
+        with tempfile.TemporaryDirectory() as tmp, patch.dict(app.config, {"METRICS_DIR": tmp}):
+            metrics = Metrics(app)
+            for i in range(2):  # e.g. successive workers that got the same pid
+                with open(os.path.join(tmp, f"{dead}-{i}.json"), 'w') as f:
+                    json.dump({"pid": dead, "histograms": {"http_request_duration_seconds": [series]},
+                               "gauges": {"db_pool_checked_out": 3}, "counters": {"db_pool_checkouts_total": 7}}, f)
+
+            def others():
+                with app.app_context():
+                    return render([s for s in metrics.collect() if s.get("pid") != os.getpid()])
+
+            before = others()
+            self.assertIn('http_request_duration_seconds_count{endpoint="api.get_book",method="GET",status="200"} 2',
+                          before)
+            self.assertIn('db_pool_checkouts_total 14\n', before)
+            retire(tmp, dead)
+            retire(tmp, dead)  # nothing left to fold
+            self.assertEqual(sorted(os.listdir(tmp)), sorted(["retired.json", os.path.basename(metrics._path)]))
+            self.assertEqual(others(), before)
+
+    def test_benchmark_smoke(self):
+        """Test the benchmark runner on a tiny data set and its baseline regression check."""
+        import subprocess
+        import sys
+        import tempfile
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'results.json')
+            command = [sys.executable, os.path.join(root, 'benchmarks', 'run.py'), '--rows', '50',
+                       '--requests', '3', '--database-uri', f"sqlite:///{os.path.join(tmp, 'bench.db')}"]
+            subprocess.run(command + ['--output', output], check=True, capture_output=True)
+            with open(output) as f:
+                results = json.load(f)["results"]
+            self.assertIn("get_book", {r["scenario"] for r in results})
+            self.assertEqual(sum(r["errors"] for r in results), 0)
+
+            for r in results:
+                r["throughput_rps"] *= 1000
+            with open(output, 'w') as f:
+                json.dump({"results": results}, f)
+            regressed = subprocess.run(command + ['--scenarios', 'get_book', '--baseline', output],
+                                       capture_output=True, text=True)
+            self.assertEqual(regressed.returncode, 1)
+            self.assertIn("REGRESSION get_book", regressed.stderr)
+
+    def test_import_cli(self):
+        """Test `flask books import` loads valid rows, skips existing ISBNs, reports rejects and resumes."""
+        import tempfile
+        from api.importer import Checkpoint
+        self.app.post('/api/books', json={"title": "Existing", "author": "A", "isbn": "9780000000002",
+                                          "publish_date": "2020-01-01"}, headers={"X-API-Key": "fake-key"})
+        runner = app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'books.ndjson')
+            with open(path, 'w') as f:
+                f.write('{"title": "Skipped On Resume", "author": "A", "isbn": "9780000000001", "publish_date": "2020-01-01"}\n')
+                f.write('{"title": "Existing Again", "author": "A", "isbn": "9780000000002", "publish_date": "2020-01-01"}\n')
+                f.write('{"title": "Lantern Tales", "author": "B", "isbn": "9780000000003", "publish_date": "2021-02-03"}\n')
+                f.write('{"title": "Bad", "author": "B", "isbn": "123", "publish_date": "2021-02-03"}\n')
+                f.write('not json\n')
+            Checkpoint(f"{path}.checkpoint", path).save(1)  # as if interrupted after the first record
+            rejects = os.path.join(tmp, 'rejects.ndjson')
+            result = runner.invoke(args=['books', 'import', path, '--batch-size', '1', '--rejects', rejects])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Imported 1 books", result.output)
+            self.assertFalse(os.path.exists(f"{path}.checkpoint"))
+            with open(rejects) as f:
+                self.assertEqual([json.loads(line)["record"] for line in f], [4, 5])
+
+        books = self.app.get('/api/books', headers={"X-API-Key": "fake-key"}).json
+        self.assertEqual(sorted(book["isbn"] for book in books), ["9780000000002", "9780000000003"])
+        found = self.app.get('/api/books/search?q=lantern', headers={"X-API-Key": "fake-key"}).json
+        self.assertEqual([book["isbn"] for book in found["books"]], ["9780000000003"])
+        changes = self.app.get('/api/books/changes', headers={"X-API-Key": "fake-key"}).json["changes"]
+        self.assertEqual([(c["op"], c["book"]["isbn"]) for c in changes],
+                         [("insert", "9780000000002"), ("insert", "9780000000003")])
+        stats = self.app.get('/api/books/stats', headers={"X-API-Key": "fake-key"}).json
+        self.assertEqual((stats["total"], stats["by_year"][-1]), (2, {"year": 2021, "books": 1}))
+
+    def test_upsert_book_by_isbn(self):
+        """Test PUT /books/isbn/<isbn> creates, then replaces, the same book and can be replayed."""
+        headers = {"X-API-Key": "fake-key"}
+        body = {"title": "Upserted", "author": "A", "publish_date": "2020-01-01"}
+        response = self.app.put('/api/books/isbn/9780000000001', json=body, headers=headers)
+        self.assertEqual(response.status_code, 201)
+        book_id = response.json["id"]
+        self.assertEqual(response.headers["Location"], f"/api/books/{book_id}")
+
+        self.app.get(f'/api/books/{book_id}', headers=headers)  # cache it
+        for _ in range(2):
+            response = self.app.put('/api/books/isbn/9780000000001', json={**body, "title": "Replaced"},
+                                    headers=headers)
+            self.assertEqual((response.status_code, response.json["id"]), (200, book_id))
+        book = self.app.get(f'/api/books/{book_id}', headers=headers)
+        self.assertEqual(book.json["title"], "Replaced")
+        self.assertEqual(book.headers["ETag"], response.headers["ETag"])
+
+        response = self.app.put('/api/books/isbn/9780000000001', json={**body, "isbn": "9780000000002"},
+                                headers=headers)
+        self.assertEqual(response.status_code, 400)
+        response = self.app.put('/api/books/isbn/123', json=body, headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_conditional_patch_and_delete(self):
+        """Test If-Match on PATCH/DELETE: stale ETags get 412 and invalid input changes nothing."""
+        headers = {"X-API-Key": "fake-key"}
+        book_id = self.app.post('/api/books', json={"title": "Original", "author": "A", "isbn": "9780000000001",
+                                                    "publish_date": "2020-01-01"}, headers=headers).json["id"]
+        etag = self.app.get(f'/api/books/{book_id}', headers=headers).headers["ETag"]
+
+        response = self.app.patch(f'/api/books/{book_id}', json={"title": "Half", "publish_date": "bad"},
+                                  headers=headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.app.get(f'/api/books/{book_id}', headers=headers).json["title"], "Original")
+
+        response = self.app.patch(f'/api/books/{book_id}', json={"title": "First editor"},
+                                  headers={**headers, "If-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        new_etag = response.headers["ETag"]
+        self.assertNotEqual(new_etag, etag)
+
+        response = self.app.patch(f'/api/books/{book_id}', json={"title": "Second editor"},
+                                  headers={**headers, "If-Match": etag})
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(self.app.get(f'/api/books/{book_id}', headers=headers).json["title"], "First editor")
+
+        self.assertEqual(self.app.delete(f'/api/books/{book_id}', headers={**headers, "If-Match": etag}).status_code, 412)
+        self.assertEqual(self.app.delete(f'/api/books/{book_id}', headers={**headers, "If-Match": new_etag}).status_code, 204)
+        self.assertEqual(self.app.patch(f'/api/books/{book_id}', json={"title": "Gone"}, headers=headers).status_code, 404)
+        self.assertEqual(self.app.delete(f'/api/books/{book_id}', headers=headers).status_code, 404)
+
+    def test_rate_limit_per_key(self):
+        """Test hashed extra keys, per-key token buckets, 429 with Retry-After and RateLimit headers."""
+        from api.auth import configure_auth, hash_api_key
+        with patch.dict(app.config, {"API_KEY_HASHES": f"sync:{hash_api_key('sync-key')}:1:2"}), \
+                patch.dict(app.extensions):
+            configure_auth(app)
+            self.assertEqual(self.app.get('/api/books', headers={"X-API-Key": "wrong"}).status_code, 401)
+            responses = [self.app.get('/api/books', headers={"X-API-Key": "sync-key"}) for _ in range(3)]
+            self.assertEqual([r.status_code for r in responses], [200, 200, 429])
+            self.assertEqual(responses[0].headers["RateLimit-Limit"], "2")
+            self.assertEqual(responses[1].headers["RateLimit-Remaining"], "0")
+            self.assertEqual(responses[2].headers["Retry-After"], "1")
+            # Other keys have their own bucket
+            self.assertEqual(self.app.get('/api/books', headers={"X-API-Key": "fake-key"}).status_code, 200)
+
+    def test_rate_limit_mmap_backend_is_shared(self):
+        """Test two mmap backends on the same file (as two workers would) draw from one bucket."""
+        import tempfile
+        from api.ratelimit import MmapBackend
+        with tempfile.TemporaryDirectory() as tmp:
+            config = {"RATE_LIMIT_FILE": os.path.join(tmp, "ratelimit")}
+            first, second = MmapBackend(["a", "b"], config), MmapBackend(["a", "b"], config)
+            self.assertEqual(first.take(0, 1, 2, now=100.0), (True, 1.0))
+            self.assertEqual(second.take(0, 1, 2, now=100.0), (True, 0.0))
+            self.assertEqual(first.take(0, 1, 2, now=100.0)[0], False)
+            self.assertEqual(second.take(1, 1, 2, now=100.0), (True, 1.0))
+            self.assertEqual(first.take(0, 1, 2, now=101.5), (True, 0.5))
+
+    def test_export_job(self):
+        """Test an export runs in the background and its gzip CSV snapshot can be downloaded."""
+        import csv
+        import gzip
+        import tempfile
+        import time
+        headers = {"X-API-Key": "fake-key"}
+        self.app.post('/api/books', json={"title": "Exported", "author": "A", "isbn": "9780000000001",
+                                          "publish_date": "2020-01-01"}, headers=headers)
+        self.assertEqual(self.app.post('/api/exports', json={"format": "xml"}, headers=headers).status_code, 400)
+        for body in ([1], "csv", []):
+            self.assertEqual(self.app.post('/api/exports', json=body, headers=headers).status_code, 400)
+        self.assertEqual(self.app.get('/api/exports/missing', headers=headers).status_code, 404)
+
+        with tempfile.TemporaryDirectory() as tmp, patch.object(app.extensions['exports'], 'directory', tmp):
+            response = self.app.post('/api/exports', json={"format": "csv"}, headers=headers)
+            self.assertEqual(response.status_code, 202)
+            deadline = time.time() + 60
+            while True:
+                job = self.app.get(response.headers['Location'], headers=headers).json
+                if job["status"] in ("done", "failed") or time.time() > deadline:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(job["status"], "done", job)
+            self.assertEqual(job["rows"], 1)
+
+            download = self.app.get(job["download"], headers=headers)
+            self.assertEqual(download.status_code, 200)
+            self.assertEqual(download.mimetype, 'application/gzip')
+            rows = list(csv.DictReader(gzip.decompress(download.get_data()).decode().splitlines()))
+            self.assertEqual([(row["isbn"], row["title"]) for row in rows], [("9780000000001", "Exported")])
+
+    def test_export_snapshot_matches_catalog_version(self):
+        """Test a write landing while an export reads its rows is neither in the file nor in its catalog_version."""
+        import tempfile
+        from api import exports
+        from api.models import ExportJob
+        headers = {"X-API-Key": "fake-key"}
+        book = {"author": "A", "publish_date": "2020-01-01"}
+        self.app.post('/api/books', json={**book, "title": "Before", "isbn": "9780000000001"}, headers=headers)
+        with app.app_context():
+            db.session.add(ExportJob(id="snapshot", format="ndjson", compression="gzip"))
+            db.session.commit()
+            database_uri = db.engine.url.render_as_string(hide_password=False)
+
+        real_select = exports.select
+
+        def select_after_write(*columns):
+            # Commit a write between the catalog version read and the SELECT of the rows
+            if columns and columns[0] is exports.BOOK_COLUMNS[0]:
+                self.app.post('/api/books', json={**book, "title": "During", "isbn": "9780000000002"},
+                              headers=headers)
+            return real_select(*columns)
+
+        with tempfile.TemporaryDirectory() as tmp, patch.object(exports, 'select', select_after_write):
+            exports.run_export(database_uri, "snapshot", tmp, 100)
+        with app.app_context():
+            job = db.session.get(ExportJob, "snapshot")
+            self.assertEqual(job.status, "done")
+            self.assertEqual(job.rows, 1)
+            self.assertEqual(job.catalog_version, 1)
+        changes = self.app.get(f'/api/books/changes?since={job.catalog_version}', headers=headers).json
+        self.assertEqual([change["book"]["title"] for change in changes["changes"]], ["During"])
+
+    def test_compressed_listing_cache(self):
+        """Test large listings are gzipped with a weak ETag and served from the collection cache."""
+        import gzip
+        headers = {"X-API-Key": "fake-key"}
+        self.app.post('/api/books/bulk', json=[
+            {"title": f"Compressible Book {i}", "author": "Author Name", "isbn": f"97800000001{i:02d}",
+             "publish_date": "2020-01-01"} for i in range(30)
+        ], headers=headers)
+        plain = self.app.get('/api/books', headers=headers)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        response = self.app.get('/api/books', headers={**headers, "Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(response.headers['ETag'].startswith('W/'))
+        self.assertEqual(json.loads(gzip.decompress(response.get_data())), plain.json)
+        self.assertEqual(self.app.get('/api/books', headers={**headers, "Accept-Encoding": "gzip",
+                                                             "If-None-Match": response.headers['ETag']}).status_code, 304)
+
+        cache = app.extensions['collection_cache']
+        hits = cache.stats()["hits"]
+        again = self.app.get('/api/books', headers={**headers, "Accept-Encoding": "gzip"})
+        self.assertEqual(cache.stats()["hits"], hits + 1)
+        self.assertEqual(again.get_data(), response.get_data())
+        self.assertIn('RateLimit-Remaining', again.headers)
+
+        # A write changes the collection ETag, so the cached bytes are not reused
+        self.app.post('/api/books', json={"title": "Newest", "author": "Author Name", "isbn": "9780000000199",
+                                          "publish_date": "2020-01-01"}, headers=headers)
+        fresh = self.app.get('/api/books', headers={**headers, "Accept-Encoding": "gzip"})
+        self.assertNotEqual(fresh.headers['ETag'], response.headers['ETag'])
+        self.assertEqual(len(json.loads(gzip.decompress(fresh.get_data()))), 31)
+
+        # Small bodies are sent as is
+        small = self.app.get('/api/books?limit=1', headers={**headers, "Accept-Encoding": "gzip"})
+        self.assertNotIn('Content-Encoding', small.headers)
+
+    def test_replica_reads(self):
+        """Test GETs read from a replica, writes and reads after them use the primary, and a dead replica falls back."""
+        import datetime
+        import tempfile
+        from api.asgi import AsyncReadApp
+        from api.replicas import configure_replicas
+        headers = {"X-API-Key": "fake-key"}
+        self.app.post('/api/books', json={"title": "On Primary", "author": "A", "isbn": "9780000000001",
+                                          "publish_date": "2020-01-01"}, headers=headers)
+        with tempfile.TemporaryDirectory() as tmp:
+            replica_uri = f"sqlite:///{os.path.join(tmp, 'replica.db')}"
+            replica = db.create_engine(replica_uri)
+            db.metadata.create_all(replica)
+            with replica.begin() as conn:
+                conn.execute(db.insert(Book).values(id=1, title="On Replica", author="A", isbn="9780000000001",
+                                                    publish_date=datetime.date(2020, 1, 1)))
+            replica.dispose()
+            try:
+                with patch.dict(app.config, {"REPLICA_DATABASE_URIS": replica_uri}):
+                    configure_replicas(app)
+                    response = self.app.get('/api/books', headers=headers)
+                    self.assertEqual([book["title"] for book in response.json], ["On Replica"])
+                    self.assertEqual(self.app.get('/api/books/1', headers=headers).json["title"], "On Replica")
+
+                    # Writes go to the primary, and so does everything the session reads after one
+                    response = self.app.put('/api/books/1', json={"title": "Renamed"}, headers=headers)
+                    self.assertEqual(response.status_code, 200)
+                    with app.app_context():
+                        db.session.info["replica"] = app.extensions["replicas"].engines[0]
+                        self.assertEqual(db.session.scalar(db.select(Book.title)), "On Replica")
+                        db.session.execute(db.update(Book).values(author="B"))
+                        self.assertEqual(db.session.scalar(db.select(Book.title)), "Renamed")
+                        db.session.rollback()
+
+                    # The replica hasn't seen the write, so its row must not go into the book cache
+                    self.assertEqual(self.app.get('/api/books/1', headers=headers).json["title"], "On Replica")
+                    self.assertIsNone(app.extensions['book_cache'].get(1))
+
+                    # The ASGI handlers read from the replicas too
+                    async def asgi_get(asgi_app, path):
+                        messages = []
+
+                        async def receive():
+                            return {"type": "http.request", "body": b"", "more_body": False}
+
+                        async def send(message):
+                            messages.append(message)
+
+                        await asgi_app({"type": "http", "method": "GET", "path": path, "root_path": "",
+                                        "query_string": b"", "headers": [(b'x-api-key', b'fake-key')],
+                                        "http_version": "1.1", "scheme": "http"}, receive, send)
+                        await asgi_app.dispose()
+                        return json.loads(b''.join(m.get('body', b'') for m in messages[1:]))
+
+                    asgi_app = AsyncReadApp(app)
+                    self.assertEqual(asyncio.run(asgi_get(asgi_app, '/api/books/1'))["title"], "On Replica")
+                    self.assertIsNone(app.extensions['book_cache'].get(1))
+
+                missing = f"sqlite:///{os.path.join(tmp, 'missing', 'replica.db')}"
+                with patch.dict(app.config, {"REPLICA_DATABASE_URIS": missing}):
+                    configure_replicas(app)
+                    response = self.app.get('/api/books', headers=headers)
+                    self.assertEqual([book["title"] for book in response.json], ["Renamed"])
+                    stats = self.app.get('/api/instrumentation/replicas', headers=headers).json
+                    self.assertEqual((stats["replicas"][0]["healthy"], stats["fallbacks"]), (False, 1))
+                    asgi_app = AsyncReadApp(app)
+                    self.assertEqual(asyncio.run(asgi_get(asgi_app, '/api/books/1'))["title"], "Renamed")
+                    self.assertEqual(asgi_app.replicas.fallbacks, 1)
+            finally:
+                configure_replicas(app)
+
+    def test_book_changes_feed(self):
+        """Test the change feed lists inserts, updates and deletes in order, resumes from its cursor and long-polls."""
+        import threading
+        headers = {"X-API-Key": "fake-key"}
+        ids = [self.app.post('/api/books', json={"title": f"Book {i}", "author": "A", "isbn": f"978000000000{i}",
+                                                 "publish_date": "2020-01-01"}, headers=headers).json['id']
+               for i in range(2)]
+        self.app.put(f'/api/books/{ids[0]}', json={"title": "Renamed"}, headers=headers)
+        self.app.delete(f'/api/books/{ids[1]}', headers=headers)
+
+        feed = self.app.get('/api/books/changes', headers=headers).json
+        self.assertEqual([(c["id"], c["op"], c["version"]) for c in feed["changes"]],
+                         [(ids[0], "insert", 1), (ids[1], "insert", 2), (ids[0], "update", 3), (ids[1], "delete", 4)])
+        self.assertEqual(feed["changes"][0]["book"]["title"], "Renamed")  # current state
+        self.assertIsNone(feed["changes"][1]["book"])
+        self.assertFalse(feed["more"])
+        caught_up = self.app.get(f'/api/books/changes?since={feed["cursor"]}', headers=headers).json
+        self.assertEqual((caught_up["changes"], caught_up["cursor"]), ([], feed["cursor"]))
+
+        page = self.app.get('/api/books/changes?since=2&limit=1', headers=headers).json
+        self.assertEqual(([c["op"] for c in page["changes"]], page["more"]), (["update"], True))
+        page = self.app.get(f'/api/books/changes?since={page["cursor"]}', headers=headers).json
+        self.assertEqual([c["op"] for c in page["changes"]], ["delete"])
+        self.assertEqual(self.app.get('/api/books/changes?since=bogus', headers=headers).status_code, 400)
+        from api.pagination import encode_cursor
+        for since in ('99999999999999999999999', '²', encode_cursor({"v": 2 ** 64, "id": None}),
+                      encode_cursor({"v": True, "id": None}), encode_cursor({"v": 1, "id": -1})):
+            response = self.app.get('/api/books/changes', query_string={"since": since}, headers=headers)
+            self.assertEqual(response.status_code, 400, since)
+        self.assertEqual(self.app.get('/api/books/changes?wait=nan', headers=headers).status_code, 400)
+
+        with patch.dict(app.config, {"CHANGES_POLL_INTERVAL": 0.05, "CHANGES_STREAM_SECONDS": 0.2}):
+            def write_later():
+                with app.test_client() as client:
+                    client.put('/api/books/isbn/9780000000009', json={"title": "Late", "author": "A",
+                                                                         "publish_date": "2020-01-01"},
+                                headers=headers)
+            writer = threading.Timer(0.2, write_later)
+            writer.start()
+            polled = self.app.get(f'/api/books/changes?since={feed["cursor"]}&wait=10', headers=headers).json
+            writer.join()
+            self.assertEqual([(c["op"], c["book"]["title"]) for c in polled["changes"]], [("insert", "Late")])
+
+            stream = self.app.get('/api/books/changes', headers={**headers, "Accept": "text/event-stream",
+                                                                  "Last-Event-ID": feed["cursor"]})
+            self.assertEqual(stream.mimetype, 'text/event-stream')
+            events = [block for block in stream.get_data(as_text=True).split('\n\n') if block.startswith('id: ')]
+            self.assertEqual(len(events), 1)
+            self.assertEqual(events[0].split('\n')[0], f'id: {polled["cursor"]}')
+            self.assertEqual(json.loads(events[0].split('data: ')[1])["op"], "insert")
+            stream.close()
+
+            # With every waiting slot in use, streams are refused and long polls answer at once
+            import time
+            waiters, taken = app.extensions['changes_waiters'], 0
+            while waiters.acquire(blocking=False):
+                taken += 1
+            try:
+                self.assertEqual(taken, app.config['CHANGES_MAX_WAITERS'])  # the stream gave its slot back
+                stream = self.app.get('/api/books/changes', headers={**headers, "Accept": "text/event-stream"})
+                self.assertEqual((stream.status_code, stream.headers['Retry-After']), (503, "5"))
+                started = time.monotonic()
+                polled = self.app.get(f'/api/books/changes?since={polled["cursor"]}&wait=10', headers=headers)
+                self.assertEqual((polled.status_code, polled.json["changes"]), (200, []))
+                self.assertLess(time.monotonic() - started, 1)
+            finally:
+                for _ in range(taken):
+                    waiters.release()
+
+    def test_book_stats(self):
+        """Test /books/stats follows creates, updates, deletes and imports, and counts filtered views."""
+        headers = {"X-API-Key": "fake-key"}
+        self.app.post('/api/books/bulk', json=[
+            {"title": f"Book {i}", "author": "Prolific" if i < 3 else "Rare", "isbn": f"978000000000{i}",
+             "publish_date": f"{2019 + i % 2}-06-01"} for i in range(4)
+        ], headers=headers)
+        self.app.put('/api/books/4', json={"author": "Prolific", "publish_date": "2021-01-01"}, headers=headers)
+        self.app.delete('/api/books/1', headers=headers)
+
+        stats = self.app.get('/api/books/stats', headers=headers)
+        self.assertEqual(stats.json["total"], 3)
+        self.assertEqual(stats.json["by_year"], [{"year": 2019, "books": 1}, {"year": 2020, "books": 1},
+                                                 {"year": 2021, "books": 1}])
+        self.assertEqual(stats.json["top_authors"], [{"author": "Prolific", "books": 3}])
+        self.assertNotIn("matching", stats.json)
+        self.assertEqual(self.app.get('/api/books/stats', headers={
+            **headers, "If-None-Match": stats.headers["ETag"]}).status_code, 304)
+
+        def matching(query):
+            return self.app.get(f'/api/books/stats?{query}', headers=headers).json["matching"]
+        self.assertEqual(matching("author=Prolific"), {"count": 3, "exact": True})
+        self.assertEqual(matching("published_after=2020-01-01"), {"count": 2, "exact": True})
+        self.assertEqual(matching("published_after=2020-01-01&published_before=2020-12-31"), {"count": 1, "exact": True})
+        self.assertEqual(matching("author=Prolific&published_before=2020-06-30"), {"count": 2, "exact": True})
+        with patch.dict(app.config, {"STATS_COUNT_LIMIT": 2}):
+            self.assertEqual(matching("published_after=2019-02-01"), {"count": 2, "exact": False})
+        self.assertEqual(self.app.get('/api/books/stats?authors=0', headers=headers).status_code, 400)
+
+        # Rebuilding from the book table gives the same counts the triggers kept
+        result = app.test_cli_runner().invoke(args=['books', 'refresh-stats'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        refreshed = self.app.get('/api/books/stats', headers=headers).json
+        self.assertEqual({key: refreshed[key] for key in stats.json}, stats.json)
+
+    def test_shared_response_cache(self):
+        """Test the sqlite response cache is shared between instances (workers), single-fills keys and evicts LRU."""
+        import tempfile
+        import threading
+        import time
+        from api.response_cache import SqliteResponseCache
+        with tempfile.TemporaryDirectory() as tmp:
+            config = {"COLLECTION_CACHE_FILE": os.path.join(tmp, "responses.db"),
+                      "COLLECTION_CACHE_MAX_BYTES": 10, "COLLECTION_CACHE_FILL_WAIT": 5}
+            first, second = SqliteResponseCache(config), SqliteResponseCache(config)
+            first.TOUCH_INTERVAL = second.TOUCH_INTERVAL = 0  # record every hit right away
+            self.assertIsNone(first.get("a"))  # miss, and first now fills "a"
+            threading.Timer(0.1, first.set, ("a", b"12345", [("ETag", "x")])).start()
+            self.assertEqual(second.get("a"), (b"12345", [["ETag", "x"]]))  # waited for first's bytes
+
+            second.set("b", b"678", [])
+            self.assertIsNotNone(first.get("a"))  # "b" is now the least recently used
+            second.set("c", b"9012", [])  # 12 bytes > 10: evict "b"
+            self.assertIsNone(second.get("b", wait=False))
+            self.assertIsNotNone(second.get("c"))
+            self.assertEqual(first.stats(), {"entries": 2, "bytes": 9, "max_bytes": 10,
+                                             "hits": 3, "misses": 2, "evictions": 1})
+
+            # A fill that is never stored (too large here) is released, and nobody waits for it
+            self.assertIsNone(first.get("d"))
+            first.set("d", b"too large to cache", [])
+            first.release()
+            started = time.monotonic()
+            self.assertIsNone(second.get("d"))
+            self.assertLess(time.monotonic() - started, 1)
+
+        headers = {"X-API-Key": "fake-key"}
+        self.app.post('/api/books', json={"title": "Shared", "author": "A", "isbn": "9780000000001",
+                                          "publish_date": "2020-01-01"}, headers=headers)
+        with tempfile.TemporaryDirectory() as tmp:
+            config = {**app.config, "COLLECTION_CACHE_FILE": os.path.join(tmp, "responses.db")}
+            with patch.dict(app.extensions, {"collection_cache": SqliteResponseCache(config)}):
+                responses = [self.app.get('/api/books', headers=headers) for _ in range(2)]
+                self.assertEqual(responses[0].get_data(), responses[1].get_data())
+                stats = self.app.get('/api/instrumentation/responses', headers=headers).json
+                self.assertEqual((stats["entries"], stats["hits"], stats["hit_rate"]), (1, 1, 0.5))
+                self.app.delete('/api/books/1', headers=headers)
+                self.assertEqual(self.app.get('/api/instrumentation/responses', headers=headers).json["entries"], 0)
+
+            # Requests whose response isn't cached leave no lease behind
+            small = SqliteResponseCache({**config, "COLLECTION_CACHE_MAX_BYTES": 1})
+            with patch.dict(app.extensions, {"collection_cache": small}):
+                self.assertEqual(self.app.get('/api/books?cursor=bogus', headers=headers).status_code, 400)
+                self.assertEqual(self.app.get('/api/books', headers=headers).status_code, 200)
+                self.assertEqual(small._db.execute("SELECT count(*) FROM lease").fetchone()[0], 0)
+
+    def test_batch_get_books(self):
+        """Test batch lookups by ID and ISBN answer in request order, mark misses and fill the book cache."""
+        headers = {"X-API-Key": "fake-key"}
+        self.app.post('/api/books/bulk', json=[
+            {"title": f"Listed {i}", "author": "A", "isbn": f"978000000000{i}", "publish_date": "2020-01-01"}
+            for i in range(1, 4)
+        ], headers=headers)
+        self.app.get('/api/books/2', headers=headers)  # cached
+        cache = app.extensions['book_cache']
+        hits = cache.stats()["hits"]
+
+        response = self.app.get('/api/books?ids=3,99,2,3', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json["found"], response.json["not_found"]), (3, 1))
+        self.assertEqual([(r["id"], r["status"], r.get("book", {}).get("title")) for r in response.json["results"]],
+                         [(3, "found", "Listed 3"), (99, "not_found", None), (2, "found", "Listed 2"),
+                          (3, "found", "Listed 3")])
+        self.assertEqual(cache.stats()["hits"], hits)  # cached host-wide, so every row is read
+        self.assertEqual(self.app.get('/api/books/3', headers=headers).json["title"], "Listed 3")
+        self.assertEqual(cache.stats()["hits"], hits + 1)  # filled by the batch
+        self.assertEqual(self.app.get('/api/books?ids=1,x', headers=headers).status_code, 400)
+        self.assertEqual(self.app.get('/api/books?ids=1&sort=title', headers=headers).status_code, 400)
+
+        response = self.app.post('/api/books/batch-get', json={"isbns": ["9780000000001", "9780000000009"]},
+                                 headers=headers)
+        self.assertEqual([(r["isbn"], r["status"]) for r in response.json["results"]],
+                         [("9780000000001", "found"), ("9780000000009", "not_found")])
+        response = self.app.post('/api/books/batch-get', json={"ids": [1, 2]}, headers=headers)
+        self.assertEqual([r["book"]["isbn"] for r in response.json["results"]], ["9780000000001", "9780000000002"])
+        for body in ({"ids": ["1"]}, {"ids": [1], "isbns": []}, [1, 2]):
+            self.assertEqual(self.app.post('/api/books/batch-get', json=body, headers=headers).status_code, 400)
+
+        # An entry another worker's write has made stale never reaches the shared ?ids= response
+        cache.set(1, ("b1-0", {"id": 1, "title": "Stale"}))
+        response = self.app.get('/api/books?ids=1', headers=headers)
+        self.assertEqual(response.json["results"][0]["book"]["title"], "Listed 1")
+
+    def test_batch_get_out_of_range_ids(self):
+        """Test that IDs too large for any integer column are reported as not found, not a 500."""
+        headers = {"X-API-Key": "fake-key"}
+        self.app.post('/api/books', json={"title": "T", "author": "A", "isbn": "9780000000001",
+                                          "publish_date": "2020-01-01"}, headers=headers)
+        huge = 99999999999999999999
+        response = self.app.get(f'/api/books?ids=1,{huge},-{huge}', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r["status"] for r in response.json["results"]], ["found", "not_found", "not_found"])
+        response = self.app.post('/api/books/batch-get', json={"ids": [huge, 1]}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r["status"] for r in response.json["results"]], ["not_found", "found"])
+
+    def test_existing_database_upgraded(self):
+        """Test that create_all brings a book table from before versions, indexes and search up to date."""
+        with app.app_context():
+            db.drop_all()
+            with db.engine.begin() as connection:
+                connection.exec_driver_sql(
+                    "CREATE TABLE book (id INTEGER PRIMARY KEY, title VARCHAR(100) NOT NULL, "
+                    "author VARCHAR(100) NOT NULL, isbn VARCHAR(13) NOT NULL UNIQUE, publish_date DATE NOT NULL, "
+                    "created_at DATETIME, updated_at DATETIME)")
+                connection.exec_driver_sql("INSERT INTO book (title, author, isbn, publish_date) "
+                                           "VALUES ('Old Book', 'Old Author', '1234567890123', '2020-01-01')")
+            db.create_all()
+            indexes = {index['name'] for index in db.inspect(db.engine).get_indexes('book')}
+        self.assertLessEqual({'ix_book_author_id', 'ix_book_title_id'}, indexes)
+
+        response = self.app.get('/api/books/1', headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], '"b1-1"')
+        response = self.app.get('/api/books/search?q=old', headers={"X-API-Key": "fake-key"})
+        self.assertEqual([b['id'] for b in response.json['books']], [1])
+        response = self.app.put('/api/books/1', json={"title": "Renamed"}, headers={"X-API-Key": "fake-key"})
+        self.assertEqual(response.headers['ETag'], '"b1-2"')
+
+    def test_recreated_catalog_not_served_from_cache(self):
+        """Test a recreated database whose catalog version starts over doesn't match old ETags or cached bodies."""
+        headers = {"X-API-Key": "fake-key"}
+        book = {"title": "First Run", "author": "A", "isbn": "9780000000100", "publish_date": "2020-01-01"}
+        self.app.post('/api/books', json=book, headers=headers)
+        old = self.app.get('/api/books', headers=headers)
+        self.assertEqual(len(old.json), 1)
+
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+        self.app.post('/api/books/bulk', json=[{**book, "isbn": f"978000000020{i}"} for i in range(2)],
+                      headers=headers)  # catalog version 1 again
+        response = self.app.get('/api/books', headers={**headers, "If-None-Match": old.headers['ETag']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json), 2)
+
 if __name__ == '__main__':
     unittest.main()
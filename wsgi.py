@@ -0,0 +1,11 @@
+"""Production WSGI entry point.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Uses the "production" config unless FLASK_ENV says otherwise.
+"""
+import os
+
+os.environ.setdefault("FLASK_ENV", "production")
+
+from main import app  # noqa: E402  (FLASK_ENV must be set first)